@@ -0,0 +1,474 @@
+# Benchmark e verificação de precisão do motor de rastreamento (biostep_engine)
+#
+# Gera vídeos sintéticos com marcadores amarelos em trajetórias conhecidas (várias
+# resoluções, fps, durações, ruído, desfoque e oclusão) e mede, para cada cenário e modo:
+#   - vazão (frames/s) de AnalisadorBioStep.processar_video
+#   - latência por etapa (decodificação, resize, cinza, fluxo óptico, métricas, DataFrame), pela instrumentação do motor
+#   - pico de memória (tracemalloc) durante o processamento
+#   - erro de rastreamento em relação à trajetória real (px no frame de referência)
+#   - erro das métricas (ângulo do joelho e desvio linear) em relação às calculadas na trajetória real
+# Também confere calcular_angulo/calcular_desvio_linear em casos analíticos, roda verificações
+# de robustez (ex.: um worker do lote que morre não derruba os outros vídeos) e mede, em
+# processos novos, o tempo de importação do motor e da página inicial do dashboard, que não
+# podem carregar as dependências pesadas (pandas, plotly, OpenCV, fpdf).
+#
+# Uso:
+#   python benchmark_biostep.py [--rapido] [--saida relatorio.json] [--limites benchmark_limites.json]
+#                               [--base relatorio_anterior.json]
+#   python benchmark_biostep.py --importacao      # só o tempo de importação
+# Sai com código 1 se algum limite for violado ou se a vazão cair mais que a tolerância em
+# relação ao relatório base.
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import biostep_engine as be
+
+PASTA = os.path.dirname(os.path.abspath(__file__))
+LIMITES_PADRAO = os.path.join(PASTA, 'benchmark_limites.json')
+
+# Cenários: resolução do vídeo, fps, número de frames e degradações
+CENARIOS = [
+    {'nome': '720p_30fps', 'largura': 720, 'altura': 1280, 'fps': 30, 'frames': 150},
+    {'nome': '1080p_60fps', 'largura': 1080, 'altura': 1920, 'fps': 60, 'frames': 240},
+    {'nome': '1080p_ruido_desfoque', 'largura': 1080, 'altura': 1920, 'fps': 30, 'frames': 150, 'ruido': 8, 'desfoque': 2.0},
+    {'nome': '720p_oclusao', 'largura': 720, 'altura': 1280, 'fps': 30, 'frames': 150, 'oclusao': 6},
+    {'nome': '4k_30fps', 'largura': 2160, 'altura': 3840, 'fps': 30, 'frames': 90},
+    {'nome': 'paisagem_1080p', 'largura': 1920, 'altura': 1080, 'fps': 30, 'frames': 120},
+]
+CENARIOS_RAPIDOS = ['720p_30fps', '720p_oclusao']
+
+# Modos do AnalisadorBioStep comparados em cada cenário
+MODOS = {
+    'padrao': {},
+    'roi': {'roi': True},
+    'reancorar': {'reancorar': True},
+    # reancoragem periódica: ainda perde para o reancorar simples na maioria dos cenários, por isso
+    # não aparece no painel nem na linha de comando
+    'reancorar_cada': {'reancorar': True, 'reancorar_cada': 5},
+    'buffers_fixos': {'buffers_fixos': True},
+    'blocos': {'blocos_paralelos': 4},
+}
+
+
+# --- Vídeos sintéticos ---
+
+# trajetória de um Step Down: o joelho desce e vai para medial, a pelve inclina.
+# Retorna (frames x 5 x 2) em pixels do vídeo
+def trajetoria_sintetica(n_frames, largura, altura, repeticoes=2):
+    t = np.linspace(0, 1, n_frames)
+    fase = np.sin(np.pi * repeticoes * t) ** 2  # 0 em pé, 1 no fundo do movimento
+
+    # posições relativas em pé (esterno, quadril dir, quadril esq, joelho, tornozelo)
+    base = np.array([[0.50, 0.25], [0.42, 0.45], [0.58, 0.45], [0.53, 0.68], [0.52, 0.90]])
+    # deslocamento no fundo do movimento (fração da largura/altura)
+    fundo = np.array([[0.01, 0.05], [0.00, 0.06], [0.00, 0.03], [-0.05, 0.03], [0.00, 0.00]])
+
+    # em vídeos paisagem o corpo ocupa a altura: escala pela menor dimensão, centrado
+    escala = np.array([min(largura, altura * 9 / 16), altura], dtype=np.float64)
+    origem = np.array([(largura - escala[0]) / 2, 0.0])
+    pts = base[None] + fase[:, None, None] * fundo[None]
+    return (pts * escala + origem).astype(np.float32)
+
+def fundo_texturizado(largura, altura, semente=0):
+    rng = np.random.default_rng(semente)
+    ruido = rng.integers(40, 160, (altura // 8 + 1, largura // 8 + 1, 3), dtype=np.uint8)
+    return cv2.GaussianBlur(cv2.resize(ruido, (largura, altura), interpolation=cv2.INTER_LINEAR), (0, 0), 2)
+
+# grava o vídeo sintético e retorna a trajetória real (px do vídeo)
+# repeticoes=0: os marcadores ficam parados o vídeo todo
+def gerar_video_sintetico(caminho, largura, altura, fps, frames, ruido=0, desfoque=0.0, oclusao=0, semente=0, repeticoes=2, **_):
+    gt = trajetoria_sintetica(frames, largura, altura, repeticoes)
+    fundo = fundo_texturizado(largura, altura, semente)
+    rng = np.random.default_rng(semente + 1)
+    raio = max(4, round(0.02 * min(largura, altura * 9 / 16)))
+    escrita = cv2.VideoWriter(caminho, cv2.VideoWriter_fourcc(*'mp4v'), fps, (largura, altura))
+    inicio_oclusao = frames // 3  # o joelho some por `oclusao` frames
+
+    for i in range(frames):
+        frame = fundo.copy()
+        for j, (x, y) in enumerate(gt[i]):
+            if j == 3 and inicio_oclusao <= i < inicio_oclusao + oclusao: continue
+            # desenho com precisão subpixel (shift=4)
+            cv2.circle(frame, (int(round(x * 16)), int(round(y * 16))), raio * 16, (0, 220, 240), -1, cv2.LINE_AA, shift=4)
+        if desfoque: frame = cv2.GaussianBlur(frame, (0, 0), desfoque)
+        if ruido: frame = np.clip(frame + rng.normal(0, ruido, frame.shape), 0, 255).astype(np.uint8)
+        escrita.write(frame)
+    escrita.release()
+    return gt
+
+
+# --- Medições ---
+
+def _para_referencia(gt, largura, altura, analise):
+    return gt * np.array([analise.LARGURA / largura, analise.ALTURA / altura], dtype=np.float32)
+
+# roda processar_video medindo tempo, memória e erros
+def medir_modo(caminho, gt, cenario, opcoes):
+    analise = be.AnalisadorBioStep(caminho, **opcoes)
+    gt_ref = _para_referencia(gt, cenario['largura'], cenario['altura'], analise)
+    analise.set_pontos(gt_ref[0])
+
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    df = analise.processar_video()
+    duracao = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    real = gt_ref[analise.frames]
+    erro = np.linalg.norm(analise.trajetoria - real, axis=-1)
+    metricas_reais = be.calcular_metricas_lote(real, analise.frames)
+    erro_angulo = np.abs(df['Angulo Joelho'].to_numpy() - metricas_reais['Angulo Joelho'])
+    erro_desvio = np.abs(df['Desvio Valgo (px)'].to_numpy() - metricas_reais['Desvio Valgo (px)'])
+    return {
+        'frames': len(df),
+        'segundos': round(duracao, 4),
+        'fps': round(len(df) / duracao, 1) if duracao else None,
+        'memoria_pico_mb': round(pico / 2 ** 20, 2),
+        'erro_px_medio': round(float(erro.mean()), 4),
+        'erro_px_p95': round(float(np.percentile(erro, 95)), 4),
+        'erro_px_max': round(float(erro.max()), 4),
+        'erro_angulo_medio': round(float(erro_angulo.mean()), 4),
+        'erro_angulo_max': round(float(erro_angulo.max()), 4),
+        'erro_desvio_medio_px': round(float(erro_desvio.mean()), 4),
+    }
+
+# latência por etapa (ms por chamada) pela instrumentação do motor, com leitura sequencial
+# para que a decodificação não se sobreponha ao rastreamento
+def medir_etapas(caminho, gt, cenario):
+    analise = be.AnalisadorBioStep(caminho, instrumentar=True)
+    analise.set_pontos(_para_referencia(gt, cenario['largura'], cenario['altura'], analise)[0])
+    analise.processar_video(profundidade_fila=0)
+    return {etapa: {'media_ms': e['media_ms'], 'p50_ms': e['p50_ms'], 'p95_ms': e['p95_ms']}
+            for etapa, e in analise.diagnostico['etapas'].items()}
+
+# casos analíticos das funções de métrica (escalares e vetorizadas)
+def verificar_funcoes_metricas():
+    falhas = []
+
+    def conferir(nome, obtido, esperado, tol=1e-6):
+        if not math.isclose(obtido, esperado, abs_tol=tol):
+            falhas.append(f"{nome}: obtido {obtido}, esperado {esperado}")
+
+    conferir('angulo reto', be.calcular_angulo((0, 0), (1, 0), (1, 1)), 90.0)
+    conferir('angulo raso', be.calcular_angulo((0, -1), (0, 0), (0, 1)), 180.0)
+    conferir('angulo 60', be.calcular_angulo((1, 0), (0, 0), (0.5, math.sqrt(3) / 2)), 60.0)
+    conferir('angulo degenerado', be.calcular_angulo((1, 1), (1, 1), (2, 2)), 0.0)
+    conferir('desvio sobre a reta', be.calcular_desvio_linear((0, 0), (0, 5), (0, 10)), 0.0)
+    conferir('desvio 3 px', abs(be.calcular_desvio_linear((0, 0), (3, 5), (0, 10))), 3.0)
+    conferir('desvio reta nula', be.calcular_desvio_linear((2, 2), (5, 5), (2, 2)), 0.0)
+    conferir('pelve nivelada', be.calcular_inclinacao((0, 0), (10, 0)), 0.0)
+    conferir('tronco vertical', be.calcular_tronco((0, 0), (-1, 10), (1, 10)), 0.0)
+
+    # vetorizada == escalar em pontos aleatórios
+    rng = np.random.default_rng(0)
+    trajetoria = rng.uniform(0, 800, (200, 5, 2)).astype(np.float32)
+    colunas = be.calcular_metricas_lote(trajetoria)
+    for i in range(0, 200, 17):
+        pts = trajetoria[i].astype(np.float64)
+        q = pts[1] if np.linalg.norm(pts[1] - pts[3]) < np.linalg.norm(pts[2] - pts[3]) else pts[2]
+        conferir(f'lote angulo {i}', colunas['Angulo Joelho'][i], be.calcular_angulo(q, pts[3], pts[4]), 1e-9)
+        conferir(f'lote desvio {i}', colunas['Desvio Valgo (px)'][i], be.calcular_desvio_linear(q, pts[3], pts[4]), 1e-9)
+
+    # bilateral: cada lado usa o próprio quadril, joelho e tornozelo
+    trajetoria = rng.uniform(0, 800, (200, 7, 2)).astype(np.float32)
+    colunas = be.calcular_metricas_lote(trajetoria, esquema=be.ESQUEMA_BILATERAL)
+    for i in range(0, 200, 17):
+        pts = trajetoria[i].astype(np.float64)
+        for sufixo, (q, j, t), sinal in ((' Dir', (1, 3, 4), -1), (' Esq', (2, 5, 6), 1)):
+            conferir(f'bilateral angulo{sufixo} {i}', colunas[f'Angulo Joelho{sufixo}'][i], be.calcular_angulo(pts[q], pts[j], pts[t]), 1e-9)
+            conferir(f'bilateral desvio{sufixo} {i}', colunas[f'Desvio Valgo{sufixo} (px)'][i], sinal * be.calcular_desvio_linear(pts[q], pts[j], pts[t]), 1e-9)
+
+    # pernas espelhadas na vista frontal (a direita do paciente fica no lado esquerdo da imagem): os dois
+    # joelhos vão de 0 a 10 px para medial e o pico de valgo é +10 px nos dois lados
+    medial = np.linspace(0, 10, 11)
+    espelhado = np.tile(np.array([[400, 200], [320, 400], [480, 400], [320, 600], [320, 800], [480, 600], [480, 800]],
+                                 dtype=np.float64), (len(medial), 1, 1))
+    espelhado[:, 3, 0] += medial
+    espelhado[:, 5, 0] -= medial
+    picos = be.calcular_picos(be.calcular_metricas_lote(espelhado, esquema=be.ESQUEMA_BILATERAL))
+    for sufixo in (' Dir', ' Esq'):
+        conferir(f'bilateral espelhado valgo{sufixo}', picos[f'Desvio Maximo{sufixo}'], 10.0)
+    return falhas
+
+
+# --- Robustez ---
+
+# vídeos pequenos com o json lateral de pontos (frame de referência 480x850), como o lote espera
+def gerar_videos_lote(pasta, nomes, frames=30, largura=360, altura=640, **kwargs):
+    for nome in nomes:
+        gt = gerar_video_sintetico(os.path.join(pasta, nome + '.mp4'), largura, altura, 30, frames, **kwargs)
+        pontos = gt[0] * np.array([480 / largura, 850 / altura])
+        with open(os.path.join(pasta, nome + '.json'), 'w', encoding='utf-8') as f:
+            json.dump({'pontos': pontos.tolist()}, f)
+
+# o worker herda (fork) o processar_um substituído, que mata o próprio processo em um dos vídeos
+_LOTE_COM_FALHA = '''
+import json, multiprocessing, os, sys
+import biostep_lote
+multiprocessing.set_start_method('fork', force=True)
+original = biostep_lote.processar_um
+def processar_um(id_, *args, **kwargs):
+    if id_ == sys.argv[2]: os._exit(1)
+    return original(id_, *args, **kwargs)
+biostep_lote.processar_um = processar_um
+resumo = biostep_lote.processar_lote(sys.argv[1], sys.argv[1] + '_saida', processos=2, profundidade_fila=0)
+print(json.dumps(dict(zip(resumo['Video'], resumo['Status']))))
+'''
+
+# um processo do lote que morre só perde o próprio vídeo; os demais terminam com status ok
+def verificar_isolamento_lote():
+    import multiprocessing
+    if 'fork' not in multiprocessing.get_all_start_methods(): return []
+    with tempfile.TemporaryDirectory(prefix='biostep_lote_') as pasta:
+        videos = os.path.join(pasta, 'videos')
+        os.makedirs(videos)
+        gerar_videos_lote(videos, ['v1', 'v2', 'v3', 'v4'])
+        saida = subprocess.run([sys.executable, '-c', _LOTE_COM_FALHA, videos, 'v2'], cwd=PASTA,
+                               capture_output=True, text=True, timeout=300)
+        if saida.returncode != 0:
+            return [f"lote com worker morto: {saida.stderr.strip().splitlines()[-1:]}"]
+        status = json.loads(saida.stdout.strip().splitlines()[-1])
+    esperado = {'v1': 'ok', 'v2': 'erro', 'v3': 'ok', 'v4': 'ok'}
+    return [] if status == esperado else [f"lote com worker morto: status {status}, esperado {esperado}"]
+
+# segmentar em um vídeo sem movimento: nenhuma janela, resultado vazio (e não o vídeo inteiro como repetição 0)
+def verificar_segmentacao_sem_movimento():
+    falhas = []
+    with tempfile.TemporaryDirectory(prefix='biostep_parado_') as pasta:
+        gerar_videos_lote(pasta, ['parado'], frames=60, repeticoes=0)
+        with open(os.path.join(pasta, 'parado.json'), encoding='utf-8') as f:
+            pontos = json.load(f)['pontos']
+        chamadas = []
+        analise = be.AnalisadorBioStep(os.path.join(pasta, 'parado.mp4'), segmentar=True)
+        analise.set_pontos(pontos)
+        df = analise.processar_video(progresso=lambda feitos, total: chamadas.append(total))
+    if analise.janelas != []: falhas.append(f"vídeo parado: janelas {analise.janelas}, esperado []")
+    if len(df): falhas.append(f"vídeo parado: {len(df)} frames rastreados, esperado 0")
+    if 'Repeticao' not in df.columns: falhas.append("vídeo parado: sem a coluna Repeticao")
+    if chamadas: falhas.append(f"vídeo parado: progresso chamado {len(chamadas)} vezes")
+    return falhas
+
+# relatório (figuras e PDF, com picos por repetição) de um esquema sem pelve: sem a coluna Queda Pelvica
+ESQUEMA_SEM_PELVE = {
+    'nome': 'sem_pelve',
+    'pontos': ['Quadril Dir', 'Joelho Dir', 'Tornozelo Dir'],
+    'lados': {' Dir': {'quadril': 'Quadril Dir', 'joelho': 'Joelho Dir', 'tornozelo': 'Tornozelo Dir'}},
+    'pelve': None,
+    'tronco': None,
+}
+
+def verificar_relatorio_sem_pelve():
+    import pandas as pd
+    from biostep_relatorio import figuras_padrao, gerar_pdfs_lote
+    rng = np.random.default_rng(0)
+    frames = np.arange(1, 61)
+    df = pd.DataFrame({'Frame': frames, **be.calcular_metricas_lote(rng.uniform(0, 800, (60, 3, 2)), frames, ESQUEMA_SEM_PELVE),
+                       'Repeticao': (frames > 30) + 1})
+    try:
+        figuras = figuras_padrao(df)
+        pdf, = gerar_pdfs_lote([{'nome_paciente': 'sem pelve', 'df': df, 'figuras': figuras}])
+    except Exception as e:
+        return [f"relatório sem pelve: {type(e).__name__}: {e}"]
+    falhas = [] if figuras[2] is None else ["relatório sem pelve: gráfico da pelve gerado sem a coluna"]
+    if not pdf.startswith(b'%PDF'): falhas.append("relatório sem pelve: PDF inválido")
+    return falhas
+
+# reduzir_df com várias colunas: no máximo max_pontos linhas, mantendo o mínimo e o máximo de cada coluna
+def verificar_reducao_graficos():
+    import pandas as pd
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'Frame': np.arange(20000), **{f'c{i}': rng.normal(0, 1, 20000).cumsum() for i in range(3)}})
+    falhas = []
+    for colunas, max_pontos in ((['c0'], 500), (['c0', 'c1'], 500), (['c0', 'c1', 'c2'], 2000)):
+        reduzido = be.reduzir_df(df, colunas, max_pontos)
+        if len(reduzido) > max_pontos:
+            falhas.append(f"reduzir_df {colunas}: {len(reduzido)} linhas, limite {max_pontos}")
+        for c in colunas:
+            if reduzido[c].min() != df[c].min() or reduzido[c].max() != df[c].max():
+                falhas.append(f"reduzir_df {colunas}: picos de {c} perdidos")
+    return falhas
+
+def verificar_robustez():
+    return (verificar_isolamento_lote() + verificar_segmentacao_sem_movimento() + verificar_relatorio_sem_pelve()
+            + verificar_reducao_graficos())
+
+
+# --- Tempo de importação ---
+
+# módulos que não podem ser carregados ao importar o motor / ao abrir a página inicial
+PESADOS_MOTOR = ['pandas']
+PESADOS_INICIO = ['pandas', 'plotly.express', 'cv2', 'fpdf', 'streamlit_image_coordinates', 'biostep_engine']
+
+_MEDIR_MOTOR = '''
+import json, sys, time
+t = time.perf_counter()
+import biostep_engine
+segundos = time.perf_counter() - t
+print(json.dumps({'segundos': segundos, 'pesados': [m for m in json.loads(sys.argv[1]) if m in sys.modules]}))
+'''
+
+# o streamlit já está carregado no servidor: só a execução do script conta
+_MEDIR_INICIO = '''
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+antes = set(sys.modules)
+t = time.perf_counter()
+at = AppTest.from_file('dashboard.py', default_timeout=120).run()
+segundos = time.perf_counter() - t
+pesados = [m for m in json.loads(sys.argv[1]) if m in sys.modules and m not in antes]
+print(json.dumps({'segundos': segundos, 'pesados': pesados, 'erro': str(at.exception[0].message) if at.exception else None}))
+'''
+
+def _medir_em_processo_novo(codigo, pesados):
+    saida = subprocess.run([sys.executable, '-c', codigo, json.dumps(pesados)], cwd=PASTA,
+                           capture_output=True, text=True, timeout=300)
+    if saida.returncode != 0:
+        return {'segundos': None, 'pesados': [], 'erro': saida.stderr.strip().splitlines()[-1:]}
+    return json.loads(saida.stdout.strip().splitlines()[-1])
+
+# melhor de N execuções, cada uma em um processo novo (importação a frio)
+def medir_importacao(repeticoes=3):
+    resultado = {}
+    for nome, codigo, pesados in (('biostep_engine', _MEDIR_MOTOR, PESADOS_MOTOR),
+                                  ('dashboard_inicio', _MEDIR_INICIO, PESADOS_INICIO)):
+        medidas = [_medir_em_processo_novo(codigo, pesados) for _ in range(repeticoes)]
+        validas = [m for m in medidas if m['segundos'] is not None]
+        melhor = min(validas, key=lambda m: m['segundos']) if validas else medidas[0]
+        if melhor['segundos'] is not None: melhor['segundos'] = round(melhor['segundos'], 4)
+        resultado[nome] = melhor
+        print(f"{'importação ' + nome:>33}: {melhor['segundos']} s  pesados carregados: {melhor['pesados'] or '-'}", file=sys.stderr)
+    return resultado
+
+# limites: {"importacao": {"biostep_engine": {"segundos_max": ...}, "dashboard_inicio": {...}}}
+def verificar_importacao(medidas, limites):
+    violacoes = []
+    for nome, m in medidas.items():
+        if m.get('erro'): violacoes.append(f"importação {nome}: erro {m['erro']}")
+        if m['pesados']: violacoes.append(f"importação {nome}: carregou {', '.join(m['pesados'])}")
+        teto = limites.get('importacao', {}).get(nome, {}).get('segundos_max')
+        if teto is not None and m['segundos'] is not None and m['segundos'] > teto:
+            violacoes.append(f"importação {nome}: {m['segundos']} s (limite max {teto})")
+    return violacoes
+
+
+# --- Limites e regressões ---
+
+def carregar_limites(caminho):
+    if not caminho or not os.path.exists(caminho): return {}
+    with open(caminho, encoding='utf-8') as f:
+        return json.load(f)
+
+# compara o resultado de cada cenário/modo com os limites. Formato:
+#   {"padrao": {...}, "modos": {modo: {...}}, "cenarios": {nome: {..., "modos": {modo: {...}}}}}
+# chaves *_max são tetos e *_min são pisos; as regras mais específicas sobrescrevem as gerais
+def verificar_limites(relatorio, limites):
+    violacoes = []
+    for nome, resultado in relatorio['cenarios'].items():
+        do_cenario = limites.get('cenarios', {}).get(nome, {})
+        for modo, medidas in resultado['modos'].items():
+            regras = dict(limites.get('padrao', {}))
+            regras.update(limites.get('modos', {}).get(modo, {}))
+            regras.update({k: v for k, v in do_cenario.items() if k != 'modos'})
+            regras.update(do_cenario.get('modos', {}).get(modo, {}))
+            for chave, limite in regras.items():
+                campo, tipo = chave.rsplit('_', 1)
+                valor = medidas.get(campo)
+                if valor is None: continue
+                if (tipo == 'max' and valor > limite) or (tipo == 'min' and valor < limite):
+                    violacoes.append(f"{nome}/{modo}: {campo} = {valor} (limite {tipo} {limite})")
+    return violacoes
+
+# queda de vazão em relação a um relatório anterior (mesmos cenários e modos)
+def comparar_com_base(relatorio, base, tolerancia):
+    violacoes = []
+    for nome, resultado in relatorio['cenarios'].items():
+        anterior = base.get('cenarios', {}).get(nome)
+        if not anterior: continue
+        for modo, medidas in resultado['modos'].items():
+            fps_base = anterior['modos'].get(modo, {}).get('fps')
+            if fps_base and medidas['fps'] < fps_base * (1 - tolerancia):
+                violacoes.append(f"{nome}/{modo}: fps caiu de {fps_base} para {medidas['fps']}")
+            erro_base = anterior['modos'].get(modo, {}).get('erro_px_medio')
+            if erro_base is not None and medidas['erro_px_medio'] > erro_base * (1 + tolerancia) + 0.05:
+                violacoes.append(f"{nome}/{modo}: erro médio subiu de {erro_base} para {medidas['erro_px_medio']} px")
+    return violacoes
+
+
+def executar(cenarios, modos):
+    relatorio = {
+        'versao_motor': be.VERSAO_MOTOR,
+        'opencv': cv2.__version__,
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'nucleos': os.cpu_count(),
+        'data': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'funcoes_metricas': verificar_funcoes_metricas(),
+        'robustez': verificar_robustez() if cenarios else [],
+        'cenarios': {},
+    }
+    with tempfile.TemporaryDirectory(prefix='biostep_bench_') as pasta:
+        for cenario in cenarios:
+            caminho = os.path.join(pasta, cenario['nome'] + '.mp4')
+            gt = gerar_video_sintetico(caminho, **cenario)
+            resultado = {'cenario': cenario, 'etapas_ms': medir_etapas(caminho, gt, cenario), 'modos': {}}
+            for modo, opcoes in modos.items():
+                resultado['modos'][modo] = medir_modo(caminho, gt, cenario, opcoes)
+                m = resultado['modos'][modo]
+                print(f"{cenario['nome']:>22} {modo:>10}: {m['fps']:>8} fps  erro {m['erro_px_medio']:.3f} px  "
+                      f"ângulo {m['erro_angulo_medio']:.3f}°  memória {m['memoria_pico_mb']} MB", file=sys.stderr)
+            # vazão de cada modo em relação ao padrão no mesmo cenário (limite fps_relativo_min)
+            fps_padrao = resultado['modos'].get('padrao', {}).get('fps')
+            if fps_padrao:
+                for m in resultado['modos'].values():
+                    if m['fps']: m['fps_relativo'] = round(m['fps'] / fps_padrao, 3)
+            relatorio['cenarios'][cenario['nome']] = resultado
+    return relatorio
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark e precisão do motor do BioStep Analyzer em vídeos sintéticos.")
+    parser.add_argument('--rapido', action='store_true', help="só os cenários pequenos")
+    parser.add_argument('--saida', default='benchmark_relatorio.json', help="relatório JSON (padrão: %(default)s)")
+    parser.add_argument('--limites', default=LIMITES_PADRAO, help="arquivo de limites (padrão: %(default)s)")
+    parser.add_argument('--base', help="relatório anterior para detectar regressões de vazão/precisão")
+    parser.add_argument('--tolerancia', type=float, default=0.15, help="queda relativa aceita em relação à base (padrão: %(default)s)")
+    parser.add_argument('--importacao', action='store_true', help="só mede o tempo de importação (sem os vídeos sintéticos)")
+    args = parser.parse_args(argv)
+
+    limites = carregar_limites(args.limites)
+    cenarios = [c for c in CENARIOS if not args.rapido or c['nome'] in CENARIOS_RAPIDOS]
+    relatorio = executar([] if args.importacao else cenarios, MODOS)
+    relatorio['importacao'] = medir_importacao()
+
+    violacoes = [f"funções de métrica: {f}" for f in relatorio['funcoes_metricas']]
+    violacoes += [f"robustez: {f}" for f in relatorio['robustez']]
+    violacoes += verificar_limites(relatorio, limites)
+    violacoes += verificar_importacao(relatorio['importacao'], limites)
+    if args.base:
+        with open(args.base, encoding='utf-8') as f:
+            violacoes += comparar_com_base(relatorio, json.load(f), args.tolerancia)
+    relatorio['violacoes'] = violacoes
+
+    with open(args.saida, 'w', encoding='utf-8') as f:
+        json.dump(relatorio, f, indent=2, ensure_ascii=False)
+
+    for v in violacoes:
+        print(f"VIOLAÇÃO: {v}", file=sys.stderr)
+    print(f"relatório: {args.saida} ({len(violacoes)} violações)", file=sys.stderr)
+    return 1 if violacoes else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+# Modo ao vivo: rastreamento durante o próprio teste, a partir de uma câmera
+#
+# Uso:
+#   python biostep_ao_vivo.py 0 --marcar                      # câmera 0, pontos marcados com o mouse
+#   python biostep_ao_vivo.py rtsp://... --pontos pontos.json
+#   python biostep_ao_vivo.py teste.mp4 --pontos teste.json   # arquivo reproduzido na velocidade real
+#
+# Uma thread de captura guarda só o frame mais recente: se o rastreamento atrasar, os frames
+# intermediários são descartados em vez de acumular em uma fila. Frames que já chegam mais velhos
+# que o orçamento de latência também são descartados. Ao final, o relatório traz o fps alcançado
+# e a latência de ponta a ponta (da captura até as métricas do frame prontas).
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from biostep_diagnostico import Instrumentacao, SEM_INSTRUMENTACAO, registrar_log
+from biostep_engine import (AnalisadorBioStep, ESQUEMA_PADRAO, calcular_metricas_lote, calcular_picos, colunas_metricas,
+                            escolher_quadril_apoio_lote, refinar_ponto_pela_cor)
+
+ORCAMENTO_MS = 100     # idade máxima de um frame ao começar a ser processado
+JANELA_S = 10.0        # segundos de métricas mantidos para o painel (picos recentes)
+INTERVALO_EXIBICAO = 0.1
+
+
+# Fonte de frames ao vivo: índice de câmera, URL de stream ou arquivo.
+# Arquivos são reproduzidos na velocidade real (tempo_real=None: só arquivos), como se fossem uma câmera
+class FonteAoVivo:
+    def __init__(self, origem, tempo_real=None):
+        self.origem = int(origem) if str(origem).isdigit() else origem
+        self.arquivo = isinstance(self.origem, str) and os.path.isfile(self.origem)
+        self.tempo_real = self.arquivo if tempo_real is None else tempo_real
+        self.cap = None
+        self.fps = None
+        self.capturados = 0   # frames entregues pela fonte desde o início da captura
+        self.descartados = 0  # substituídos por um mais novo antes de serem lidos
+        self.erro = None
+        self._cond = threading.Condition()
+        self._atual = None    # (numero, frame, instante da captura) ainda não lido
+        self._fim = False
+        self._parar = threading.Event()
+        self._thread = None
+
+    def abrir(self):
+        # abre a fonte e devolve o primeiro frame (para marcar os pontos)
+        self.cap = cv2.VideoCapture(self.origem)
+        if not self.cap.isOpened(): raise ValueError(f"Não foi possível abrir a fonte {self.origem!r}")
+        if not self.arquivo: self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # câmera: sem fila no driver
+        ok, frame = self.cap.read()
+        if not ok: raise ValueError("A fonte não entregou nenhum frame")
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if fps and fps > 0 else 30.0
+        return frame
+
+    def iniciar_captura(self):
+        self._inicio = time.perf_counter()
+        self._thread = threading.Thread(target=self._capturar, daemon=True)
+        self._thread.start()
+
+    def _capturar(self):
+        numero = 0
+        try:
+            while not self._parar.is_set():
+                numero += 1
+                if self.tempo_real:
+                    # o frame n "chega" em inicio + n/fps
+                    espera = self._inicio + numero / self.fps - time.perf_counter()
+                    if espera > 0 and self._parar.wait(espera): break
+                ok, frame = self.cap.read()
+                if not ok: break
+                agora = time.perf_counter()
+                with self._cond:
+                    if self._atual is not None: self.descartados += 1
+                    self._atual = (numero, frame, agora)
+                    self.capturados += 1
+                    self._cond.notify()
+        except Exception as e:
+            self.erro = e  # repassado em ler()
+        finally:
+            with self._cond:
+                self._fim = True
+                self._cond.notify()
+
+    def ler(self, timeout=5.0):
+        # frame mais recente ainda não lido (espera chegar um); None no fim da fonte
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._atual is not None or self._fim, timeout):
+                raise TimeoutError("A fonte parou de entregar frames")
+            item, self._atual = self._atual, None
+        if item is None and self.erro is not None: raise self.erro
+        return item
+
+    def fechar(self):
+        self._parar.set()
+        if self._thread is not None: self._thread.join()
+        if self.cap is not None: self.cap.release()
+
+
+# Rastreamento ao vivo sobre o AnalisadorBioStep (mesmo fluxo óptico, reancoragem e métricas).
+# Os modos roi e segmentar dependem do vídeo inteiro ou de frames em resolução original e não são usados aqui
+class AnalisadorAoVivo(AnalisadorBioStep):
+    def __init__(self, origem, titulo="Ao vivo", orcamento_ms=ORCAMENTO_MS, janela_s=JANELA_S, tempo_real=None, **opcoes):
+        if opcoes.get('roi') or opcoes.get('segmentar'):
+            raise ValueError("O modo ao vivo não suporta roi nem segmentar")
+        super().__init__(str(origem), titulo, **opcoes)
+        self.fonte = FonteAoVivo(origem, tempo_real)
+        self.orcamento_ms = orcamento_ms
+        self.janela_s = janela_s
+        self._recentes = deque()  # (instante, métricas do frame) dos últimos janela_s segundos
+
+    @property
+    def frame_inicial(self):
+        # primeiro frame da fonte, no tamanho de referência (onde os pontos são marcados)
+        if self._frame_inicial is None: self._iniciar_com_frame(self.fonte.abrir())
+        return self._frame_inicial
+
+    def metricas_recentes(self):
+        # dict coluna -> array com as métricas dos últimos janela_s segundos
+        linhas = [linha for _, linha in self._recentes]
+        return {nome: np.array([linha[nome] for linha in linhas]) for nome in ['Frame'] + colunas_metricas(self.esquema)}
+
+    def executar(self, pontos, ao_atualizar=None, parar=None, duracao_s=None, intervalo_exibicao=INTERVALO_EXIBICAO):
+        # pontos: no frame de referência (como no dashboard); cada um é atraído para o marcador amarelo
+        # ao_atualizar(estado): chamado no máximo a cada intervalo_exibicao segundos (ver _estado)
+        # parar: objeto com is_set() que encerra a sessão; duracao_s: encerra depois desse tempo
+        # Retorna as colunas (mesmo formato de processar_video(como_dataframe=False)) dos frames processados
+        frame_ref = self.frame_inicial
+        self.set_pontos([refinar_ponto_pela_cor(frame_ref, int(round(x)), int(round(y))) for x, y in pontos])
+        self.instr = Instrumentacao() if self.instrumentar else SEM_INSTRUMENTACAO
+        if self.buffers_fixos: self._alocar_buffers(0, 1)
+        preparar = self._preparar_frame_fixo if self.buffers_fixos else self._preparar_frame
+
+        trajetoria, numeros, confiancas, self._latencias = [], [], [], []
+        self.descartados_atraso = 0   # frames que chegaram mais velhos que o orçamento
+        self.acima_orcamento = 0      # frames processados que estouraram o orçamento
+        self._recentes.clear()
+        reposicionar = True  # primeiro frame: pode ter passado tempo desde a marcação, os pontos são achados pela cor
+        ultima_exibicao = 0.0
+
+        self.fonte.iniciar_captura()
+        inicio = time.perf_counter()
+        try:
+            while not (parar is not None and parar.is_set()):
+                if duracao_s is not None and time.perf_counter() - inicio >= duracao_s: break
+                item = self.fonte.ler()
+                if item is None: break
+                numero, frame, capturado = item
+                if (time.perf_counter() - capturado) * 1000 > self.orcamento_ms:
+                    self.descartados_atraso += 1  # velho demais: espera o próximo em vez de processar atrasado
+                    continue
+
+                preparado = preparar(frame)
+                if reposicionar:
+                    pts, conf = self._reiniciar_segmento(preparado)
+                    reposicionar = False
+                else:
+                    pts, conf = self._passo_completo(numero, *preparado)
+                    if pts is None:
+                        reposicionar = True
+                        continue
+                with self.instr.medir('metricas'):
+                    linha = {nome: valores[0] for nome, valores in calcular_metricas_lote(pts[None], [numero], self.esquema).items()}
+                agora = time.perf_counter()
+                latencia = agora - capturado
+                self._latencias.append(latencia)
+                if latencia * 1000 > self.orcamento_ms: self.acima_orcamento += 1
+
+                trajetoria.append(np.array(pts, np.float32))
+                numeros.append(numero)
+                if self.reancorar: confiancas.append(np.ones(len(pts), np.float32) if conf is None else conf)
+                self.instr.contar('frames')
+
+                self._recentes.append((agora, linha))
+                while self._recentes[0][0] < agora - self.janela_s: self._recentes.popleft()
+                if ao_atualizar is not None and agora - ultima_exibicao >= intervalo_exibicao:
+                    ao_atualizar(self._estado(preparado[0], pts, linha, inicio))
+                    ultima_exibicao = time.perf_counter()
+        finally:
+            self._duracao = time.perf_counter() - inicio
+            self.fonte.fechar()
+            self.instr.concluir()
+
+        self.trajetoria = np.array(trajetoria, np.float32).reshape(-1, len(self.p0), 2)
+        self.frames = np.array(numeros, np.int64)
+        confianca = np.array(confiancas, np.float32).reshape(-1, len(self.p0)) if self.reancorar else None
+        return self._colunas(self.trajetoria, confianca, self.frames)
+
+    def _estado(self, frame, pts, linha, inicio):
+        decorrido = time.perf_counter() - inicio
+        return {'frame': frame, 'pontos': pts, 'metricas': linha, 'picos': calcular_picos(self.metricas_recentes()),
+                'fps': len(self._latencias) / decorrido if decorrido > 0 else 0.0,
+                'latencia_ms': self._latencias[-1] * 1000}
+
+    def relatorio(self):
+        # fps alcançado e latência de ponta a ponta da última sessão (executar)
+        lat = np.array(self._latencias) * 1000
+        processados = len(lat)
+        relatorio = {
+            'origem': str(self.fonte.origem), 'duracao_s': round(self._duracao, 3), 'orcamento_ms': self.orcamento_ms,
+            'fps_fonte': round(self.fonte.fps, 2),
+            'fps_captura': round(self.fonte.capturados / self._duracao, 2) if self._duracao > 0 else None,
+            'fps_processado': round(processados / self._duracao, 2) if self._duracao > 0 else None,
+            'frames_capturados': self.fonte.capturados, 'frames_processados': processados,
+            'descartados_fila': self.fonte.descartados, 'descartados_atraso': self.descartados_atraso,
+            'acima_orcamento': self.acima_orcamento,
+        }
+        if processados:
+            p50, p95 = np.percentile(lat, [50, 95])
+            relatorio['latencia_ms'] = {'media': round(float(lat.mean()), 2), 'p50': round(float(p50), 2),
+                                        'p95': round(float(p95), 2), 'max': round(float(lat.max()), 2)}
+        if self.instr.ativa: relatorio['diagnostico'] = self.diagnostico
+        return relatorio
+
+
+# --- Exibição (janela do OpenCV) ---
+
+# segmentos desenhados sobre o frame (pares de pontos): pelve, esterno-quadris e, em cada lado,
+# quadril-joelho-tornozelo (o quadril de apoio automático é o mais próximo do joelho no frame)
+def ligacoes(esquema, pts):
+    indice = {nome: i for i, nome in enumerate(esquema['pontos'])}
+    pelve = [indice[nome] for nome in esquema.get('pelve') or []]
+    pares = [tuple(pelve)] if pelve else []
+    if esquema.get('tronco'): pares += [(indice[esquema['tronco']], q) for q in pelve]
+    for lado in esquema.get('lados', {}).values():
+        joelho, tornozelo = indice[lado['joelho']], indice[lado['tornozelo']]
+        if lado.get('quadril') is not None:
+            quadril = indice[lado['quadril']]
+        else:
+            apoio = escolher_quadril_apoio_lote(pts[pelve[0]], pts[pelve[1]], pts[joelho])
+            quadril = pelve[0] if np.array_equal(apoio, pts[pelve[0]]) else pelve[1]
+        pares += [(quadril, joelho), (joelho, tornozelo)]
+    return pares
+
+# desenha os pontos, as métricas do frame e o desempenho; o texto do OpenCV só aceita ASCII
+def desenhar_estado(estado, esquema=ESQUEMA_PADRAO):
+    tela = estado['frame'].copy()
+    pts = np.round(estado['pontos']).astype(int)
+    for a, b in ligacoes(esquema, np.asarray(estado['pontos'])):
+        cv2.line(tela, tuple(pts[a]), tuple(pts[b]), (255, 200, 0), 2)
+    for x, y in pts:
+        cv2.circle(tela, (int(x), int(y)), 5, (0, 0, 255), -1)
+    m, picos = estado['metricas'], estado['picos']
+    linhas = [f"Joelho{sufixo} {m[f'Angulo Joelho{sufixo}']:.1f} graus (min {picos[f'Angulo Minimo{sufixo}']:.1f})  "
+              f"Valgo {m[f'Desvio Valgo{sufixo} (px)']:.1f} px" for sufixo in esquema.get('lados', {})]
+    if 'Queda Pelvica' in m: linhas.append(f"Pelve {abs(m['Queda Pelvica'] - 180):.1f} graus")
+    linhas.append(f"{estado['fps']:.1f} fps  latencia {estado['latencia_ms']:.0f} ms")
+    for i, texto in enumerate(linhas):
+        cv2.putText(tela, texto, (10, 25 + 22 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (0, 0, 0), 3, cv2.LINE_AA)
+        cv2.putText(tela, texto, (10, 25 + 22 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (255, 255, 255), 1, cv2.LINE_AA)
+    return tela
+
+# marca os pontos com o mouse, na ordem do esquema (cada clique é atraído para o marcador amarelo)
+# Enter confirma, r recomeça, Esc cancela (retorna None)
+def marcar_pontos(frame, esquema=ESQUEMA_PADRAO, janela="BioStep - marcar pontos"):
+    nomes = esquema['pontos']
+    pontos = []
+
+    def clique(evento, x, y, *_):
+        if evento == cv2.EVENT_LBUTTONDOWN and len(pontos) < len(nomes):
+            pontos.append(refinar_ponto_pela_cor(frame, x, y))
+
+    cv2.namedWindow(janela)
+    cv2.setMouseCallback(janela, clique)
+    try:
+        while True:
+            tela = frame.copy()
+            for nome, (x, y) in zip(nomes, pontos):
+                cv2.circle(tela, (x, y), 5, (0, 0, 255), -1)
+                cv2.putText(tela, nome, (x + 8, y), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 1, cv2.LINE_AA)
+            texto = f"Clique: {nomes[len(pontos)]}" if len(pontos) < len(nomes) else "Enter: confirmar  r: recomecar"
+            cv2.putText(tela, texto, (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2, cv2.LINE_AA)
+            cv2.imshow(janela, tela)
+            tecla = cv2.waitKey(30) & 0xFF
+            if tecla == 27: return None
+            if tecla == ord('r'): pontos.clear()
+            if tecla in (10, 13) and len(pontos) == len(nomes): return pontos
+    finally:
+        cv2.destroyWindow(janela)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rastreamento ao vivo do teste Step Down com o BioStep Analyzer.")
+    parser.add_argument('origem', help="índice da câmera (ex.: 0), URL de stream ou arquivo de vídeo (reproduzido na velocidade real)")
+    grupo = parser.add_mutually_exclusive_group(required=True)
+    grupo.add_argument('--pontos', help="arquivo .json com os pontos do esquema no frame de referência")
+    grupo.add_argument('--marcar', action='store_true', help="marca os pontos com o mouse no primeiro frame")
+    parser.add_argument('--esquema', default='padrao', help="esquema de marcadores: padrao, bilateral ou arquivo .json (padrão: %(default)s)")
+    parser.add_argument('--orcamento-ms', type=float, default=ORCAMENTO_MS, help="latência máxima por frame (padrão: %(default)s ms)")
+    parser.add_argument('--duracao', type=float, default=None, help="encerra depois de N segundos")
+    parser.add_argument('--sem-janela', action='store_true', help="não abre a janela de exibição (só o relatório)")
+    parser.add_argument('--reancorar', action='store_true', help="reancora pela cor os pontos perdidos pelo fluxo óptico")
+    parser.add_argument('--preservar-aspecto', action='store_true', help="mantém a proporção da câmera (ex.: 640x480) em vez de 480x850")
+    parser.add_argument('--buffers-fixos', action='store_true', help="frames e pirâmides em buffers pré-alocados")
+    parser.add_argument('--diagnostico', action='store_true', help="inclui o tempo por etapa no relatório")
+    parser.add_argument('--saida', help="salva as métricas da sessão em CSV")
+    parser.add_argument('--relatorio', help="salva o relatório de desempenho em JSON")
+    args = parser.parse_args(argv)
+    from biostep_lote import ler_esquema, ler_pontos
+    try:
+        esquema = ler_esquema(args.esquema)
+    except (OSError, ValueError) as e:
+        parser.error(f"--esquema: {e}")
+
+    analise = AnalisadorAoVivo(args.origem, orcamento_ms=args.orcamento_ms, reancorar=args.reancorar,
+                               preservar_aspecto=args.preservar_aspecto, buffers_fixos=args.buffers_fixos,
+                               instrumentar=args.diagnostico, esquema=esquema)
+    if args.marcar:
+        pontos = marcar_pontos(analise.frame_inicial, esquema)
+        if pontos is None: return 1
+    else:
+        pontos = ler_pontos(args.pontos)
+
+    parar = threading.Event()
+    exibir = None
+    if not args.sem_janela:
+        def exibir(estado):
+            cv2.imshow("BioStep - ao vivo", desenhar_estado(estado, esquema))
+            if cv2.waitKey(1) & 0xFF in (27, ord('q')): parar.set()
+
+    try:
+        colunas = analise.executar(pontos, exibir, parar, args.duracao)
+    except KeyboardInterrupt:
+        colunas = None
+    finally:
+        if not args.sem_janela: cv2.destroyAllWindows()
+
+    relatorio = analise.relatorio()
+    registrar_log(relatorio, video=str(args.origem), titulo=analise.titulo, modo='ao_vivo')
+    print(json.dumps(relatorio, ensure_ascii=False, indent=1))
+    if args.relatorio:
+        with open(args.relatorio, 'w', encoding='utf-8') as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=1)
+    if args.saida and colunas is not None:
+        import pandas as pd
+        pd.DataFrame(colunas).to_csv(args.saida, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+# Histórico de sessões por paciente
+#
+# Cada sessão fica em <pasta>/<paciente>/<id>/ com:
+#   trajetoria.npy  (frames x pontos x 2, float32) - pontos rastreados no frame de referência
+#   inteiros.npy    (colunas x frames, int64)      - Frame e, no modo segmentado, Repeticao
+#   metricas.npy    (colunas x frames, float32)    - métricas e confiança, uma coluna por linha
+#   meta.json                                      - paciente, data, pontos iniciais, parâmetros, picos
+# Os .npy são abertos com memória mapeada (np.load(mmap_mode='r')): só as partes usadas são
+# lidas do disco. O indice.json na raiz lista as sessões por paciente e data e pode ser
+# reconstruído a partir dos meta.json.
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from biostep_engine import ESQUEMAS, VERSAO_MOTOR, calcular_metricas_lote, calcular_picos
+
+PASTA_PADRAO = os.environ.get('BIOSTEP_ARMAZEM', os.path.join(os.path.expanduser('~'), 'biostep_sessoes'))
+ARQUIVO_INDICE = 'indice.json'
+COLUNAS_INTEIRAS = ('Frame', 'Repeticao')
+
+
+# nome de pasta seguro para o paciente (o nome original fica no meta.json)
+def _pasta_paciente(paciente):
+    return re.sub(r'[^\w-]+', '_', paciente.strip(), flags=re.UNICODE).strip('_') or 'sem_nome'
+
+def _salvar_json(caminho, dados):
+    pasta = os.path.dirname(caminho)
+    fd, tmp = tempfile.mkstemp(dir=pasta, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(dados, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, caminho)
+
+
+# uma sessão carregada: os arrays são mapeados do disco (somente leitura)
+class SessaoArmazenada:
+    def __init__(self, pasta, meta, mmap=True):
+        self.pasta = pasta
+        self.meta = meta
+        modo = 'r' if mmap else None
+        self.trajetoria = np.load(os.path.join(pasta, 'trajetoria.npy'), mmap_mode=modo)
+        self._inteiros = np.load(os.path.join(pasta, 'inteiros.npy'), mmap_mode=modo)
+        self._metricas = np.load(os.path.join(pasta, 'metricas.npy'), mmap_mode=modo)
+
+    @property
+    def frames(self):
+        return self._inteiros[0]
+
+    def colunas(self):
+        # dict nome -> array, na ordem original das colunas (cada coluna é contígua no arquivo)
+        colunas = dict(zip(self.meta['colunas_inteiras'], self._inteiros))
+        colunas.update(zip(self.meta['colunas_metricas'], self._metricas))
+        return {nome: colunas[nome] for nome in self.meta['colunas']}
+
+    def dataframe(self):
+        return pd.DataFrame(self.colunas())
+
+    def recalcular_metricas(self):
+        # métricas a partir da trajetória guardada (versão atual das funções), sem abrir o vídeo;
+        # o esquema de marcadores fica nos parâmetros quando não é o padrão; um esquema do motor
+        # (ex.: bilateral) é usado na definição atual, pelo nome
+        esquema = (self.meta.get('parametros') or {}).get('esquema')
+        if isinstance(esquema, dict) and esquema.get('nome') in ESQUEMAS: esquema = esquema['nome']
+        colunas = calcular_metricas_lote(self.trajetoria, self.frames, esquema)
+        for nome, valores in self.colunas().items():
+            if nome not in colunas: colunas[nome] = valores  # confiança, repetição
+        return pd.DataFrame(colunas)
+
+
+class ArmazemSessoes:
+    def __init__(self, pasta=PASTA_PADRAO):
+        self.pasta = pasta
+        self._trava = threading.Lock()
+        os.makedirs(self.pasta, exist_ok=True)
+
+    # --- índice ---
+
+    def _caminho_indice(self):
+        return os.path.join(self.pasta, ARQUIVO_INDICE)
+
+    def _ler_indice(self):
+        try:
+            with open(self._caminho_indice(), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return self.reconstruir_indice()
+
+    def reconstruir_indice(self):
+        # varre os meta.json (ex.: índice apagado ou corrompido)
+        indice = {}
+        for paciente in os.listdir(self.pasta):
+            pasta_paciente = os.path.join(self.pasta, paciente)
+            if not os.path.isdir(pasta_paciente): continue
+            for id_sessao in os.listdir(pasta_paciente):
+                try:
+                    with open(os.path.join(pasta_paciente, id_sessao, 'meta.json'), encoding='utf-8') as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    continue  # sessão incompleta
+                indice[meta['id']] = self._entrada_indice(meta)
+        _salvar_json(self._caminho_indice(), indice)
+        return indice
+
+    @staticmethod
+    def _entrada_indice(meta):
+        return {k: meta[k] for k in ('id', 'paciente', 'pasta', 'data', 'titulo', 'frames', 'picos')}
+
+    # --- sessões ---
+
+    def salvar(self, paciente, df, trajetoria, pontos, data=None, titulo="", parametros=None):
+        # df: resultado do AnalisadorBioStep; trajetoria: analise.trajetoria (linhas alinhadas com df)
+        data = data or datetime.now()
+        if len(trajetoria) != len(df):
+            raise ValueError("a trajetória e o DataFrame têm números de frames diferentes")
+
+        id_sessao = f"{data:%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+        rel = os.path.join(_pasta_paciente(paciente), id_sessao)
+        colunas = list(df.columns)
+        inteiras = [c for c in colunas if c in COLUNAS_INTEIRAS]
+        metricas = [c for c in colunas if c not in COLUNAS_INTEIRAS]
+        meta = {
+            'id': id_sessao, 'paciente': paciente, 'pasta': rel, 'data': data.isoformat(timespec='seconds'),
+            'titulo': titulo, 'frames': len(df), 'versao_motor': VERSAO_MOTOR,
+            'pontos': [[float(x), float(y)] for x, y in pontos], 'parametros': parametros,
+            'colunas': colunas, 'colunas_inteiras': inteiras, 'colunas_metricas': metricas,
+            'picos': calcular_picos(df) if len(df) else {},
+        }
+
+        # grava em uma pasta temporária e renomeia: uma sessão nunca aparece pela metade
+        destino = os.path.join(self.pasta, rel)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(destino), prefix='.tmp_')
+        try:
+            np.save(os.path.join(tmp, 'trajetoria.npy'), np.ascontiguousarray(trajetoria, dtype=np.float32))
+            np.save(os.path.join(tmp, 'inteiros.npy'), df[inteiras].to_numpy(np.int64).T.copy())
+            np.save(os.path.join(tmp, 'metricas.npy'), df[metricas].to_numpy(np.float32).T.copy())
+            _salvar_json(os.path.join(tmp, 'meta.json'), meta)
+            os.replace(tmp, destino)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        with self._trava:
+            indice = self._ler_indice()
+            indice[id_sessao] = self._entrada_indice(meta)
+            _salvar_json(self._caminho_indice(), indice)
+        return id_sessao
+
+    def listar(self, paciente=None):
+        # sessões (entradas do índice) em ordem de data; só de um paciente, se informado
+        sessoes = self._ler_indice().values()
+        if paciente is not None: sessoes = [s for s in sessoes if s['paciente'] == paciente]
+        return sorted(sessoes, key=lambda s: s['data'])
+
+    def pacientes(self):
+        return sorted({s['paciente'] for s in self._ler_indice().values()})
+
+    def carregar(self, id_sessao, mmap=True):
+        entrada = self._ler_indice()[id_sessao]
+        pasta = os.path.join(self.pasta, entrada['pasta'])
+        with open(os.path.join(pasta, 'meta.json'), encoding='utf-8') as f:
+            return SessaoArmazenada(pasta, json.load(f), mmap)
+
+    def remover(self, id_sessao):
+        with self._trava:
+            indice = self._ler_indice()
+            entrada = indice.pop(id_sessao, None)
+            _salvar_json(self._caminho_indice(), indice)
+        if entrada: shutil.rmtree(os.path.join(self.pasta, entrada['pasta']), ignore_errors=True)
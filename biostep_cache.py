@@ -0,0 +1,104 @@
+# Cache em disco dos resultados do rastreamento
+#
+# A chave é o hash do conteúdo do vídeo + pontos iniciais + parâmetros do rastreamento
+# (Lucas-Kanade, resolução e versão do motor). Reabrir o mesmo vídeo com os mesmos pontos
+# devolve o resultado guardado (DataFrame ou qualquer objeto serializável) sem rastrear de
+# novo. Os arquivos mais antigos (pelo último acesso) são removidos quando o cache passa do
+# limite de tamanho.
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+PASTA_PADRAO = os.environ.get('BIOSTEP_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'biostep'))
+LIMITE_PADRAO = 512 * 1024 * 1024  # 512 MB
+EXTENSAO = '.pkl'
+
+
+# hash sha256 de bytes em memória (ex.: upload do Streamlit)
+def hash_bytes(dados):
+    return hashlib.sha256(dados).hexdigest()
+
+
+# hash sha256 de um arquivo, lido em blocos para não carregar o vídeo inteiro na memória
+def hash_arquivo(caminho, tamanho_bloco=1 << 20):
+    h = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(tamanho_bloco), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+class CacheResultados:
+    def __init__(self, pasta=PASTA_PADRAO, limite_bytes=LIMITE_PADRAO):
+        self.pasta = pasta
+        self.limite_bytes = limite_bytes
+        os.makedirs(self.pasta, exist_ok=True)
+
+    def chave(self, hash_video, pontos, parametros):
+        # parametros: AnalisadorBioStep.parametros_rastreamento()
+        conteudo = {
+            'video': hash_video,
+            'pontos': [[round(float(x), 3), round(float(y), 3)] for x, y in pontos],
+            'parametros': parametros,
+        }
+        return hash_bytes(json.dumps(conteudo, sort_keys=True).encode('utf-8'))
+
+    def _caminho(self, chave):
+        return os.path.join(self.pasta, chave + EXTENSAO)
+
+    def obter(self, chave):
+        caminho = self._caminho(chave)
+        try:
+            with open(caminho, 'rb') as f:
+                valor = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None  # ausente, corrompido ou gravado por outra versão das bibliotecas
+        os.utime(caminho)  # marca o acesso para a política LRU
+        return valor
+
+    def guardar(self, chave, valor):
+        # grava em arquivo temporário e renomeia, para nunca expor um resultado incompleto
+        fd, tmp = tempfile.mkstemp(dir=self.pasta, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(valor, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._caminho(chave))
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+        self._podar()
+
+    def invalidar(self, chave=None):
+        # remove um resultado, ou todo o cache se nenhuma chave for passada
+        caminhos = [self._caminho(chave)] if chave else self._arquivos()
+        for caminho in caminhos:
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
+    def _arquivos(self):
+        return [os.path.join(self.pasta, n) for n in os.listdir(self.pasta) if n.endswith(EXTENSAO)]
+
+    def tamanho_total(self):
+        return sum(os.path.getsize(c) for c in self._arquivos())
+
+    def _podar(self):
+        # remove os menos usados recentemente até caber no limite
+        entradas = []
+        for caminho in self._arquivos():
+            try:
+                info = os.stat(caminho)
+            except FileNotFoundError:
+                continue
+            entradas.append((info.st_mtime, info.st_size, caminho))
+        total = sum(e[1] for e in entradas)
+        for _, tamanho, caminho in sorted(entradas):
+            if total <= self.limite_bytes: break
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+            total -= tamanho
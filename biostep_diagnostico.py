@@ -0,0 +1,108 @@
+# Instrumentação do rastreamento: tempo por etapa e contadores
+#
+# Desligada (SEM_INSTRUMENTACAO), cada medição é só um "with" sobre um contexto vazio.
+# Ligada, guarda a duração de cada chamada por etapa (decodificacao, resize, cinza,
+# fluxo_optico, reancoragem, metricas, dataframe...) e resume em p50/p95 e frames/s.
+import json
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+# log estruturado (uma linha JSON por análise); a aplicação escolhe o destino (handler)
+logger = logging.getLogger('biostep')
+
+
+class Instrumentacao:
+    ativa = True
+
+    def __init__(self):
+        self.tempos = {}      # etapa -> lista de durações (s)
+        self.contadores = {}  # nome -> total
+        self.erros_lk = []    # arrays de erro do Lucas-Kanade dos pontos rastreados
+        self.inicio = time.perf_counter()
+        self.fim = None
+
+    @contextmanager
+    def medir(self, etapa):
+        # pode ser chamada das threads de leitura: list.append é atômico
+        lista = self.tempos.get(etapa)
+        if lista is None: lista = self.tempos.setdefault(etapa, [])
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            lista.append(time.perf_counter() - t0)
+
+    def contar(self, nome, n=1):
+        self.contadores[nome] = self.contadores.get(nome, 0) + int(n)
+
+    def registrar_lk(self, st, err):
+        # status/erro do calcOpticalFlowPyrLK de um frame
+        ok = st.ravel() == 1
+        self.contar('pontos_falha_lk', (~ok).sum())
+        self.erros_lk.append(err.ravel()[ok].astype(np.float32))
+
+    def incorporar(self, outra):
+        # soma as medições de outra instrumentação (ex.: a de cada bloco rastreado em paralelo)
+        for etapa, lista in outra.tempos.items():
+            self.tempos.setdefault(etapa, []).extend(lista)
+        for nome, n in outra.contadores.items():
+            self.contar(nome, n)
+        self.erros_lk.extend(outra.erros_lk)
+
+    def concluir(self):
+        self.fim = time.perf_counter()
+
+    def resumo(self):
+        duracao = (self.fim or time.perf_counter()) - self.inicio
+        frames = self.contadores.get('frames', 0)
+        etapas = {}
+        for etapa, lista in self.tempos.items():
+            if not lista: continue
+            ms = np.array(lista) * 1000
+            p50, p95 = np.percentile(ms, [50, 95])
+            etapas[etapa] = {'chamadas': len(ms), 'total_ms': round(float(ms.sum()), 3), 'media_ms': round(float(ms.mean()), 4),
+                             'p50_ms': round(float(p50), 4), 'p95_ms': round(float(p95), 4)}
+        resumo = {'frames': frames, 'duracao_s': round(duracao, 4),
+                  'fps': round(frames / duracao, 2) if duracao > 0 else None,
+                  'contadores': dict(self.contadores), 'etapas': etapas}
+        erros = np.concatenate(self.erros_lk) if self.erros_lk else np.empty(0)
+        if erros.size:
+            resumo['erro_lk'] = {'media': round(float(erros.mean()), 4), 'p95': round(float(np.percentile(erros, 95)), 4),
+                                 'max': round(float(erros.max()), 4)}
+        return resumo
+
+
+# versão desligada: mesma interface, sem custo além da chamada
+class _SemInstrumentacao:
+    ativa = False
+    _vazio = nullcontext()
+
+    def medir(self, etapa):
+        return self._vazio
+
+    def contar(self, nome, n=1):
+        pass
+
+    def registrar_lk(self, st, err):
+        pass
+
+    def incorporar(self, outra):
+        pass
+
+    def concluir(self):
+        pass
+
+    def resumo(self):
+        return None
+
+
+SEM_INSTRUMENTACAO = _SemInstrumentacao()
+
+
+# grava o resumo no log 'biostep' como uma linha JSON
+def registrar_log(resumo, **contexto):
+    if resumo is not None and logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({'evento': 'diagnostico', **contexto, **resumo}, ensure_ascii=False))
@@ -1,65 +1,249 @@
+import copy
 import cv2
+import itertools
 import numpy as np
-import math
-import pandas as pd
+import queue
+import threading
+import os
+from concurrent.futures import ThreadPoolExecutor
+from biostep_diagnostico import Instrumentacao, SEM_INSTRUMENTACAO, logger, registrar_log
+
+# Versão do motor de rastreamento/métricas: mudar sempre que os resultados mudarem
+# (invalida resultados guardados em cache)
+VERSAO_MOTOR = "2.1"
+
+# pandas é opcional: só é importado quando um DataFrame é pedido (processar_video,
+# reduzir_df com grupo, combinar_sessoes); sem ele o motor trabalha com dicts de arrays
+
+# Esquemas de marcadores: os pontos marcados (nome, na ordem dos cliques) e quais pontos cada métrica usa.
+#   rotulos: texto exibido ao marcar cada ponto (opcional; padrão: o nome)
+#   lados:   sufixo das colunas do lado -> pontos quadril, joelho e tornozelo. Quadril None: o quadril de
+#            apoio, o mais próximo do joelho a cada frame. Cada lado gera 'Angulo Joelho<sufixo>' e
+#            'Desvio Valgo<sufixo> (px)'. sinal (opcional, padrão 1): multiplica o desvio do lado para que
+#            positivo seja valgo nas duas pernas. Na vista frontal as pernas são espelhadas: o joelho
+#            indo para medial dá desvio negativo na perna do lado esquerdo da imagem (a direita do
+#            paciente), que usa sinal -1
+#   pelve:   os dois quadris (Queda Pelvica); tronco: o esterno (Inclinacao Tronco). None omite a métrica
+# Pontos que nenhuma métrica usa (marcadores extras) são rastreados e guardados na trajetória.
+ESQUEMA_PADRAO = {
+    'nome': 'padrao',
+    'pontos': ['Esterno', 'Quadril Dir', 'Quadril Esq', 'Joelho', 'Tornozelo'],
+    'rotulos': ['Esterno', 'Quadril Dir', 'Quadril Esq', 'Joelho (Apoio)', 'Tornozelo (Apoio)'],
+    'lados': {'': {'quadril': None, 'joelho': 'Joelho', 'tornozelo': 'Tornozelo'}},
+    'pelve': ['Quadril Dir', 'Quadril Esq'],
+    'tronco': 'Esterno',
+}
+
+# as duas pernas em uma única passada (um fluxo óptico para os 7 pontos)
+ESQUEMA_BILATERAL = {
+    'nome': 'bilateral',
+    'pontos': ['Esterno', 'Quadril Dir', 'Quadril Esq', 'Joelho Dir', 'Tornozelo Dir', 'Joelho Esq', 'Tornozelo Esq'],
+    'lados': {' Dir': {'quadril': 'Quadril Dir', 'joelho': 'Joelho Dir', 'tornozelo': 'Tornozelo Dir', 'sinal': -1},
+              ' Esq': {'quadril': 'Quadril Esq', 'joelho': 'Joelho Esq', 'tornozelo': 'Tornozelo Esq'}},
+    'pelve': ['Quadril Dir', 'Quadril Esq'],
+    'tronco': 'Esterno',
+}
+
+ESQUEMAS = {esquema['nome']: esquema for esquema in (ESQUEMA_PADRAO, ESQUEMA_BILATERAL)}
+
+# esquema pelo nome (ESQUEMAS) ou um dict no formato acima, conferido
+def obter_esquema(esquema=None):
+    if esquema is None: return ESQUEMA_PADRAO
+    if isinstance(esquema, str):
+        if esquema not in ESQUEMAS: raise ValueError(f"Esquema de marcadores desconhecido: {esquema!r} (disponíveis: {', '.join(ESQUEMAS)})")
+        return ESQUEMAS[esquema]
+    pontos = esquema.get('pontos') or []
+    if not pontos: raise ValueError("O esquema não tem pontos")
+    if len(set(pontos)) != len(pontos): raise ValueError("O esquema tem pontos com o mesmo nome")
+    usados = [esquema.get('tronco')] + list(esquema.get('pelve') or [])
+    for lado in esquema.get('lados', {}).values():
+        usados += [lado.get('quadril'), lado['joelho'], lado['tornozelo']]
+        if lado.get('sinal', 1) not in (1, -1): raise ValueError("O sinal de um lado deve ser 1 ou -1")
+        if lado.get('quadril') is None and not esquema.get('pelve'):
+            raise ValueError("Quadril de apoio automático precisa dos dois quadris em 'pelve'")
+    if esquema.get('tronco') and not esquema.get('pelve'): raise ValueError("A inclinação do tronco precisa dos dois quadris em 'pelve'")
+    faltando = [nome for nome in usados if nome is not None and nome not in pontos]
+    if faltando: raise ValueError(f"Pontos usados nas métricas e ausentes do esquema: {', '.join(faltando)}")
+    return esquema
+
+# nomes das colunas de métricas de um esquema, na ordem em que aparecem no DataFrame
+def colunas_metricas(esquema=None):
+    esquema = obter_esquema(esquema)
+    colunas = []
+    for sufixo in esquema.get('lados', {}):
+        colunas += [f'Angulo Joelho{sufixo}', f'Desvio Valgo{sufixo} (px)']
+    if esquema.get('pelve'): colunas.append('Queda Pelvica')
+    if esquema.get('tronco'): colunas.append('Inclinacao Tronco')
+    return colunas
+
+# Nomes das colunas de métricas e dos pontos marcados do esquema padrão
+COLUNAS_METRICAS = colunas_metricas(ESQUEMA_PADRAO)
+NOMES_PONTOS = ESQUEMA_PADRAO['pontos']
+
+# sufixos dos lados presentes em um resultado ('' no esquema padrão, ' Dir' e ' Esq' no bilateral)
+# df: DataFrame ou dict de colunas
+def lados_resultado(df):
+    return [nome[len('Angulo Joelho'):] for nome in df if nome.startswith('Angulo Joelho')]
+
+# Reancoragem: erro do Lucas-Kanade acima do qual o ponto é considerado perdido,
+# e confiança atribuída a um ponto recuperado pela cor do marcador
+LIMITE_ERRO_LK = 15.0
+CONFIANCA_COR = 0.5
+
+# Modo ROI: distância mínima desejada entre marcadores na imagem rastreada (px)
+# e grade (px do vídeo original) em que a caixa de recorte é alinhada
+ESPACAMENTO_ROI = 40
+GRADE_ROI = 32
+
+# Blocos paralelos: frames rastreados pelos dois blocos vizinhos (para costurar as trajetórias),
+# tamanho mínimo de um bloco e desvio (px) na sobreposição acima do qual o bloco é refeito em sequência
+SOBREPOSICAO_BLOCOS = 15
+BLOCO_MIN = 60
+LIMITE_DESVIO_BLOCO = 8.0
+
+# --- Versões vetorizadas: operam sobre arrays (..., 2), um ponto por linha ---
 
 # Calcula o angulo interno entre tres pontos - lei dos cossenos
-def calcular_angulo(a, b, c):
-    a = np.array(a)    # ponto A -  quadril
-    b = np.array(b)    # ponto B -  joelho
-    c = np.array(c)    # ponto C -  tornozelo
+def calcular_angulo_lote(a, b, c):
+    a = np.asarray(a, dtype=np.float64)    # ponto(s) A -  quadril
+    b = np.asarray(b, dtype=np.float64)    # ponto(s) B -  joelho
+    c = np.asarray(c, dtype=np.float64)    # ponto(s) C -  tornozelo
 
     # vetores
     ba = a - b  # vetor do joelho para o quadril
     bc = c - b  # vetor do joelho para o tornozelo
 
-    # normas dos vetores
-    norma_ba = np.linalg.norm(ba)
-    norma_bc = np.linalg.norm(bc)
+    # produto das normas dos vetores
+    normas = np.hypot(ba[..., 0], ba[..., 1]) * np.hypot(bc[..., 0], bc[..., 1])
+    valido = normas != 0  # evita divisao por zero
 
-    if norma_ba == 0 or norma_bc == 0: return 0  # evita divisao por zero
+    #  produto escalar
+    produto = ba[..., 0] * bc[..., 0] + ba[..., 1] * bc[..., 1]
+    cosine_angle = np.divide(produto, normas, out=np.zeros_like(produto), where=valido)
 
-    #  produto escalar 
-    cosine_angle = np.dot(ba, bc) / (norma_ba * norma_bc)
-
-    return np.degrees(np.arccos(np.clip(cosine_angle, -1.0, 1.0)))   #  converte para graus
+    angulo = np.degrees(np.arccos(np.clip(cosine_angle, -1.0, 1.0)))   #  converte para graus
+    return np.where(valido, angulo, 0.0)
 
 # calcula o desvio linear (distancia ponto-reta) para valgo/varo
-def calcular_desvio_linear(quadril, joelho, tornozelo):
-    p1, p2, p3 = np.array(quadril), np.array(tornozelo), np.array(joelho)
+def calcular_desvio_linear_lote(quadril, joelho, tornozelo):
+    p1 = np.asarray(quadril, dtype=np.float64)
+    p2 = np.asarray(tornozelo, dtype=np.float64)
+    p3 = np.asarray(joelho, dtype=np.float64)
 
     # vetores
     vec_linha = p2 - p1  # vetor da linha quadril-tornozelo
     vec_ponto = p3 - p1  # vetor do quadril ao joelho
-  
+
     # produto vetorial (cross product) em 2D retorna um escalar
-    cross_prod = vec_linha[0]*vec_ponto[1] - vec_linha[1]*vec_ponto[0]
+    cross_prod = vec_linha[..., 0] * vec_ponto[..., 1] - vec_linha[..., 1] * vec_ponto[..., 0]
 
     #  norma do vetor linha
-    norma = np.linalg.norm(vec_linha)
+    norma = np.hypot(vec_linha[..., 0], vec_linha[..., 1])
 
     #  retorna a distancia - se positiva, valgo; se negativa, varo
-    return cross_prod / norma if norma != 0 else 0
+    return np.divide(cross_prod, norma, out=np.zeros_like(cross_prod), where=norma != 0)
 
 # calcula inclinacao entre dois pontos  -  queda pelvica
-def calcular_inclinacao(p1, p2):
+def calcular_inclinacao_lote(p1, p2):
+    p1 = np.asarray(p1, dtype=np.float64)
+    p2 = np.asarray(p2, dtype=np.float64)
 
-    #  calcula   o arcotangente da diferenca y/x, retornado em  angulo polar  
-    return math.degrees(math.atan2(p2[1] - p1[1], p2[0] - p1[0]))
+    #  calcula   o arcotangente da diferenca y/x, retornado em  angulo polar
+    return np.degrees(np.arctan2(p2[..., 1] - p1[..., 1], p2[..., 0] - p1[..., 0]))
 
 # calcula inclinacao do tronco    -   compara esterno com meio dos quadris
-def calcular_tronco(esterno, q_dir, q_esq):
+def calcular_tronco_lote(esterno, q_dir, q_esq):
+    esterno = np.asarray(esterno, dtype=np.float64)
 
     #  ponto medio entre os quadris
-    mid_x = (q_dir[0] + q_esq[0]) / 2   
-    mid_y = (q_dir[1] + q_esq[1]) / 2
+    meio = (np.asarray(q_dir, dtype=np.float64) + np.asarray(q_esq, dtype=np.float64)) / 2
 
     #   calcula  a  diferença (delta) entre esterno e ponto médio
-    dx = esterno[0] - mid_x
-    dy = mid_y - esterno[1]
+    dx = esterno[..., 0] - meio[..., 0]
+    dy = meio[..., 1] - esterno[..., 1]
 
     #  retorna o angulo de inclinacao do tronco
-    return math.degrees(math.atan2(dx, dy)) if dy != 0 else 0
+    return np.where(dy != 0, np.degrees(np.arctan2(dx, dy)), 0.0)
+
+# define quadril de apoio (o mais próximo do joelho  analisado), frame a frame
+def escolher_quadril_apoio_lote(q_dir, q_esq, joelho):
+    q_dir = np.asarray(q_dir)
+    q_esq = np.asarray(q_esq)
+    joelho = np.asarray(joelho)
+
+    d_dir = q_dir - joelho
+    d_esq = q_esq - joelho
+    dist_d = np.hypot(d_dir[..., 0], d_dir[..., 1])
+    dist_e = np.hypot(d_esq[..., 0], d_esq[..., 1])
+    return np.where((dist_d < dist_e)[..., np.newaxis], q_dir, q_esq)
+
+# calcula todas as métricas de uma trajetória (frames x pontos x 2) em uma única passada;
+# os lados do esquema são empilhados em um eixo (frames x lados) e calculados juntos
+def calcular_metricas_lote(trajetoria, frames=None, esquema=None):
+    trajetoria = np.asarray(trajetoria)
+    esquema = obter_esquema(esquema)
+    if frames is None:
+        frames = np.arange(1, len(trajetoria) + 1)
+
+    indice = {nome: i for i, nome in enumerate(esquema['pontos'])}
+    ponto = lambda nome: trajetoria[:, indice[nome]]
+    pelve = [ponto(nome) for nome in esquema['pelve']] if esquema.get('pelve') else None
+
+    # colunas já tipadas, prontas para o DataFrame
+    colunas = {'Frame': np.asarray(frames, dtype=np.int64)}
+    lados = esquema.get('lados', {})
+    if lados:
+        joelho = trajetoria[:, [indice[lado['joelho']] for lado in lados.values()]]
+        tornozelo = trajetoria[:, [indice[lado['tornozelo']] for lado in lados.values()]]
+        quadril = np.stack([escolher_quadril_apoio_lote(*pelve, joelho[:, i]) if lado.get('quadril') is None
+                            else ponto(lado['quadril']) for i, lado in enumerate(lados.values())], axis=1)
+        angulos = calcular_angulo_lote(quadril, joelho, tornozelo)
+        desvios = calcular_desvio_linear_lote(quadril, joelho, tornozelo)
+        sinais = [lado.get('sinal', 1) for lado in lados.values()]
+        if any(sinal != 1 for sinal in sinais): desvios = desvios * np.array(sinais)  # positivo = valgo em cada lado
+        for i, sufixo in enumerate(lados):
+            colunas[f'Angulo Joelho{sufixo}'] = angulos[:, i]
+            colunas[f'Desvio Valgo{sufixo} (px)'] = desvios[:, i]
+    if pelve is not None:
+        colunas['Queda Pelvica'] = calcular_inclinacao_lote(*pelve)
+    if esquema.get('tronco'):
+        colunas['Inclinacao Tronco'] = calcular_tronco_lote(ponto(esquema['tronco']), *pelve)
+    return colunas
+
+# mínimo/máximo ignorando NaN (NaN se não houver valores)
+def _extremo(valores, funcao):
+    valores = np.asarray(valores, dtype=np.float64)
+    valores = valores[~np.isnan(valores)]
+    return float(funcao(valores)) if valores.size else float('nan')
+
+# resumo dos picos exibidos no dashboard e no relatório, por lado (ex.: 'Angulo Minimo Dir')
+# df: DataFrame ou dict de colunas (ex.: processar_video(como_dataframe=False))
+def calcular_picos(df):
+    picos = {}
+    for sufixo in lados_resultado(df):
+        picos[f'Angulo Minimo{sufixo}'] = _extremo(df[f'Angulo Joelho{sufixo}'], np.min)        # pico de valgo
+        picos[f'Desvio Maximo{sufixo}'] = _extremo(df[f'Desvio Valgo{sufixo} (px)'], np.max)    # desvio medial máximo
+    if 'Queda Pelvica' in df:
+        picos['Queda Pelvica'] = abs(_extremo(df['Queda Pelvica'], np.max) - 180)
+    return picos
+
+# --- Versões escalares: mantidas para compatibilidade, delegam às vetorizadas ---
+
+def calcular_angulo(a, b, c):
+    return float(calcular_angulo_lote(a, b, c))
+
+def calcular_desvio_linear(quadril, joelho, tornozelo):
+    return float(calcular_desvio_linear_lote(quadril, joelho, tornozelo))
+
+def calcular_inclinacao(p1, p2):
+    return float(calcular_inclinacao_lote(p1, p2))
+
+def calcular_tronco(esterno, q_dir, q_esq):
+    return float(calcular_tronco_lote(esterno, q_dir, q_esq))
+
+# definição  da   cor  dos marcadores  amarelos  em HSV
+COR_MARCADOR_MIN = np.array([15, 70, 70])
+COR_MARCADOR_MAX = np.array([35, 255, 255])
 
 # Funçao para refinar o ponto clicado baseado na cor do marcador  ("imã")
 def refinar_ponto_pela_cor(frame, x, y, janela=20):
@@ -77,12 +261,8 @@ def refinar_ponto_pela_cor(frame, x, y, janela=20):
     # converte  BGR (OpenCV) para HSV
     hsv_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
     
-    # definição  da   cor  dos marcadores  amarelos  em HSV
-    lower = np.array([15, 70, 70]) 
-    upper = np.array([35, 255, 255])
-
     # cria uma máscara para a cor amarela  - o que é amarelo fica branco (255)  e o resto preto (0)
-    mask = cv2.inRange(hsv_roi, lower, upper)
+    mask = cv2.inRange(hsv_roi, COR_MARCADOR_MIN, COR_MARCADOR_MAX)
     
     # calcula os momentos da máscara para encontrar o centro de massa
     M = cv2.moments(mask)
@@ -101,83 +281,887 @@ def refinar_ponto_pela_cor(frame, x, y, janela=20):
     # se não achou amarelo (ex: clicou no esterno sem marcador), mantém o original
     return x, y
 
+# Todos os marcadores amarelos do frame: componentes conexos da máscara HSV com pelo menos area_min pixels,
+# no máximo os `maximo` maiores (None: todos). Retorna (centros subpixel, áreas), do maior para o menor
+def detectar_marcadores(frame, area_min=4, maximo=32):
+    mask = cv2.inRange(cv2.cvtColor(frame, cv2.COLOR_BGR2HSV), COR_MARCADOR_MIN, COR_MARCADOR_MAX)
+    _, _, stats, centros = cv2.connectedComponentsWithStats(mask)
+    areas, centros = stats[1:, cv2.CC_STAT_AREA], centros[1:]  # o rótulo 0 é o fundo
+    ordem = np.argsort(-areas)[:maximo]
+    ordem = ordem[areas[ordem] >= area_min]
+    return centros[ordem].astype(np.float32), areas[ordem]
+
+# Mesma busca pela cor, para vários pontos de uma vez e com precisão subpixel: cada ponto vai para o centro
+# do marcador (mancha amarela com pelo menos area_min px, ver detectar_marcadores) mais próximo, se estiver a
+# menos de `janela` px. As manchas são detectadas uma única vez, na região que cobre todas as janelas com uma
+# margem (um marcador na borda da janela não é cortado); o centro de todo o amarelo da janela seria puxado
+# pelas manchas do fundo. sobre_marcador=True: só encaixa o ponto que já está sobre o marcador (a menos de um
+# raio do centro), para corrigir o rastreamento sem saltar para outra mancha.
+# Retorna (pontos, encontrado): quem não tem marcador por perto mantém a posição original.
+def localizar_marcadores(frame, pontos, janela=20, area_min=4, sobre_marcador=False):
+    pontos = np.asarray(pontos, dtype=np.float32).reshape(-1, 2)
+    novos = pontos.copy()
+    encontrado = np.zeros(len(pontos), dtype=bool)
+    if len(pontos) == 0: return novos, encontrado
+
+    h, w = frame.shape[:2]
+    rx, ry = np.clip(np.floor(pontos.min(axis=0) - 2 * janela).astype(int), 0, (w, h))
+    rx2, ry2 = np.clip(np.ceil(pontos.max(axis=0) + 2 * janela).astype(int), 0, (w, h))
+    if rx2 <= rx or ry2 <= ry: return novos, encontrado  # tudo fora da imagem
+    centros, areas = detectar_marcadores(frame[ry:ry2, rx:rx2], area_min, maximo=None)
+    if len(centros) == 0: return novos, encontrado
+    centros += (rx, ry)
+
+    dist = np.linalg.norm(pontos[:, None] - centros[None], axis=-1)
+    mais_perto = dist.argmin(axis=1)
+    dist = dist[np.arange(len(pontos)), mais_perto]
+    encontrado = dist < janela
+    if sobre_marcador: encontrado &= dist < np.sqrt(areas[mais_perto] / np.pi)
+    novos[encontrado] = centros[mais_perto[encontrado]]
+    return novos, encontrado
+
+# Associa os marcadores detectados a um arranjo conhecido de pontos (ex.: os marcados no primeiro frame).
+# O arranjo é deslocado pela translação que deixa mais pontos perto de algum marcador (candidatas: cada
+# par ponto-marcador) e cada ponto fica com o marcador livre mais próximo, se estiver a menos de `janela` px.
+# Retorna (pontos, encontrado), como localizar_marcadores; quem não tem marcador fica na posição deslocada.
+def associar_marcadores(marcadores, arranjo, janela=25):
+    arranjo = np.asarray(arranjo, dtype=np.float32).reshape(-1, 2)
+    encontrado = np.zeros(len(arranjo), dtype=bool)
+    if len(marcadores) == 0 or len(arranjo) == 0: return arranjo.copy(), encontrado
+
+    deslocados = arranjo[None] + (marcadores[:, None] - arranjo[None]).reshape(-1, 1, 2)  # (candidatas, pontos, 2)
+    dist = np.linalg.norm(deslocados[:, :, None] - marcadores[None, None], axis=-1)      # (candidatas, pontos, marcadores)
+    melhor = int(np.minimum(dist.min(axis=2), janela).sum(axis=1).argmin())
+    pts, dist = deslocados[melhor].copy(), dist[melhor]
+
+    # pares ponto-marcador do mais próximo ao mais distante, cada marcador usado uma vez
+    usados = np.zeros(len(marcadores), dtype=bool)
+    for i, j in zip(*np.unravel_index(np.argsort(dist, axis=None), dist.shape)):
+        if dist[i, j] >= janela: break
+        if encontrado[i] or usados[j]: continue
+        pts[i], encontrado[i], usados[j] = marcadores[j], True, True
+    return pts, encontrado
+
+
+# --- Segmentação das repetições ---
+
+# Energia de movimento em baixa resolução: diferença média entre frames amostrados
+# a cada `passo` frames (os intermediários são pulados com grab(), sem retrieve/resize).
+# Retorna (índices dos frames, energia, fps).
+def medir_movimento(video_path, passo=2, largura=64):
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    indices, energia = [], []
+    anterior = None
+    numero = 0
+    while True:
+        if numero % passo:
+            if not cap.grab(): break
+            numero += 1
+            continue
+        ret, frame = cap.read()
+        if not ret: break
+        h, w = frame.shape[:2]
+        pequeno = cv2.cvtColor(cv2.resize(frame, (largura, max(1, round(largura * h / w))), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        if anterior is not None:
+            indices.append(numero)
+            energia.append(cv2.absdiff(pequeno, anterior).mean())
+        anterior = pequeno
+        numero += 1
+    cap.release()
+    return np.array(indices, dtype=np.int64), np.array(energia, dtype=np.float64), fps
+
+# Janelas de movimento (inicio, fim) em índices de frame, fim exclusivo.
+# Cada janela é uma repetição: descida e subida ficam juntas porque pausas curtas
+# (o instante parado no fundo do movimento) não quebram a janela.
+# movimento_min: variação mínima da energia (nível de cinza); abaixo dela o vídeo está parado
+# e só o ruído da compressão varia, então não há nenhuma janela
+def detectar_janelas_movimento(indices, energia, fps, limiar=0.25, pausa_max=0.6, duracao_min=0.5, margem=0.25, movimento_min=0.02):
+    if len(energia) < 3: return []
+
+    # suaviza e define o limiar entre o repouso (percentil 10) e o pico (percentil 95)
+    suave = np.convolve(energia, np.ones(5) / 5, mode='same')
+    repouso, pico = np.percentile(suave, [10, 95])
+    if pico - repouso <= movimento_min: return []
+    ativo = suave > repouso + limiar * (pico - repouso)
+
+    # trechos contínuos de amostras ativas
+    bordas = np.flatnonzero(np.diff(np.concatenate(([0], ativo.astype(np.int8), [0]))))
+    trechos = [[indices[a], indices[b - 1] + 1] for a, b in zip(bordas[::2], bordas[1::2])]
+
+    # junta trechos separados por pausas curtas, descarta os muito curtos e adiciona margem
+    janelas = []
+    for inicio, fim in trechos:
+        if janelas and inicio - janelas[-1][1] <= pausa_max * fps:
+            janelas[-1][1] = fim
+        else:
+            janelas.append([inicio, fim])
+    folga = int(round(margem * fps))
+    return [(max(1, int(inicio) - folga), int(fim) + folga) for inicio, fim in janelas if fim - inicio >= duracao_min * fps]
+
+# pré-passagem rápida: janelas das repetições do vídeo
+def detectar_repeticoes(video_path, passo=2, **kwargs):
+    return detectar_janelas_movimento(*medir_movimento(video_path, passo), **kwargs)
+
+# picos por repetição (tabela com uma linha por repetição); df: DataFrame ou dict de colunas
+def resumo_repeticoes(df):
+    repeticoes, frames = np.asarray(df['Repeticao']), np.asarray(df['Frame'])
+    linhas = []
+    for rep in np.unique(repeticoes):
+        trecho = repeticoes == rep
+        grupo = {c: np.asarray(df[c])[trecho] for c in df if c.startswith(('Angulo Joelho', 'Desvio Valgo', 'Queda Pelvica'))}
+        linhas.append({'Repeticao': int(rep), 'Frame Inicial': int(frames[trecho].min()),
+                       'Frame Final': int(frames[trecho].max()), **calcular_picos(grupo)})
+    return linhas
+
+
+# --- Redução de séries para gráficos ---
+
+PONTOS_GRAFICO = 2000  # pontos por curva nos gráficos (os picos são sempre mantidos)
+
+# índices de uma série reduzida a no máximo max_pontos, por baldes de mínimo/máximo:
+# cada balde contribui com o seu menor e o seu maior valor, então os picos (ex.: o ângulo
+# mínimo do joelho) são mantidos exatamente. O primeiro e o último ponto também são mantidos.
+def indices_reduzidos(y, max_pontos):
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n <= max_pontos: return np.arange(n)
+
+    baldes = max(1, (max_pontos - 2) // 2)
+    bordas = np.linspace(0, n, baldes + 1).astype(np.int64)
+    balde = np.repeat(np.arange(baldes), np.diff(bordas))
+    indices = [np.array([0, n - 1])]
+    for extremos in (np.fmin.reduceat(y, bordas[:-1]), np.fmax.reduceat(y, bordas[:-1])):  # fmin/fmax ignoram NaN
+        candidatos = np.flatnonzero(y == extremos[balde])
+        _, primeiro = np.unique(balde[candidatos], return_index=True)  # primeira ocorrência em cada balde
+        indices.append(candidatos[primeiro])
+    return np.unique(np.concatenate(indices))
+
+# linhas do DataFrame para desenhar a(s) coluna(s) com no máximo max_pontos por curva
+# grupo: coluna que separa as curvas (ex.: 'Periodo'); cada curva é reduzida separadamente
+# As colunas desenhadas juntas usam as mesmas linhas: cada uma escolhe max_pontos // len(colunas)
+# (com os seus picos) e a união fica dentro de max_pontos
+def reduzir_df(df, colunas, max_pontos, grupo=None):
+    if isinstance(colunas, str): colunas = [colunas]
+    if grupo is not None and grupo in df.columns:
+        import pandas as pd
+        partes = [reduzir_df(g, colunas, max_pontos) for _, g in df.groupby(grupo, sort=False)]
+        return pd.concat(partes) if partes else df
+    if len(df) <= max_pontos: return df
+    por_coluna = max(1, max_pontos // len(colunas))
+    indices = np.unique(np.concatenate([indices_reduzidos(df[c].to_numpy(), por_coluna) for c in colunas]))
+    return df.iloc[indices]
+
+# --- Lucas-Kanade sobre pirâmides já construídas ---
+
+# níveis 0..maxLevel da pirâmide (o nível 0 é a própria imagem), com a mesma regra de parada do
+# OpenCV (nível menor ou igual à janela do LK não é construído).
+# destino: pirâmide anterior; os níveis de mesmo tamanho são escritos nos buffers dela em vez de alocados
+def construir_piramide(cinza, lk_params, destino=None):
+    largura_janela, altura_janela = lk_params['winSize']
+    niveis = [cinza]
+    for nivel in range(1, lk_params['maxLevel'] + 1):
+        h, w = niveis[-1].shape[:2]
+        h, w = (h + 1) // 2, (w + 1) // 2
+        if w <= largura_janela or h <= altura_janela: break
+        buffer = destino[nivel] if destino is not None and len(destino) > nivel and destino[nivel].shape == (h, w) else None
+        niveis.append(cv2.pyrDown(niveis[-1], buffer))
+    return niveis
+
+# A API Python do calcOpticalFlowPyrLK não aceita pirâmides prontas: cada nível é rastreado com
+# maxLevel=0, partindo da posição estimada no nível acima (o mesmo que o OpenCV faz internamente,
+# e com o mesmo resultado). Assim a pirâmide de cada frame é construída uma vez e reaproveitada
+# como "anterior" no frame seguinte.
+def fluxo_optico_piramides(piramide_ant, piramide, p0, lk_params):
+    topo = min(len(piramide_ant), len(piramide)) - 1
+    params = dict(lk_params, maxLevel=0, flags=lk_params.get('flags', 0) | cv2.OPTFLOW_USE_INITIAL_FLOW)
+    p1 = p0 * np.float32(1.0 / (1 << topo))
+    for nivel in range(topo, -1, -1):
+        p1, st, err = cv2.calcOpticalFlowPyrLK(piramide_ant[nivel], piramide[nivel], p0 * np.float32(1.0 / (1 << nivel)), p1, **params)
+        if nivel: p1 *= 2
+    return p1, st, err
+
+# percorre o vídeo a partir do frame 1 (o frame 0 é lido na abertura), entregando (número, frame).
+# Com janelas [(inicio, fim), ...], os frames fora delas são pulados com grab(); com [] nada é lido
+# destinos: iterador de buffers pré-alocados onde cada frame é decodificado (None = um array novo por frame)
+def _percorrer_frames(cap, janelas=None, instr=SEM_INSTRUMENTACAO, destinos=None):
+    numero = 1
+    while True:
+        if janelas is not None:
+            if not janelas or numero >= janelas[-1][1]: break  # depois da última janela
+            if not any(inicio <= numero < fim for inicio, fim in janelas):
+                with instr.medir('pular_frame'):
+                    if not cap.grab(): break
+                numero += 1
+                continue
+        with instr.medir('decodificacao'):
+            ret, frame = cap.read(next(destinos)) if destinos is not None else cap.read()
+        if not ret: break  # fim do vídeo
+        yield numero, frame
+        numero += 1
+
+# Marca o fim do vídeo na fila do leitor
+_FIM_VIDEO = object()
+
+# Leitor com pré-carregamento: decodifica e pré-processa frames em threads separadas
+# enquanto o rastreamento consome os frames já prontos, na ordem original.
+# A fila limitada funciona como um buffer circular: o leitor espera quando ela enche.
+class LeitorPrefetch:
+    def __init__(self, cap, preparar=None, profundidade=8, n_leitores=1, janelas=None, instr=SEM_INSTRUMENTACAO, destinos=None):
+        self.cap = cap
+        self.janelas = janelas  # só os frames dentro das janelas são entregues
+        self.instr = instr
+        self.destinos = destinos  # buffers de decodificação (ver _percorrer_frames)
+        # preparar(frame) -> tupla entregue ao consumidor; None entrega o frame decodificado
+        self.preparar = preparar or (lambda frame: (frame,))
+        self.fila = queue.Queue(maxsize=max(1, profundidade))
+        self.parar = threading.Event()
+        self.erro = None
+        # com mais de um leitor, o resize/cvtColor roda em paralelo (o cv2 libera o GIL);
+        # a fila guarda os futures na ordem de leitura, então a ordem dos frames é mantida
+        self.pool = ThreadPoolExecutor(n_leitores - 1) if n_leitores > 1 else None
+        self.thread = threading.Thread(target=self._ler, daemon=True)
+
+    def _colocar(self, item):
+        # espera espaço na fila, mas desiste se o consumidor pediu para parar
+        while not self.parar.is_set():
+            try:
+                self.fila.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _ler(self):
+        try:
+            for numero, frame in _percorrer_frames(self.cap, self.janelas, self.instr, self.destinos):
+                if self.parar.is_set(): break
+                self._colocar((numero, self.pool.submit(self.preparar, frame) if self.pool else self.preparar(frame)))
+        except Exception as e:
+            self.erro = e  # repassado ao consumidor
+        finally:
+            self._colocar(_FIM_VIDEO)
+
+    def __iter__(self):
+        self.thread.start()
+        try:
+            while True:
+                with self.instr.medir('espera_fila'):  # tempo em que o rastreamento ficou esperando o leitor
+                    item = self.fila.get()
+                if item is _FIM_VIDEO: break
+                numero, preparado = item
+                yield numero, (preparado.result() if self.pool else preparado)
+            if self.erro is not None: raise self.erro
+        finally:
+            self.fechar()
+
+    def fechar(self):
+        # encerra a thread de leitura (fim do vídeo ou rastreamento interrompido)
+        self.parar.set()
+        if self.thread.is_alive(): self.thread.join()
+        if self.pool: self.pool.shutdown(wait=True, cancel_futures=True)
+
 
 class AnalisadorBioStep:
-    def __init__(self, video_path, titulo="Analise"):
-        #carrega o vídeo
-        self.cap = cv2.VideoCapture(video_path)
+    def __init__(self, video_path, titulo="Analise", reancorar=False, reancorar_cada=0, janela_busca=25,
+                 roi=False, preservar_aspecto=False, segmentar=False, instrumentar=False, buffers_fixos=False,
+                 blocos_paralelos=0, esquema=None):
+        # o vídeo só é aberto quando for usado (ver a propriedade cap)
+        self.video_path = video_path
         self.titulo = titulo
-        self.dados = [] # lista para armazenar os dados calculados
-        
-        # lê o primeiro frame
-        success, frame = self.cap.read()
-        if not success: raise ValueError("Erro ao ler video")
+        # modo automático: pontos perdidos pelo fluxo óptico (status/erro) são reancorados
+        # pela cor do marcador; reancorar_cada > 0 reancora todos os pontos a cada N frames
+        self.reancorar = reancorar
+        self.reancorar_cada = reancorar_cada
+        self.janela_busca = janela_busca
+        # roi: rastreia só em um recorte ao redor dos marcadores, na resolução original do vídeo
+        # preservar_aspecto: o frame de referência segue a proporção do vídeo em vez de 480x850
+        self.roi = roi
+        self.preservar_aspecto = preservar_aspecto
+        # segmentar: rastreia só as janelas com movimento (repetições), detectadas por uma pré-passagem
+        self.segmentar = segmentar
+        # instrumentar: mede o tempo de cada etapa e conta pontos perdidos (ver self.diagnostico);
+        # não muda o resultado, por isso não entra em parametros_rastreamento
+        self.instrumentar = instrumentar
+        self.instr = SEM_INSTRUMENTACAO
+        # buffers_fixos: frames, cinza e pirâmides em buffers pré-alocados usados em rodízio, e a
+        # pirâmide de cada frame construída uma vez só (ver fluxo_optico_piramides). No modo ROI o
+        # recorte muda de tamanho, então só a decodificação usa buffers fixos. Mesmo resultado,
+        # por isso também fica fora de parametros_rastreamento
+        self.buffers_fixos = buffers_fixos
+        # blocos_paralelos > 1: processar_video divide o vídeo em até N trechos rastreados em paralelo,
+        # costurados pela sobreposição entre eles (ver _processar_em_blocos)
+        if blocos_paralelos > 1 and segmentar: raise ValueError("blocos_paralelos não pode ser usado com segmentar")
+        self.blocos_paralelos = blocos_paralelos
+        # esquema de marcadores (nome em ESQUEMAS ou dict): quais pontos são marcados e as métricas de cada lado
+        self.esquema = obter_esquema(esquema)
+        self.trajetoria = None # array (frames x pontos x 2) com os pontos rastreados
+        self.frames = None     # índice no vídeo de cada linha da trajetória
+        self.janelas = None    # janelas rastreadas no modo segmentado
+        self._cap = None
+        self._frame_inicial = None
+        self._area_min = 4     # área mínima (px do frame de referência) de uma mancha usada para reancorar
         
         # tamanho fixo para o vídeo processado
         self.LARGURA = 480
         self.ALTURA = 850
+        self._tamanho_base = (self.LARGURA, self.ALTURA)  # com preservar_aspecto, o tamanho final só é conhecido ao abrir o vídeo
         
-        
-        self.frame_inicial = cv2.resize(frame, (self.LARGURA, self.ALTURA))
-        #converte para escala  de cinza para o rastreamento óptico
-        self.old_gray = cv2.cvtColor(self.frame_inicial, cv2.COLOR_BGR2GRAY)
         # parâmetros do Lucas-Kanade
         # winSize: tamanho da janela de busca
         # maxLevel: níveis de pirâmide (para movimentos rápidos)
         self.lk_params = dict(winSize=(25, 25), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
 
+    @property
+    def cap(self):
+        # abertura preguiçosa: carrega o vídeo e lê o primeiro frame no primeiro acesso
+        if self._cap is None:
+            self._cap = cv2.VideoCapture(self.video_path)
+            success, frame = self._cap.read()
+            if not success:
+                self._cap.release()
+                self._cap = None
+                raise ValueError("Erro ao ler video")
+            self._iniciar_com_frame(frame)
+        return self._cap
+
+    def _iniciar_com_frame(self, frame):
+        # tamanho de referência, frame inicial e cinza a partir do primeiro frame da fonte
+        if self.preservar_aspecto:
+            # o lado maior fica com o tamanho padrão, o menor segue a proporção do vídeo
+            h, w = frame.shape[:2]
+            lado = max(self.LARGURA, self.ALTURA)
+            if h >= w: self.LARGURA, self.ALTURA = max(1, round(lado * w / h)), lado
+            else: self.LARGURA, self.ALTURA = lado, max(1, round(lado * h / w))
+
+        if self.roi: self._frame_ant = frame  # o modo ROI trabalha sobre o frame original
+        self._forma_video = frame.shape
+
+        self._frame_inicial = cv2.resize(frame, (self.LARGURA, self.ALTURA))
+        #converte para escala  de cinza para o rastreamento óptico
+        self.old_gray = cv2.cvtColor(self._frame_inicial, cv2.COLOR_BGR2GRAY)
+
+    @property
+    def frame_inicial(self):
+        if self._frame_inicial is None: self.cap
+        return self._frame_inicial
+
+    def fechar(self):
+        # libera o vídeo, se tiver sido aberto
+        if self._cap is not None: self._cap.release()
+
+    def parametros_rastreamento(self):
+        # tudo o que, além do vídeo e dos pontos, determina o resultado do rastreamento
+        parametros = {'lk_params': self.lk_params, 'tamanho': self._tamanho_base, 'versao': VERSAO_MOTOR,
+                      'reancorar': self.reancorar, 'reancorar_cada': self.reancorar_cada, 'janela_busca': self.janela_busca,
+                      'roi': self.roi, 'preservar_aspecto': self.preservar_aspecto, 'segmentar': self.segmentar}
+        # os blocos recomeçam pela cor do marcador: o resultado muda um pouco em relação ao sequencial
+        if self.blocos_paralelos > 1: parametros['blocos_paralelos'] = self.blocos_paralelos
+        if self.esquema != ESQUEMA_PADRAO: parametros['esquema'] = self.esquema
+        return parametros
+
+    @property
+    def diagnostico(self):
+        # resumo da instrumentação do último processamento (None se instrumentar=False)
+        return self.instr.resumo()
+
+    def registrar_diagnostico(self):
+        # grava o diagnóstico no log 'biostep' (uma linha JSON)
+        self.instr.concluir()
+        registrar_log(self.diagnostico, video=os.path.basename(self.video_path), titulo=self.titulo,
+                      parametros=self.parametros_rastreamento())
+
     def get_frame_inicial_rgb(self):
         #converte BGR para RGB para exibição no frontend
         return cv2.cvtColor(self.frame_inicial, cv2.COLOR_BGR2RGB)
 
     def set_pontos(self, lista_pontos):
-        #recebe  lista de  pontos  clicados pelo usuário    no  frontend
+        #recebe  lista de  pontos  clicados pelo usuário    no  frontend, na ordem do esquema
         self.p0 = np.array(lista_pontos, dtype=np.float32).reshape(-1, 1, 2)
+        if len(self.p0) != len(self.esquema['pontos']):
+            raise ValueError(f"O esquema '{self.esquema.get('nome', 'personalizado')}' usa {len(self.esquema['pontos'])} pontos, mas foram marcados {len(self.p0)}")
 
-    def processar_video(self):
-        #  processa o vídeo frame a frame
-        frame_count = 0
-        
-        while True:
-            #  lê o próximo frame
-            ret, frame = self.cap.read()
-            if not ret: break  # fim do vídeo
-            frame_count += 1
-            
-            # redimensiona e converte para escala de cinza
+    def _preparar_frame(self, frame):
+        # redimensiona e converte para escala de cinza
+        with self.instr.medir('resize'):
             frame = cv2.resize(frame, (self.LARGURA, self.ALTURA))
-            frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            
-            # cv2.calcOpticalFlowPyrLK compara a imagem anterior (old_gray) com a atual (frame_gray).
-            # ele pega os pontos antigos (self.p0) e descobre onde eles foram parar (p1).
-            p1, st, err = cv2.calcOpticalFlowPyrLK(self.old_gray, frame_gray, self.p0, None, **self.lk_params)
-            
-            if p1 is None: break # se não conseguiu rastrear, sai do loop
-            
-            pts = p1.reshape(-1, 2)  #   organiza os pontos rastreados
-
-            # define quadril de apoio (o mais próximo do joelho  analisado)
-            dist_d = np.linalg.norm(pts[1] - pts[3])
-            dist_e = np.linalg.norm(pts[2] - pts[3])
-            q_apoio = pts[1] if dist_d < dist_e else pts[2]
-
-            # calculos biomecânicos
-            ang = calcular_angulo(q_apoio, pts[3], pts[4])
-            desvio = calcular_desvio_linear(q_apoio, pts[3], pts[4])
-            pelve = calcular_inclinacao(pts[1], pts[2])
-            tronco = calcular_tronco(pts[0], pts[1], pts[2])
-
-            # armazena os dados calculados
-            self.dados.append({
-                'Frame': frame_count,
-                'Angulo Joelho': ang,
-                'Desvio Valgo (px)': desvio,
-                'Queda Pelvica': pelve,
-                'Inclinacao Tronco': tronco
-            })
-
-            self.old_gray = frame_gray.copy()   # atualiza o frame anterior
-            self.p0 = p1.reshape(-1, 1, 2)
-
-        self.cap.release()  # libera o vídeo
-        return pd.DataFrame(self.dados) # retorna os dados como DataFrame pandas
\ No newline at end of file
+        with self.instr.medir('cinza'):
+            return frame, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    def _preparar_frame_fixo(self, frame):
+        # como _preparar_frame, mas escrevendo no próximo par de buffers do anel
+        destino, cinza = next(self._quadros)
+        with self.instr.medir('resize'):
+            cv2.resize(frame, (self.LARGURA, self.ALTURA), dst=destino)
+        with self.instr.medir('cinza'):
+            cv2.cvtColor(destino, cv2.COLOR_BGR2GRAY, dst=cinza)
+        return destino, cinza
+
+    def _alocar_buffers(self, profundidade_fila, n_leitores):
+        # anéis de buffers usados em rodízio (itertools.cycle). Um buffer só volta a ser escrito
+        # depois que todos os outros do anel foram usados, então cada anel cobre os frames que podem
+        # estar em uso ao mesmo tempo: os da fila do leitor, o que está sendo lido e os dois do
+        # rastreamento (atual e anterior). Retorna o anel de decodificação
+        em_uso = profundidade_fila + 3 if profundidade_fila > 0 else 2
+        if self.roi:
+            n_decodificados = em_uso  # o modo ROI rastreia no próprio frame decodificado
+        else:
+            # o frame decodificado só é usado até o resize: com um leitor só, um buffer basta
+            n_decodificados = 1 if n_leitores <= 1 else profundidade_fila + 2
+            self._quadros = itertools.cycle([(np.empty((self.ALTURA, self.LARGURA, 3), np.uint8),
+                                              np.empty((self.ALTURA, self.LARGURA), np.uint8)) for _ in range(em_uso)])
+            # pirâmides: a do frame anterior e uma livre, que recebe o frame atual; depois as duas são trocadas
+            self._piramide_ant, self._piramide_livre = construir_piramide(self.old_gray, self.lk_params), None
+        return itertools.cycle([np.empty(self._forma_video, np.uint8) for _ in range(n_decodificados)])
+
+    def _frames_sequencial(self, preparar, janelas=None, destinos=None):
+        for numero, frame in _percorrer_frames(self.cap, janelas, self.instr, destinos):
+            yield numero, preparar(frame)
+
+    def _reiniciar_segmento(self, item):
+        # primeiro frame de uma janela depois de um salto: não há frame anterior para o fluxo óptico,
+        # então os marcadores são detectados pela cor e associados à última posição conhecida (como no
+        # início de um bloco paralelo; o salto pode ser maior que a janela de busca)
+        self.instr.contar('saltos_segmento')
+        if self.roi:
+            frame = item[0]
+            marcadores, _ = detectar_marcadores(frame, self._area_min_src)
+            pts_src, achou = associar_marcadores(marcadores, self._p_src, 2 * self._janela_src)
+            self._p_src, self._frame_ant, self._caixa_ant, self._velocidade = pts_src, frame, None, 0.0
+            pts = pts_src * self._escala_ref
+        else:
+            frame, frame_gray = item
+            marcadores, _ = detectar_marcadores(frame, self._area_min)
+            pts, achou = associar_marcadores(marcadores, self.p0.reshape(-1, 2), 2 * self.janela_busca)
+            self.p0, self.old_gray = pts.reshape(-1, 1, 2), frame_gray
+            if self.buffers_fixos:
+                self._piramide_livre, self._piramide_ant = self._piramide_ant, construir_piramide(frame_gray, self.lk_params, self._piramide_livre)
+        return pts, np.where(achou, CONFIANCA_COR, 0).astype(np.float32)
+
+    def _reancorar(self, frame, p_ant, p1, st, err, numero_frame, janela, area_min):
+        # p_ant, p1 e frame no mesmo sistema de coordenadas; janela e area_min também
+        # confiança do fluxo óptico: 1 com erro zero, caindo até 0 no limite de erro
+        pts = p1.reshape(-1, 2)
+        perdido = (st.ravel() == 0) | (err.ravel() > LIMITE_ERRO_LK)
+        confianca = np.clip(1 - err.ravel() / LIMITE_ERRO_LK, 0, 1).astype(np.float32)
+        confianca[perdido] = 0
+
+        # pontos perdidos: procura o marcador ao redor da última posição confiável
+        if perdido.any():
+            novos, achou = localizar_marcadores(frame, p_ant.reshape(-1, 2)[perdido], janela, area_min)
+            pts[perdido] = novos
+            confianca[np.flatnonzero(perdido)[achou]] = CONFIANCA_COR
+            self.instr.contar('pontos_perdidos', perdido.sum())
+            self.instr.contar('pontos_reancorados', achou.sum())
+
+        # reancoragem periódica: encaixa no centro do marcador os pontos rastreados que estão sobre ele
+        # (um ponto fora de qualquer marcador fica com a posição do fluxo óptico)
+        if self.reancorar_cada and numero_frame % self.reancorar_cada == 0:
+            ok = ~perdido
+            pts[ok], _ = localizar_marcadores(frame, pts[ok], janela, area_min, sobre_marcador=True)
+
+        return pts, confianca
+
+    def _passo_completo(self, numero_frame, frame, frame_gray):
+        # cv2.calcOpticalFlowPyrLK compara a imagem anterior (old_gray) com a atual (frame_gray).
+        # ele pega os pontos antigos (self.p0) e descobre onde eles foram parar (p1).
+        if self.buffers_fixos:
+            with self.instr.medir('piramide'):
+                piramide = construir_piramide(frame_gray, self.lk_params, self._piramide_livre)
+            with self.instr.medir('fluxo_optico'):
+                p1, st, err = fluxo_optico_piramides(self._piramide_ant, piramide, self.p0, self.lk_params)
+            self._piramide_livre, self._piramide_ant = self._piramide_ant, piramide
+        else:
+            with self.instr.medir('fluxo_optico'):
+                p1, st, err = cv2.calcOpticalFlowPyrLK(self.old_gray, frame_gray, self.p0, None, **self.lk_params)
+        if p1 is None: return None, None
+        self.instr.registrar_lk(st, err)
+
+        pts, confianca = p1.reshape(-1, 2), None
+        if self.reancorar:
+            with self.instr.medir('reancoragem'):
+                pts, confianca = self._reancorar(frame, self.p0, p1, st, err, numero_frame, self.janela_busca, self._area_min)
+
+        # atualiza o frame anterior: troca de referência, sem cópia (frame_gray é um array novo a cada
+        # iteração ou, com buffers_fixos, um buffer do anel que só é reescrito depois do próximo frame)
+        self.old_gray = frame_gray
+        self.p0 = pts.reshape(-1, 1, 2)
+        return pts, confianca
+
+    # --- Modo ROI: recorte dinâmico ao redor dos pontos, no frame original ---
+
+    def _iniciar_roi(self):
+        h, w = self._frame_ant.shape[:2]
+        # escala do frame original para o frame de referência (onde os pontos foram marcados)
+        self._escala_ref = np.array([self.LARGURA / w, self.ALTURA / h], dtype=np.float32)
+        self._p_src = self.p0.reshape(-1, 2) / self._escala_ref
+
+        # resolução do rastreamento: a mesma do modo completo (média geométrica das escalas),
+        # aumentada quando os marcadores estão próximos, até a resolução original
+        escala = float(np.sqrt(self._escala_ref.prod()))
+        if len(self._p_src) > 1:
+            dist = np.linalg.norm(self._p_src[:, None] - self._p_src[None], axis=-1)
+            dist_min = dist[dist > 0].min() if (dist > 0).any() else 0
+            if dist_min > 0: escala = max(escala, ESPACAMENTO_ROI / dist_min)
+        self._escala_roi = min(1.0, escala)
+        self._janela_src = max(1, round(self.janela_busca / self._escala_ref.min()))
+        self._area_min_src = max(4, round(self._area_min / self._escala_ref.prod()))
+        self._velocidade = 0.0  # deslocamento máximo do último frame (pixels do frame original)
+        self._caixa_ant, self._gray_ant = None, None
+
+    def _caixa_roi(self, pts, w, h):
+        # caixa ao redor dos pontos + margem para a janela do LK e o movimento recente
+        margem = (2 * max(self.lk_params['winSize'])) / self._escala_roi + 3 * self._velocidade
+        minimo, maximo = pts.min(axis=0) - margem, pts.max(axis=0) + margem
+
+        # mantém a caixa anterior enquanto ela ainda cobrir os pontos: assim o recorte
+        # do frame anterior é reaproveitado em vez de refeito
+        if self._caixa_ant is not None:
+            x0, y0, x1, y1 = self._caixa_ant
+            if (minimo >= (x0, y0)).all() and (maximo <= (x1, y1)).all():
+                return self._caixa_ant
+
+        # nova caixa com o dobro da margem (folga para os próximos frames), alinhada a uma grade
+        x0, y0 = np.floor((minimo - margem) / GRADE_ROI).astype(int) * GRADE_ROI
+        x1, y1 = np.ceil((maximo + margem) / GRADE_ROI).astype(int) * GRADE_ROI
+        return max(0, int(x0)), max(0, int(y0)), min(w, int(x1)), min(h, int(y1))
+
+    def _recortar(self, frame, caixa):
+        # reduz o recorte antes de converter para cinza (menos pixels na conversão)
+        x0, y0, x1, y1 = caixa
+        recorte = frame[y0:y1, x0:x1]
+        if self._escala_roi != 1.0:
+            tamanho = (max(1, round((x1 - x0) * self._escala_roi)), max(1, round((y1 - y0) * self._escala_roi)))
+            with self.instr.medir('resize'):
+                recorte = cv2.resize(recorte, tamanho)
+        with self.instr.medir('cinza'):
+            return cv2.cvtColor(recorte, cv2.COLOR_BGR2GRAY)
+
+    def _passo_roi(self, numero_frame, frame):
+        h, w = frame.shape[:2]
+        p_src = self._p_src
+        caixa = self._caixa_roi(p_src, w, h)
+        x0, y0, x1, y1 = caixa
+
+        # o frame anterior é recortado com a mesma caixa (reaproveitado se a caixa não mudou)
+        old_gray = self._gray_ant if caixa == self._caixa_ant else self._recortar(self._frame_ant, caixa)
+        frame_gray = self._recortar(frame, caixa)
+
+        # coordenadas do recorte (escala por eixo, pelo tamanho efetivo após o arredondamento)
+        escala = np.array([frame_gray.shape[1] / (x1 - x0), frame_gray.shape[0] / (y1 - y0)], dtype=np.float32)
+        origem = np.array([x0, y0], dtype=np.float32)
+        p0 = ((p_src - origem) * escala).reshape(-1, 1, 2)
+        with self.instr.medir('fluxo_optico'):
+            p1, st, err = cv2.calcOpticalFlowPyrLK(old_gray, frame_gray, p0, None, **self.lk_params)
+        if p1 is None: return None, None
+        self.instr.registrar_lk(st, err)
+
+        # volta para o frame original
+        pts, confianca = p1.reshape(-1, 2) / escala + origem, None
+        if self.reancorar:
+            with self.instr.medir('reancoragem'):
+                pts, confianca = self._reancorar(frame, p_src, pts, st, err, numero_frame, self._janela_src, self._area_min_src)
+
+        self._velocidade = float(np.abs(pts - p_src).max())
+        self._frame_ant, self._caixa_ant, self._gray_ant = frame, caixa, frame_gray
+        self._p_src = pts.astype(np.float32)
+
+        # as métricas são sempre calculadas no frame de referência
+        return self._p_src * self._escala_ref, confianca
+
+    def _colunas(self, pts, confianca, frames):
+        # métricas de um trecho da trajetória, mais a confiança por ponto (modo reancorar)
+        # e o número da repetição (modo segmentado)
+        with self.instr.medir('metricas'):
+            colunas = calcular_metricas_lote(pts, frames, self.esquema)
+        if confianca is not None:
+            for i, nome in enumerate(self.esquema['pontos']):
+                colunas[f'Confianca {nome}'] = confianca[:, i]
+        if self.janelas is not None:
+            inicios = np.array([inicio for inicio, _ in self.janelas])
+            colunas['Repeticao'] = np.searchsorted(inicios, frames, side='right').astype(np.int64)
+        return colunas
+
+    def iterar_resultados(self, tamanho_bloco=30, progresso=None, cancelar=None, profundidade_fila=8, n_leitores=1,
+                          guardar_trajetoria=False, janelas=None):
+        # processa o vídeo entregando os resultados aos poucos: a cada tamanho_bloco frames
+        # rastreados produz um dict de colunas (mesmo formato de calcular_metricas_lote)
+        # tamanho_bloco: None entrega tudo em um único bloco no final
+        # progresso(feitos, total): chamado a cada frame; total vem de CAP_PROP_FRAME_COUNT (0 se desconhecido)
+        # cancelar: objeto com is_set() (ex.: threading.Event); interrompe após o frame atual
+        # guardar_trajetoria: mantém a trajetória completa em self.trajetoria; sem isso só o bloco atual fica na memória
+        # profundidade_fila: frames pré-carregados pela thread de leitura (0 = leitura sequencial)
+        # n_leitores: threads de leitura/pré-processamento
+        # janelas: [(inicio, fim), ...] em índices de frame; só esses trechos são rastreados.
+        #          Com segmentar=True e sem janelas, elas são detectadas automaticamente.
+        #          Sem nenhuma janela (ex.: vídeo sem movimento), nada é rastreado e o resultado fica vazio.
+        self.instr = Instrumentacao() if self.instrumentar else SEM_INSTRUMENTACAO
+        if janelas is None and self.segmentar:
+            with self.instr.medir('segmentacao'):
+                janelas = detectar_repeticoes(self.video_path)
+        self.janelas = sorted(janelas) if janelas is not None else None
+        if self.janelas == []:
+            logger.warning("Nenhuma repeticao detectada em %s: nenhum frame rastreado", os.path.basename(self.video_path))
+            self.trajetoria = np.empty((0, len(self.p0), 2), np.float32)
+            self.frames = np.empty(0, np.int64)
+            self.cancelado = False
+            self.fechar()
+            self.instr.concluir()
+            return
+
+        total = max(int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)) - 1, 0)  # o primeiro frame já foi lido
+        if self.janelas is not None:
+            total = sum(max(0, min(fim, total + 1) - inicio) for inicio, fim in self.janelas)
+        n_pontos = len(self.p0)
+        self.cancelado = False
+
+        # pré-aloca a trajetória inteira (guardar_trajetoria ou bloco único) ou apenas um bloco
+        inteira = guardar_trajetoria or not tamanho_bloco
+        capacidade = max(total, 1) if inteira else tamanho_bloco
+        trajetoria = np.empty((capacidade, n_pontos, 2), dtype=np.float32)
+        numeros = np.empty(capacidade, dtype=np.int64)  # índice de cada frame no vídeo
+        confianca = np.empty((capacidade, n_pontos), dtype=np.float32) if self.reancorar else None
+        base = 0              # índice (frame_count) da primeira posição do buffer
+        inicio_bloco = 0
+        frame_count = 0
+        ultimo = 0            # último frame lido (o frame 0 é lido na abertura)
+
+        destinos = self._alocar_buffers(profundidade_fila, n_leitores) if self.buffers_fixos else None
+        # manchas com menos da metade da área dos marcadores marcados não são usadas para reancorar
+        if self.reancorar or self.janelas is not None: self._area_min = max(4, self._area_marcadores() // 2)
+
+        # no modo ROI o recorte depende dos pontos do frame anterior: o leitor só decodifica
+        if self.roi:
+            self._iniciar_roi()
+            preparar, passo = (lambda frame: (frame,)), self._passo_roi
+        else:
+            preparar, passo = (self._preparar_frame_fixo if self.buffers_fixos else self._preparar_frame), self._passo_completo
+
+        if profundidade_fila > 0:
+            frames = iter(LeitorPrefetch(self.cap, preparar, profundidade_fila, n_leitores, self.janelas, self.instr, destinos))
+        else:
+            frames = self._frames_sequencial(preparar, self.janelas, destinos)
+
+        try:
+            for numero, item in frames:
+                # salto entre janelas: reposiciona os pontos pela cor em vez de usar o fluxo óptico
+                if numero != ultimo + 1:
+                    pts, conf = self._reiniciar_segmento(item)
+                else:
+                    pts, conf = passo(numero, *item)
+                    if pts is None: break # se não conseguiu rastrear, sai do loop
+                ultimo = numero
+
+                # CAP_PROP_FRAME_COUNT é só uma estimativa em alguns formatos: dobra a capacidade se faltar espaço
+                if frame_count - base == len(trajetoria):
+                    trajetoria = np.concatenate((trajetoria, np.empty_like(trajetoria)))
+                    numeros = np.concatenate((numeros, np.empty_like(numeros)))
+                    if confianca is not None: confianca = np.concatenate((confianca, np.empty_like(confianca)))
+
+                trajetoria[frame_count - base] = pts  #   organiza os pontos rastreados
+                numeros[frame_count - base] = numero
+                if confianca is not None: confianca[frame_count - base] = 1.0 if conf is None else conf
+                frame_count += 1
+                self.instr.contar('frames')
+
+                if progresso: progresso(frame_count, total)
+                if cancelar is not None and cancelar.is_set():
+                    self.cancelado = True
+                    break
+
+                # bloco completo: calcula as métricas do trecho e entrega
+                if tamanho_bloco and frame_count - inicio_bloco == tamanho_bloco:
+                    yield self._bloco(trajetoria, numeros, confianca, inicio_bloco - base, frame_count - base)
+                    inicio_bloco = frame_count
+                    if not inteira: base = frame_count  # reaproveita o buffer do bloco
+        finally:
+            frames.close()  # encerra a leitura antes de liberar o vídeo
+            self.fechar()  # libera o vídeo
+
+        if inteira:
+            self.trajetoria = trajetoria[:frame_count]
+            self.frames = numeros[:frame_count]
+
+        # último bloco (parcial)
+        if frame_count > inicio_bloco:
+            yield self._bloco(trajetoria, numeros, confianca, inicio_bloco - base, frame_count - base)
+        self.instr.concluir()
+
+    def _bloco(self, trajetoria, numeros, confianca, a, b):
+        return self._colunas(trajetoria[a:b], None if confianca is None else confianca[a:b], numeros[a:b])
+
+    # --- Blocos paralelos: um vídeo longo dividido em trechos rastreados ao mesmo tempo ---
+
+    def _area_marcadores(self):
+        # área (px) do menor marcador marcado no frame inicial: a maior mancha amarela perto de cada ponto
+        centros, areas = detectar_marcadores(self.frame_inicial)
+        perto = np.linalg.norm(centros[:, None] - self.p0.reshape(1, -1, 2), axis=-1) < self.janela_busca
+        achados = [areas[perto[:, i]].max() for i in range(perto.shape[1]) if perto[:, i].any()]
+        return int(min(achados)) if achados else 0
+
+    def _rastrear_bloco(self, inicio, fim, sementes=None, avancar=None, cancelar=None, area_min=4):
+        # rastreia os frames (inicio, fim) em uma cópia do analisador, com o vídeo posicionado no frame inicio
+        # sementes: pontos no frame inicio; None = detecta os marcadores (manchas com pelo menos area_min px)
+        #           e associa ao arranjo de self.p0
+        # fim None: até o fim do vídeo; avancar(numero): chamado a cada frame rastreado
+        # Retorna (trajetoria, numeros, confianca, semeado, instrumentação do bloco); semeado: quais pontos
+        # começaram sobre um marcador (todos, com sementes)
+        bloco = copy.copy(self)
+        bloco.instr = Instrumentacao() if self.instrumentar else SEM_INSTRUMENTACAO
+        bloco._cap = cv2.VideoCapture(self.video_path)
+        if inicio: bloco._cap.set(cv2.CAP_PROP_POS_FRAMES, inicio)
+        trajetoria, numeros, confiancas = [], [], []
+        try:
+            ok, frame = bloco._cap.read()
+            if not ok: raise ValueError(f"Erro ao ler o frame {inicio} do video")
+            bloco._iniciar_com_frame(frame)
+            semeado = np.ones(len(self.p0), dtype=bool)
+            if sementes is None:
+                with bloco.instr.medir('deteccao_marcadores'):
+                    marcadores, _ = detectar_marcadores(bloco._frame_inicial, area_min)
+                    sementes, semeado = associar_marcadores(marcadores, self.p0, 2 * self.janela_busca)
+            bloco.set_pontos(sementes)
+
+            destinos = bloco._alocar_buffers(0, 1) if self.buffers_fixos else None
+            if self.roi:
+                bloco._iniciar_roi()
+                preparar, passo = (lambda frame: (frame,)), bloco._passo_roi
+            else:
+                preparar, passo = (bloco._preparar_frame_fixo if self.buffers_fixos else bloco._preparar_frame), bloco._passo_completo
+
+            # o leitor numera os frames a partir do seguinte ao já lido (1, 2, ...)
+            for relativo, item in bloco._frames_sequencial(preparar, None, destinos):
+                numero = inicio + relativo
+                if fim is not None and numero >= fim: break
+                pts, conf = passo(numero, *item)
+                if pts is None: break
+                trajetoria.append(pts)
+                numeros.append(numero)
+                if self.reancorar: confiancas.append(np.ones(len(pts), np.float32) if conf is None else conf)
+                bloco.instr.contar('frames')
+                if avancar: avancar(numero)
+                if cancelar is not None and cancelar.is_set(): break
+        finally:
+            bloco.fechar()
+            bloco.instr.concluir()
+
+        n_pontos = len(self.p0)
+        return (np.array(trajetoria, np.float32).reshape(-1, n_pontos, 2), np.array(numeros, np.int64),
+                np.array(confiancas, np.float32).reshape(-1, n_pontos) if self.reancorar else None, semeado, bloco.instr)
+
+    def _processar_em_blocos(self, progresso=None, cancelar=None):
+        # Divide os frames em até blocos_paralelos trechos, rastreados ao mesmo tempo em threads (o cv2 libera
+        # o GIL), cada um com o seu VideoCapture posicionado no início do trecho. O primeiro parte dos pontos
+        # marcados; os demais começam SOBREPOSICAO_BLOCOS frames antes, com os marcadores detectados pela cor.
+        # Na costura, cada ponto do bloco é deslocado pela diferença mediana em relação ao anterior nos frames
+        # em comum, e continua de onde o anterior o deixou. O bloco só é refeito a partir do anterior quando a
+        # diferença passa de LIMITE_DESVIO_BLOCO por troca de marcador: o ponto não foi achado pela cor ou
+        # segue outro ponto do bloco anterior. Cada costura é feita assim que os seus dois blocos terminam; o
+        # bloco refeito volta para o pool enquanto os seguintes ainda rodam.
+        # Retorna as colunas (como processar_video(como_dataframe=False)); None se o vídeo for curto demais
+        total = max(int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)) - 1, 0)  # o primeiro frame já foi lido
+        n_blocos = min(self.blocos_paralelos, total // BLOCO_MIN)
+        if n_blocos < 2: return None
+        limites = [int(round(1 + i * total / n_blocos)) for i in range(n_blocos)] + [None]  # o último vai até o fim
+        self.janelas = None
+        self.cancelado = False
+        # manchas com menos da metade da área dos marcadores marcados são ignoradas na detecção
+        area_min = self._area_min = max(4, self._area_marcadores() // 2)  # também na reancoragem dos blocos
+
+        trava = threading.Lock()
+        feitos = [0]
+
+        def avancar(frames=1):
+            with trava:  # serializa também o progresso (ex.: gravação em arquivo)
+                feitos[0] += frames
+                if progresso: progresso(min(feitos[0], total), total)
+
+        def avancar_bloco(inicio):
+            # só contam os frames que o bloco entrega: os da sobreposição são do bloco anterior
+            def avancar_frame(numero):
+                if numero >= inicio: avancar()
+            return avancar_frame
+
+        with ThreadPoolExecutor(n_blocos) as pool:
+            futuros = [pool.submit(self._rastrear_bloco, 0, limites[1], self.p0, avancar_bloco(limites[0]), cancelar)]
+            futuros += [pool.submit(self._rastrear_bloco, limites[i] - SOBREPOSICAO_BLOCOS - 1, limites[i + 1], None,
+                                    avancar_bloco(limites[i]), cancelar, area_min)
+                        for i in range(1, n_blocos)]
+
+            trajetoria, numeros, confianca, _, instr = futuros[0].result()
+            self.instr.incorporar(instr)
+            pedacos = [(trajetoria, numeros, confianca)]
+            for i in range(1, n_blocos):
+                trajetoria, numeros, confianca, semeado, instr = futuros[i].result()
+                self.instr.incorporar(instr)
+                ant_traj, ant_numeros, _ = pedacos[-1]
+                inicio = limites[i]
+                # o bloco anterior parou antes do fim do trecho (cancelado ou falha): para aqui, como no sequencial
+                if not len(ant_numeros) or ant_numeros[-1] != inicio - 1: break
+
+                comuns, i_ant, i_atual = np.intersect1d(ant_numeros, numeros, return_indices=True)
+                refazer = not len(comuns)
+                if not refazer:
+                    # diferença mediana de cada ponto do anterior (linhas) para cada ponto do bloco (colunas)
+                    desvios = np.median(ant_traj[i_ant][:, :, None] - trajetoria[i_atual][:, None], axis=0)
+                    distancias = np.linalg.norm(desvios, axis=-1)
+                    desvio = desvios.diagonal().T  # de cada ponto para ele mesmo
+                    fora = distancias.diagonal() > LIMITE_DESVIO_BLOCO
+                    refazer = (fora & ~semeado).any() or (distancias[:, fora] <= LIMITE_DESVIO_BLOCO).any()
+                if refazer:
+                    # refaz a partir da última posição do bloco anterior; os frames do bloco descartado saem do progresso
+                    self.instr.contar('blocos_refeitos')
+                    self.instr.contar('frames', -len(numeros))
+                    avancar(-int((numeros >= inicio).sum()))
+                    refeito = pool.submit(self._rastrear_bloco, inicio - 1, limites[i + 1], ant_traj[-1], avancar_bloco(inicio), cancelar)
+                    trajetoria, numeros, confianca, _, instr = refeito.result()
+                    self.instr.incorporar(instr)
+                    desvio = 0
+                novos = numeros >= inicio
+                self.instr.contar('frames', -(~novos).sum())  # a sobreposição não conta como frame entregue
+                pedacos.append((trajetoria[novos] + desvio, numeros[novos], None if confianca is None else confianca[novos]))
+
+        self.cancelado = cancelar is not None and cancelar.is_set()
+        self.fechar()
+        self.trajetoria = np.concatenate([t for t, _, _ in pedacos])
+        self.frames = np.concatenate([n for _, n, _ in pedacos])
+        confianca = np.concatenate([c for _, _, c in pedacos]) if self.reancorar else None
+        return self._colunas(self.trajetoria, confianca, self.frames)
+
+    def processar_video(self, profundidade_fila=8, n_leitores=1, progresso=None, cancelar=None, janelas=None,
+                        como_dataframe=True):
+        #  processa o vídeo inteiro e retorna os dados como DataFrame pandas
+        # (ou, com como_dataframe=False, como dict de arrays, sem precisar do pandas)
+        # o rastreamento só grava as coordenadas; as métricas são calculadas em lote no final
+        # com instrumentar=True, o diagnóstico fica em df.attrs['diagnostico'] e no log 'biostep'
+        # com blocos_paralelos > 1, vídeos longos são divididos em trechos rastreados em paralelo
+        colunas = None
+        if self.blocos_paralelos > 1 and janelas is None:
+            self.instr = Instrumentacao() if self.instrumentar else SEM_INSTRUMENTACAO
+            colunas = self._processar_em_blocos(progresso, cancelar)
+            self.instr.concluir()
+        if colunas is not None:
+            blocos = [colunas]
+        else:
+            blocos = list(self.iterar_resultados(None, progresso, cancelar, profundidade_fila, n_leitores,
+                                                 guardar_trajetoria=True, janelas=janelas))
+        if not blocos:
+            # nenhum frame rastreado: DataFrame vazio, com as mesmas colunas
+            vazio = np.empty((0, len(self.p0)), np.float32) if self.reancorar else None
+            blocos = [self._colunas(self.trajetoria, vazio, self.frames)]
+        if not como_dataframe:
+            self.registrar_diagnostico()
+            return blocos[0]
+
+        import pandas as pd
+        with self.instr.medir('dataframe'):
+            df = pd.DataFrame(blocos[0])
+        if self.instr.ativa:
+            self.registrar_diagnostico()
+            df.attrs['diagnostico'] = self.diagnostico
+        return df
+
+
+# junta os resultados das sessões em um único DataFrame, identificadas pela coluna Periodo
+def combinar_sessoes(resultados):
+    import pandas as pd
+    return pd.concat([df.assign(Periodo=rotulo) for rotulo, df in resultados.items()], ignore_index=True)
@@ -0,0 +1,297 @@
+# Fila de análises em segundo plano
+#
+# O dashboard envia a análise e recebe um id; o rastreamento roda em um processo próprio
+# (python biostep_jobs.py <pasta da tarefa>), fora da thread do script do Streamlit, então
+# recarregar a página ou mexer nos widgets não perde o trabalho. Um processo novo por tarefa,
+# e não um multiprocessing.Pool: o Streamlit executa o dashboard como __main__, e os processos
+# do multiprocessing (spawn) reexecutariam o script. Cada tarefa tem uma pasta <pasta>/<id>/ com:
+#   tarefa.json     - pedido e estado (na_fila, rodando, concluida, erro, cancelada) e o pid do processo de
+#                     trabalho, gravado pelo gerenciador
+#   progresso.json  - frames feitos/total, gravado pelo processo de trabalho
+#   cancelar        - criado para pedir o cancelamento de uma tarefa em andamento
+#   resultado.pkl   - {'df': DataFrame, 'trajetoria': array} quando concluída
+# Cada usuário tem no máximo limite_por_usuario tarefas rodando; as demais esperam na fila. As tarefas
+# enviadas juntas com o mesmo grupo (ex.: os vídeos Antes/Depois de uma comparação) contam como uma só,
+# para que os vídeos de uma comparação rodem ao mesmo tempo.
+# Tarefas que não terminaram (ex.: o servidor reiniciou) voltam para a fila na próxima abertura, a não
+# ser que o processo de trabalho anterior ainda esteja ativo: essas são canceladas e ficam com erro.
+# O servidor carrega os resultados com pickle, então a pasta precisa ser só do usuário do servidor:
+# ela é criada com permissão 0700 e recusada se for de outro usuário ou se outros puderem gravar nela.
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+PASTA_PADRAO = os.environ.get('BIOSTEP_TAREFAS', os.path.join(os.path.expanduser('~'), '.cache', 'biostep_tarefas'))
+LIMITE_POR_USUARIO = 2
+VALIDADE_TAREFA = 7 * 24 * 3600  # segundos até uma tarefa terminada ser apagada
+INTERVALO_PROGRESSO = 0.5        # segundos entre gravações do progresso
+
+EM_ANDAMENTO = ('na_fila', 'rodando')
+ARQUIVO_TAREFA, ARQUIVO_PROGRESSO, ARQUIVO_CANCELAR, ARQUIVO_RESULTADO = 'tarefa.json', 'progresso.json', 'cancelar', 'resultado.pkl'
+
+
+def _gravar_json(caminho, dados):
+    # temporário + rename: o leitor nunca vê um arquivo pela metade
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(caminho), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(dados, f, ensure_ascii=False)
+    os.replace(tmp, caminho)
+
+def _ler_json(caminho):
+    try:
+        with open(caminho, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# cria a pasta só para o usuário atual; recusa uma pasta de outro usuário ou em que outros podem gravar
+# (alguém poderia deixar ali um resultado.pkl que executa código ao ser carregado)
+def _preparar_pasta_privada(pasta):
+    os.makedirs(pasta, mode=0o700, exist_ok=True)
+    if not hasattr(os, 'getuid'): return  # Windows: a pasta do perfil já é do usuário
+    info = os.stat(pasta)
+    if info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise PermissionError(f"A pasta de tarefas {pasta} precisa ser do usuário atual e sem permissão de "
+                              f"escrita para outros (dono {info.st_uid}, permissões {oct(info.st_mode & 0o777)})")
+    if info.st_mode & 0o077: os.chmod(pasta, 0o700)
+
+# o processo ainda existe? Sem como consultar (no Windows os.kill encerraria o processo), considera que sim
+def _processo_ativo(pid):
+    if not pid: return False
+    if os.name == 'nt': return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # existe, mas é de outro usuário (pid reaproveitado)
+    return True
+
+
+# --- Processo de trabalho ---
+
+# cancelamento pelo arquivo "cancelar" na pasta da tarefa (consultado no máximo a cada 0,2 s)
+class _CancelamentoPorArquivo:
+    def __init__(self, caminho, intervalo=0.2):
+        self.caminho = caminho
+        self.intervalo = intervalo
+        self._proxima = 0.0
+        self._cancelado = False
+
+    def is_set(self):
+        agora = time.monotonic()
+        if not self._cancelado and agora >= self._proxima:
+            self._cancelado = os.path.exists(self.caminho)
+            self._proxima = agora + self.intervalo
+        return self._cancelado
+
+# roda a análise descrita no tarefa.json; devolve o status final ('concluida' ou 'cancelada')
+def _executar_tarefa(pasta):
+    import cv2
+    from biostep_engine import AnalisadorBioStep
+    cv2.setNumThreads(1)  # o paralelismo vem das várias tarefas: uma thread do OpenCV por processo
+
+    tarefa = _ler_json(os.path.join(pasta, ARQUIVO_TAREFA))
+
+    caminho_progresso = os.path.join(pasta, ARQUIVO_PROGRESSO)
+    ultimo = [0.0]
+
+    def progresso(feitos, total):
+        agora = time.monotonic()
+        if agora - ultimo[0] >= INTERVALO_PROGRESSO:
+            _gravar_json(caminho_progresso, {'feitos': feitos, 'total': total})
+            ultimo[0] = agora
+
+    analise = AnalisadorBioStep(tarefa['video'], tarefa['titulo'], **tarefa['opcoes'])
+    analise.set_pontos(tarefa['pontos'])
+    df = analise.processar_video(progresso=progresso, cancelar=_CancelamentoPorArquivo(os.path.join(pasta, ARQUIVO_CANCELAR)))
+    if analise.cancelado: return 'cancelada'
+
+    caminho = os.path.join(pasta, ARQUIVO_RESULTADO)
+    with open(caminho + '.tmp', 'wb') as f:
+        pickle.dump({'df': df, 'trajetoria': analise.trajetoria}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(caminho + '.tmp', caminho)
+    _gravar_json(caminho_progresso, {'feitos': len(df), 'total': len(df)})
+    return 'concluida'
+
+
+# --- Gerenciador (um por servidor) ---
+
+# tarefas sem grupo contam sozinhas no limite por usuário
+def _grupo(tarefa):
+    return tarefa.get('grupo') or tarefa['id']
+
+class GerenciadorTarefas:
+    def __init__(self, pasta=PASTA_PADRAO, max_workers=None, limite_por_usuario=LIMITE_POR_USUARIO):
+        self.pasta = pasta
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.limite_por_usuario = limite_por_usuario
+        _preparar_pasta_privada(self.pasta)
+        self._trava = threading.RLock()  # reentrante: o callback de um futuro já concluído roda na hora, com a trava
+        self._tarefas = {}   # id -> conteúdo do tarefa.json
+        self._fila = []      # ids na_fila, na ordem de envio
+        self._rodando = {}   # id -> future
+        self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix='biostep_tarefa')  # cada thread espera um processo
+        self._retomar()
+
+    def _pasta_tarefa(self, id_tarefa):
+        return os.path.join(self.pasta, id_tarefa)
+
+    def _atualizar(self, id_tarefa, **campos):
+        tarefa = self._tarefas[id_tarefa]
+        tarefa.update(campos)
+        _gravar_json(os.path.join(self._pasta_tarefa(id_tarefa), ARQUIVO_TAREFA), tarefa)
+
+    def _retomar(self):
+        # carrega o registro; tarefas não terminadas voltam para a fila e as antigas são apagadas.
+        # Uma tarefa 'rodando' cujo processo ainda existe (ex.: o servidor anterior caiu e ele continuou)
+        # não volta para a fila, senão rodaria duas vezes: recebe o pedido de cancelamento e fica com erro
+        limite = time.time() - VALIDADE_TAREFA
+        tarefas = []
+        for nome in os.listdir(self.pasta):
+            tarefa = _ler_json(os.path.join(self.pasta, nome, ARQUIVO_TAREFA))
+            if tarefa is None: continue
+            if tarefa['status'] not in EM_ANDAMENTO and (tarefa.get('concluida') or tarefa['criada']) < limite:
+                shutil.rmtree(self._pasta_tarefa(nome), ignore_errors=True)
+                continue
+            tarefas.append(tarefa)
+
+        with self._trava:
+            for tarefa in sorted(tarefas, key=lambda t: t['criada']):
+                self._tarefas[tarefa['id']] = tarefa
+                if tarefa['status'] == 'rodando' and _processo_ativo(tarefa.get('pid')):
+                    open(os.path.join(self._pasta_tarefa(tarefa['id']), ARQUIVO_CANCELAR), 'w').close()
+                    self._atualizar(tarefa['id'], status='erro', concluida=time.time(),
+                                    erro="o servidor reiniciou durante a análise; envie o vídeo de novo")
+                elif tarefa['status'] in EM_ANDAMENTO:
+                    for arquivo in (ARQUIVO_CANCELAR, ARQUIVO_PROGRESSO):
+                        try:
+                            os.remove(os.path.join(self._pasta_tarefa(tarefa['id']), arquivo))
+                        except FileNotFoundError:
+                            pass
+                    if os.path.exists(tarefa['video']):
+                        self._atualizar(tarefa['id'], status='na_fila')
+                        self._fila.append(tarefa['id'])
+                    else:
+                        self._atualizar(tarefa['id'], status='erro', erro="vídeo não encontrado ao retomar a tarefa", concluida=time.time())
+            self._despachar()
+
+    def _despachar(self):
+        # com a trava: inicia as tarefas da fila respeitando o limite por usuário (em grupos) e o de processos
+        ativos = defaultdict(set)  # usuário -> grupos rodando
+        for i in self._rodando:
+            ativos[self._tarefas[i]['usuario']].add(_grupo(self._tarefas[i]))
+        for id_tarefa in list(self._fila):
+            if len(self._rodando) >= self.max_workers: break
+            tarefa = self._tarefas[id_tarefa]
+            grupos = ativos[tarefa['usuario']]
+            if _grupo(tarefa) not in grupos and len(grupos) >= self.limite_por_usuario: continue
+            self._fila.remove(id_tarefa)
+            grupos.add(_grupo(tarefa))
+            self._atualizar(id_tarefa, status='rodando', iniciada=time.time(), pid=None)
+            futuro = self._pool.submit(self._rodar_processo, id_tarefa)
+            self._rodando[id_tarefa] = futuro
+            futuro.add_done_callback(partial(self._concluir, id_tarefa))
+
+    def _rodar_processo(self, id_tarefa):
+        processo = subprocess.Popen([sys.executable, os.path.abspath(__file__), self._pasta_tarefa(id_tarefa)],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        with self._trava:
+            self._atualizar(id_tarefa, pid=processo.pid)  # para a retomada saber se ele ainda está ativo
+        saida, erros = processo.communicate()
+        if processo.returncode != 0:
+            # última linha do traceback (ex.: "ValueError: Não foi possível abrir o vídeo")
+            linhas = erros.strip().splitlines()
+            raise RuntimeError(linhas[-1] if linhas else f"o processo terminou com código {processo.returncode}")
+        return saida.strip().splitlines()[-1]
+
+    def _concluir(self, id_tarefa, futuro):
+        with self._trava:
+            self._rodando.pop(id_tarefa, None)
+            try:
+                self._atualizar(id_tarefa, status=futuro.result(), concluida=time.time())
+            except Exception as e:  # erro na análise ou o processo de trabalho morreu
+                self._atualizar(id_tarefa, status='erro', erro=str(e), concluida=time.time())
+            self._despachar()
+
+    # --- API ---
+
+    def enviar(self, usuario, video, pontos, titulo="Analise", opcoes=None, dados=None, grupo=None):
+        # dados: informações extras devolvidas com o estado (ex.: a chave do cache de resultados)
+        # grupo: tarefas com o mesmo grupo ocupam uma só vaga do usuário (ex.: os vídeos de uma comparação)
+        id_tarefa = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(self._pasta_tarefa(id_tarefa))
+        with self._trava:
+            self._tarefas[id_tarefa] = {
+                'id': id_tarefa, 'usuario': usuario, 'video': video, 'titulo': titulo,
+                'pontos': [[float(x), float(y)] for x, y in pontos], 'opcoes': opcoes or {}, 'dados': dados or {},
+                'criada': time.time(), 'grupo': grupo,
+            }
+            self._atualizar(id_tarefa, status='na_fila')
+            self._fila.append(id_tarefa)
+            self._despachar()
+        return id_tarefa
+
+    def estado(self, id_tarefa):
+        # cópia do registro + progresso (feitos, total) e posição na fila; None se a tarefa não existe
+        with self._trava:
+            if id_tarefa not in self._tarefas: return None
+            tarefa = dict(self._tarefas[id_tarefa])
+            posicao = self._fila.index(id_tarefa) + 1 if id_tarefa in self._fila else None
+        progresso = _ler_json(os.path.join(self._pasta_tarefa(id_tarefa), ARQUIVO_PROGRESSO)) or {}
+        tarefa.update(feitos=progresso.get('feitos', 0), total=progresso.get('total', 0), posicao_fila=posicao)
+        return tarefa
+
+    def listar(self, usuario=None):
+        # tarefas (mais recentes primeiro); só as do usuário, se informado
+        with self._trava:
+            ids = [i for i, t in self._tarefas.items() if usuario is None or t['usuario'] == usuario]
+        tarefas = [t for t in map(self.estado, ids) if t is not None]
+        return sorted(tarefas, key=lambda t: t['criada'], reverse=True)
+
+    def cancelar(self, id_tarefa):
+        with self._trava:
+            tarefa = self._tarefas.get(id_tarefa)
+            if tarefa is None or tarefa['status'] not in EM_ANDAMENTO: return
+            if id_tarefa in self._fila:
+                self._fila.remove(id_tarefa)
+                self._atualizar(id_tarefa, status='cancelada', concluida=time.time())
+            else:
+                # o processo de trabalho vê o arquivo e para após o frame atual
+                open(os.path.join(self._pasta_tarefa(id_tarefa), ARQUIVO_CANCELAR), 'w').close()
+
+    def resultado(self, id_tarefa):
+        # {'df': DataFrame, 'trajetoria': array} de uma tarefa concluída (None se não houver)
+        try:
+            with open(os.path.join(self._pasta_tarefa(id_tarefa), ARQUIVO_RESULTADO), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def remover(self, id_tarefa):
+        self.cancelar(id_tarefa)
+        with self._trava:
+            if id_tarefa in self._rodando: return  # ainda terminando o frame atual
+            self._tarefas.pop(id_tarefa, None)
+        shutil.rmtree(self._pasta_tarefa(id_tarefa), ignore_errors=True)
+
+    def encerrar(self, esperar=True):
+        with self._trava:
+            for id_tarefa in self._rodando:
+                open(os.path.join(self._pasta_tarefa(id_tarefa), ARQUIVO_CANCELAR), 'w').close()
+            self._fila.clear()
+        self._pool.shutdown(wait=esperar, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    print(_executar_tarefa(sys.argv[1]))
@@ -0,0 +1,256 @@
+# Processamento em lote (sem interface) de vídeos do teste Step Down
+#
+# Uso:
+#   python biostep_lote.py <pasta ou manifesto.json> --saida resultados [--processos N]
+#
+# Pasta: cada vídeo (.mp4/.mov) precisa de um arquivo lateral com os pontos iniciais na ordem do esquema
+#        de marcadores (--esquema: 5 pontos no padrão, 7 no bilateral),
+#        "video.json" ou "video.mp4.json", no formato {"pontos": [[x, y], ...]} (ou só a lista).
+# Manifesto: lista JSON de {"video": caminho, "pontos": [[x, y], ...]}; caminhos relativos
+#            são resolvidos a partir da pasta do manifesto.
+#
+# Saída: metricas/<id>.csv por vídeo, resumo.csv com os picos e estado.jsonl com o
+# andamento (com --relatorios, também relatorios/<id>.pdf). Ao rodar de novo sobre a mesma saída, os vídeos já concluídos são pulados.
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import pandas as pd
+
+from biostep_engine import AnalisadorBioStep, calcular_picos, obter_esquema
+
+EXTENSOES_VIDEO = ('.mp4', '.mov')
+ARQUIVO_ESTADO = 'estado.jsonl'
+ARQUIVO_RESUMO = 'resumo.csv'
+PASTA_RELATORIOS = 'relatorios'
+
+
+# lê os pontos de um json lateral: {"pontos": [...]} ou diretamente a lista
+def ler_pontos(caminho_json):
+    with open(caminho_json, encoding='utf-8') as f:
+        dados = json.load(f)
+    pontos = dados['pontos'] if isinstance(dados, dict) else dados
+    return [(float(x), float(y)) for x, y in pontos]
+
+
+# esquema de marcadores pelo nome (ex.: bilateral) ou de um arquivo .json no formato de biostep_engine.ESQUEMAS
+def ler_esquema(valor):
+    if os.path.isfile(valor):
+        with open(valor, encoding='utf-8') as f:
+            return obter_esquema(json.load(f))
+    return obter_esquema(valor)
+
+
+# identificador único do vídeo dentro do lote (caminho relativo sem separadores)
+def id_video(video, raiz):
+    rel = os.path.relpath(os.path.abspath(video), os.path.abspath(raiz))
+    return os.path.splitext(rel)[0].replace(os.sep, '__').replace('/', '__')
+
+
+# monta a lista de tarefas (id, video, pontos) a partir de uma pasta ou de um manifesto
+def listar_tarefas(entrada):
+    tarefas, problemas = [], []
+
+    if os.path.isdir(entrada):
+        for pasta, _, arquivos in os.walk(entrada):
+            for nome in sorted(arquivos):
+                if not nome.lower().endswith(EXTENSOES_VIDEO): continue
+                video = os.path.join(pasta, nome)
+                laterais = [os.path.splitext(video)[0] + '.json', video + '.json']
+                lateral = next((c for c in laterais if os.path.exists(c)), None)
+                if lateral is None:
+                    problemas.append((video, 'arquivo de pontos (.json) não encontrado'))
+                    continue
+                try:
+                    tarefas.append((id_video(video, entrada), video, ler_pontos(lateral)))
+                except (ValueError, KeyError, TypeError) as e:
+                    problemas.append((video, f'pontos inválidos em {lateral}: {e}'))
+    else:
+        raiz = os.path.dirname(os.path.abspath(entrada))
+        with open(entrada, encoding='utf-8') as f:
+            manifesto = json.load(f)
+        for item in manifesto:
+            video = os.path.join(raiz, item['video'])
+            tarefas.append((id_video(video, raiz), video, [(float(x), float(y)) for x, y in item['pontos']]))
+
+    return tarefas, problemas
+
+
+# escreve primeiro em arquivo temporário para não deixar CSV pela metade após uma queda
+def salvar_csv_atomico(df, caminho):
+    tmp = caminho + '.tmp'
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, caminho)
+
+
+# limita as threads internas do OpenCV: o paralelismo vem dos processos
+def _iniciar_processo():
+    cv2.setNumThreads(1)
+
+
+# roda um vídeo em um processo do pool; qualquer erro fica restrito a este vídeo
+def processar_um(id_, video, pontos, caminho_csv, profundidade_fila, opcoes=None):
+    inicio = time.time()
+    registro = {'Video': id_, 'Arquivo': video}
+    try:
+        analise = AnalisadorBioStep(video, id_, **(opcoes or {}))
+        analise.set_pontos(pontos)
+        df = analise.processar_video(profundidade_fila=profundidade_fila)
+        if df.empty: raise ValueError("nenhuma repetição detectada" if analise.janelas == [] else "nenhum frame rastreado")
+        salvar_csv_atomico(df, caminho_csv)
+        registro.update(Status='ok', Frames=len(df), **calcular_picos(df))
+        if 'Repeticao' in df.columns: registro['Repeticoes'] = int(df['Repeticao'].nunique())
+        if 'diagnostico' in df.attrs:
+            # tempo por etapa ao lado do CSV; no resumo fica só a vazão
+            with open(os.path.splitext(caminho_csv)[0] + '.diagnostico.json', 'w', encoding='utf-8') as f:
+                json.dump(df.attrs['diagnostico'], f, indent=2)
+            registro['FPS'] = df.attrs['diagnostico']['fps']
+    except Exception as e:
+        registro.update(Status='erro', Erro=f'{type(e).__name__}: {e}')
+    registro['Tempo (s)'] = round(time.time() - inicio, 2)
+    return registro
+
+
+# lê o estado salvo; o último registro de cada vídeo prevalece
+def carregar_estado(caminho):
+    estado = {}
+    if os.path.exists(caminho):
+        with open(caminho, encoding='utf-8') as f:
+            for linha in f:
+                try:
+                    registro = json.loads(linha)
+                except json.JSONDecodeError:
+                    continue  # linha incompleta de uma execução interrompida
+                estado[registro['Video']] = registro
+    return estado
+
+
+# um PDF por vídeo concluído; os gráficos de todos são renderizados de uma vez
+def gerar_relatorios(saida, registros):
+    from biostep_relatorio import figuras_padrao, gerar_pdfs_lote
+    pasta = os.path.join(saida, PASTA_RELATORIOS)
+    os.makedirs(pasta, exist_ok=True)
+    registros = [r for r in registros if r.get('Status') == 'ok']
+    relatorios = []
+    for r in registros:
+        df = pd.read_csv(os.path.join(saida, 'metricas', r['Video'] + '.csv'))
+        relatorios.append({'nome_paciente': r['Video'], 'df': df, 'figuras': figuras_padrao(df)})
+    for r, pdf in zip(registros, gerar_pdfs_lote(relatorios)):
+        caminho = os.path.join(pasta, r['Video'] + '.pdf')
+        with open(caminho + '.tmp', 'wb') as f:
+            f.write(pdf)
+        os.replace(caminho + '.tmp', caminho)
+    return len(registros)
+
+
+def processar_lote(entrada, saida, processos=None, profundidade_fila=8, refazer=False, opcoes=None, relatorios=False):
+    # opcoes: argumentos extras do AnalisadorBioStep (ex.: reancorar, roi)
+    pasta_metricas = os.path.join(saida, 'metricas')
+    os.makedirs(pasta_metricas, exist_ok=True)
+    caminho_estado = os.path.join(saida, ARQUIVO_ESTADO)
+
+    tarefas, problemas = listar_tarefas(entrada)
+    for video, motivo in problemas:
+        print(f"aviso: {video}: {motivo}", file=sys.stderr)
+
+    # retomada: pula o que já foi concluído e ainda tem o CSV em disco
+    estado = {} if refazer else carregar_estado(caminho_estado)
+    pendentes = [t for t in tarefas
+                 if estado.get(t[0], {}).get('Status') != 'ok'
+                 or not os.path.exists(os.path.join(pasta_metricas, t[0] + '.csv'))]
+    print(f"{len(tarefas)} vídeos, {len(tarefas) - len(pendentes)} já concluídos, {len(pendentes)} pendentes", file=sys.stderr)
+
+    # cada vaga tem um pool de um processo só e roda um vídeo por vez: se o processo morrer
+    # (ex.: falha no decoder), só o vídeo que estava nele é perdido e a vaga ganha um pool novo
+    processos = min(processos or os.cpu_count() or 1, max(1, len(pendentes)))
+    pools = [None] * processos
+    vagas = list(range(processos))
+    fila = list(reversed(pendentes))
+    em_andamento = {}
+    n = 0
+    try:
+        with open(caminho_estado, 'a', encoding='utf-8') as arq_estado:
+            while fila or em_andamento:
+                while fila and vagas:
+                    i = vagas.pop()
+                    id_, video, pontos = fila.pop()
+                    pools[i] = pools[i] or ProcessPoolExecutor(max_workers=1, initializer=_iniciar_processo)
+                    futuro = pools[i].submit(processar_um, id_, video, pontos, os.path.join(pasta_metricas, id_ + '.csv'), profundidade_fila, opcoes)
+                    em_andamento[futuro] = (i, id_, video)
+
+                prontos, _ = wait(em_andamento, return_when=FIRST_COMPLETED)
+                for futuro in prontos:
+                    i, id_, video = em_andamento.pop(futuro)
+                    vagas.append(i)
+                    try:
+                        registro = futuro.result()
+                    except BrokenProcessPool:  # o processo do worker morreu com este vídeo
+                        pools[i].shutdown(wait=False)
+                        pools[i] = None
+                        registro = {'Video': id_, 'Arquivo': video, 'Status': 'erro',
+                                    'Erro': 'BrokenProcessPool: o processo terminou de forma inesperada durante este vídeo'}
+                    except Exception as e:
+                        registro = {'Video': id_, 'Arquivo': video, 'Status': 'erro', 'Erro': f'{type(e).__name__}: {e}'}
+
+                    # grava o andamento imediatamente para permitir a retomada após uma queda
+                    arq_estado.write(json.dumps(registro, ensure_ascii=False) + '\n')
+                    arq_estado.flush()
+                    os.fsync(arq_estado.fileno())
+                    estado[id_] = registro
+
+                    n += 1
+                    detalhe = f"{registro.get('Frames', 0)} frames, {registro.get('Tempo (s)', 0)} s" if registro['Status'] == 'ok' else registro['Erro']
+                    print(f"[{n}/{len(pendentes)}] {id_}: {registro['Status']} ({detalhe})", file=sys.stderr)
+    finally:
+        for pool in pools:
+            if pool is not None: pool.shutdown()
+
+    # tabela resumo com todos os vídeos do lote, inclusive os de execuções anteriores
+    ids = {t[0] for t in tarefas}
+    resumo = pd.DataFrame([r for v, r in estado.items() if v in ids])
+    if not resumo.empty:
+        salvar_csv_atomico(resumo, os.path.join(saida, ARQUIVO_RESUMO))
+        if relatorios:
+            n = gerar_relatorios(saida, resumo.to_dict('records'))
+            print(f"{n} relatórios PDF -> {os.path.join(saida, PASTA_RELATORIOS)}", file=sys.stderr)
+    return resumo
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Processa em lote vídeos do teste Step Down com o BioStep Analyzer.")
+    parser.add_argument('entrada', help="pasta com vídeos e arquivos .json de pontos, ou manifesto .json")
+    parser.add_argument('--saida', default='resultados_biostep', help="pasta de saída (padrão: %(default)s)")
+    parser.add_argument('--processos', type=int, default=None, help="processos em paralelo (padrão: núcleos disponíveis)")
+    parser.add_argument('--profundidade-fila', type=int, default=8, help="frames pré-carregados por vídeo (0 = leitura sequencial)")
+    parser.add_argument('--refazer', action='store_true', help="ignora o estado salvo e processa tudo de novo")
+    parser.add_argument('--esquema', default='padrao', help="esquema de marcadores: padrao, bilateral ou arquivo .json (padrão: %(default)s)")
+    parser.add_argument('--reancorar', action='store_true', help="reancora pela cor os pontos perdidos pelo fluxo óptico")
+    parser.add_argument('--roi', action='store_true', help="rastreia só a região dos marcadores, na resolução original (vídeos 1080p/4K)")
+    parser.add_argument('--segmentar', action='store_true', help="rastreia só as repetições detectadas (coluna Repeticao nos CSVs)")
+    parser.add_argument('--buffers-fixos', action='store_true', help="frames e pirâmides em buffers pré-alocados (memória estável em vídeos longos)")
+    parser.add_argument('--blocos', type=int, default=0, help="divide cada vídeo longo em N trechos rastreados em paralelo (use com menos --processos; não combina com --segmentar)")
+    parser.add_argument('--relatorios', action='store_true', help="gera um relatório PDF por vídeo concluído")
+    parser.add_argument('--diagnostico', action='store_true', help="mede o tempo por etapa (metricas/<id>.diagnostico.json e coluna FPS no resumo)")
+    args = parser.parse_args(argv)
+    if args.blocos > 1 and args.segmentar:
+        parser.error("--blocos não combina com --segmentar (os trechos paralelos não seguem as janelas das repetições)")
+    try:
+        esquema = ler_esquema(args.esquema)
+    except (OSError, ValueError) as e:
+        parser.error(f"--esquema: {e}")
+
+    opcoes = {'reancorar': args.reancorar, 'roi': args.roi, 'segmentar': args.segmentar, 'instrumentar': args.diagnostico,
+              'buffers_fixos': args.buffers_fixos, 'blocos_paralelos': args.blocos, 'esquema': esquema}
+    resumo = processar_lote(args.entrada, args.saida, args.processos, args.profundidade_fila, args.refazer, opcoes, args.relatorios)
+    falhas = int((resumo['Status'] != 'ok').sum()) if not resumo.empty else 0
+    print(f"concluído: {len(resumo) - falhas} ok, {falhas} com erro -> {os.path.join(args.saida, ARQUIVO_RESUMO)}", file=sys.stderr)
+    return 1 if falhas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+# Relatórios PDF do BioStep Analyzer
+#
+# Os gráficos são rasterizados uma única vez por conteúdo: a imagem fica guardada pelo
+# hash do JSON da figura, então gerar o mesmo relatório de novo não passa pelo kaleido.
+# As figuras que faltam são renderizadas juntas em uma única sessão do kaleido
+# (pio.write_images); sem o Chrome do kaleido, um rasterizador com OpenCV desenha os
+# gráficos de linha no próprio processo. Os PNGs vão para uma pasta temporária que é
+# apagada mesmo se a geração falhar (o fpdf 1.7 só aceita imagens por caminho).
+import hashlib
+import os
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+import plotly.express as px
+import plotly.io as pio
+from fpdf import FPDF
+
+from biostep_engine import calcular_picos, lados_resultado, resumo_repeticoes, reduzir_df, PONTOS_GRAFICO
+
+LARGURA_IMAGEM, ALTURA_IMAGEM = 800, 400
+MAX_IMAGENS_CACHE = 64
+
+# 'auto': kaleido e, se ele não estiver disponível, OpenCV; 'kaleido' ou 'opencv' forçam um dos dois
+MOTOR_IMAGENS = os.environ.get('BIOSTEP_MOTOR_IMAGENS', 'auto')
+
+_imagens = OrderedDict()  # hash -> PNG (bytes), do menos para o mais usado
+_trava = threading.Lock()
+_kaleido_indisponivel = False
+
+
+#Função PDF
+class  PDFReport(FPDF):
+    def header(self):
+        self.set_font('Arial', 'B', 12)
+        self.cell(0, 10, 'Relatório BioStep Analyzer', 0, 1, 'C')
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Arial', 'I', 8)
+        self.cell(0, 10, f'Página {self.page_no()}', 0, 0, 'C')
+
+
+# gráficos padrão da análise individual (ângulo, desvio e pelve), com no máximo max_pontos por curva;
+# na avaliação bilateral, ângulo e desvio têm uma curva por lado. Sem a coluna Queda Pelvica
+# (esquema sem 'pelve'), o gráfico da pelve é None
+def figuras_padrao(df, max_pontos=PONTOS_GRAFICO):
+    lados = lados_resultado(df)
+    angulos = [f"Angulo Joelho{sufixo}" for sufixo in lados]
+    desvios = [f"Desvio Valgo{sufixo} (px)" for sufixo in lados]
+    y = lambda colunas: colunas[0] if len(colunas) == 1 else colunas
+    pelve = None
+    if 'Queda Pelvica' in df.columns:
+        pelve = px.line(reduzir_df(df, "Queda Pelvica", max_pontos), x="Frame", y="Queda Pelvica", title="Pelve")
+    return (px.line(reduzir_df(df, angulos, max_pontos), x="Frame", y=y(angulos), title="Ângulo Joelho"),
+            px.line(reduzir_df(df, desvios, max_pontos), x="Frame", y=y(desvios), title="Desvio Linear"),
+            pelve)
+
+# gráfico do ângulo do joelho com uma curva por período (Antes/Depois); na avaliação bilateral,
+# uma curva por período e lado (o traço diferencia os lados)
+def figura_comparacao(df, max_pontos=PONTOS_GRAFICO):
+    angulos = [f"Angulo Joelho{sufixo}" for sufixo in lados_resultado(df)]
+    cores = {"Antes":"red", "Depois":"green"}
+    if len(angulos) == 1:
+        return px.line(reduzir_df(df, angulos[0], max_pontos, grupo="Periodo"), x="Frame", y=angulos[0], color="Periodo",
+                       title="Comparativo: Ângulo Q Dinâmico", color_discrete_map=cores)
+    longo = reduzir_df(df, angulos, max_pontos, grupo="Periodo").melt(
+        id_vars=["Frame", "Periodo"], value_vars=angulos, var_name="Lado", value_name="Angulo Joelho")
+    longo["Lado"] = longo["Lado"].str[len("Angulo Joelho"):].str.strip()
+    return px.line(longo, x="Frame", y="Angulo Joelho", color="Periodo", line_dash="Lado",
+                   title="Comparativo: Ângulo Q Dinâmico", color_discrete_map=cores)
+
+
+# --- Rasterização dos gráficos ---
+
+def _chave_figura(fig, largura, altura):
+    return hashlib.sha256(f'{largura}x{altura}:{fig.to_json()}'.encode('utf-8')).hexdigest()
+
+def _guardar_imagem(chave, png):
+    with _trava:
+        _imagens[chave] = png
+        _imagens.move_to_end(chave)
+        while len(_imagens) > MAX_IMAGENS_CACHE: _imagens.popitem(last=False)
+
+def _obter_imagem(chave):
+    with _trava:
+        png = _imagens.get(chave)
+        if png is not None: _imagens.move_to_end(chave)
+        return png
+
+def limpar_cache_imagens():
+    with _trava:
+        _imagens.clear()
+
+# cores: hex (#rrggbb) ou os nomes usados nos gráficos; o resto segue a paleta padrão do plotly
+_CORES_NOMEADAS = {'red': (0, 0, 255), 'green': (0, 128, 0), 'blue': (255, 0, 0), 'black': (0, 0, 0),
+                   'orange': (0, 165, 255), 'purple': (128, 0, 128), 'gray': (128, 128, 128)}
+_PALETA = ['#636efa', '#EF553B', '#00cc96', '#ab63fa', '#FFA15A', '#19d3f3', '#FF6692', '#B6E880']
+
+def _cor_bgr(cor, i):
+    cor = (cor or _PALETA[i % len(_PALETA)]).strip()
+    if cor.startswith('#') and len(cor) == 7:
+        return tuple(int(cor[k:k + 2], 16) for k in (5, 3, 1))
+    return _CORES_NOMEADAS.get(cor.lower(), _cor_bgr(None, i))
+
+def _ascii(texto):
+    # a fonte do OpenCV só tem ASCII: remove os acentos
+    return unicodedata.normalize('NFKD', str(texto or '')).encode('ascii', 'ignore').decode('ascii')
+
+def _marcas(minimo, maximo, n=5):
+    # marcas "redondas" (passo 1, 2 ou 5 x 10^k) cobrindo o intervalo
+    bruto = (maximo - minimo) / n
+    base = 10 ** np.floor(np.log10(bruto))
+    passo = next(m * base for m in (1, 2, 5, 10) if m * base >= bruto)
+    return np.arange(np.ceil(minimo / passo) * passo, maximo + passo * 1e-9, passo)
+
+def _texto(valor):
+    return f'{valor:g}' if abs(valor) < 1e5 else f'{valor:.2e}'
+
+# desenha os traços de linha de uma figura do plotly (px.line) com o OpenCV
+def rasterizar_opencv(fig, largura=LARGURA_IMAGEM, altura=ALTURA_IMAGEM):
+    tracos = []
+    for i, traco in enumerate(fig.data):
+        if traco.x is None or traco.y is None: continue
+        x, y = np.asarray(traco.x, dtype=np.float64), np.asarray(traco.y, dtype=np.float64)
+        if len(x): tracos.append((x, y, _ascii(traco.name), _cor_bgr(traco.line.color, i)))
+
+    img = np.full((altura, largura, 3), 255, np.uint8)
+    fonte, preto, cinza = cv2.FONT_HERSHEY_SIMPLEX, (40, 40, 40), (225, 225, 225)
+    legenda = len(tracos) > 1 and any(nome for *_, nome, _ in tracos)
+    esq, dir_, topo, base = 70, largura - (130 if legenda else 20), 50, altura - 50
+
+    cv2.putText(img, _ascii(fig.layout.title.text), (esq, 26), fonte, 0.7, preto, 2, cv2.LINE_AA)
+    cv2.putText(img, _ascii(fig.layout.xaxis.title.text), ((esq + dir_) // 2 - 20, altura - 12), fonte, 0.5, preto, 1, cv2.LINE_AA)
+    cv2.putText(img, _ascii(fig.layout.yaxis.title.text), (8, topo - 6), fonte, 0.45, preto, 1, cv2.LINE_AA)
+
+    validos = [(x[np.isfinite(y)], y[np.isfinite(y)]) for x, y, *_ in tracos]
+    validos = [(x, y) for x, y in validos if len(x)]
+    if validos:
+        x_min, x_max = min(x.min() for x, _ in validos), max(x.max() for x, _ in validos)
+        y_min, y_max = min(y.min() for _, y in validos), max(y.max() for _, y in validos)
+        if x_max == x_min: x_min, x_max = x_min - 1, x_max + 1
+        folga = (y_max - y_min) * 0.05 or 1.0
+        y_min, y_max = y_min - folga, y_max + folga
+
+        def px_(x, y):
+            # coordenadas do gráfico -> pixels (x16 para o desenho com precisão subpixel)
+            u = esq + (x - x_min) / (x_max - x_min) * (dir_ - esq)
+            v = base - (y - y_min) / (y_max - y_min) * (base - topo)
+            return np.round(np.stack([u, v], axis=-1) * 16).astype(np.int32)
+
+        for valor in _marcas(y_min, y_max):
+            v = int(round(base - (valor - y_min) / (y_max - y_min) * (base - topo)))
+            cv2.line(img, (esq, v), (dir_, v), cinza, 1)
+            cv2.putText(img, _texto(valor), (8, v + 4), fonte, 0.4, preto, 1, cv2.LINE_AA)
+        for valor in _marcas(x_min, x_max):
+            u = int(round(esq + (valor - x_min) / (x_max - x_min) * (dir_ - esq)))
+            cv2.line(img, (u, base), (u, base + 5), preto, 1)
+            cv2.putText(img, _texto(valor), (u - 12, base + 20), fonte, 0.4, preto, 1, cv2.LINE_AA)
+
+        for x, y, _, cor in tracos:
+            # NaN interrompe a linha
+            ok = np.isfinite(x) & np.isfinite(y)
+            bordas = np.flatnonzero(np.diff(np.concatenate(([0], ok.astype(np.int8), [0]))))
+            linhas = [px_(x[a:b], y[a:b]) for a, b in zip(bordas[::2], bordas[1::2])]
+            cv2.polylines(img, linhas, False, cor, 2, cv2.LINE_AA, shift=4)
+
+    cv2.rectangle(img, (esq, topo), (dir_, base), preto, 1)
+    if legenda:
+        for i, (*_, nome, cor) in enumerate(tracos):
+            v = topo + 15 + 22 * i
+            cv2.line(img, (dir_ + 12, v), (dir_ + 37, v), cor, 3, cv2.LINE_AA)
+            cv2.putText(img, nome, (dir_ + 44, v + 5), fonte, 0.45, preto, 1, cv2.LINE_AA)
+
+    return cv2.imencode('.png', img)[1].tobytes()
+
+# uma única sessão do kaleido (um Chrome) para todas as figuras
+def _rasterizar_kaleido(figs, largura, altura):
+    with tempfile.TemporaryDirectory(prefix='biostep_kaleido_') as pasta:
+        caminhos = [os.path.join(pasta, f'{i}.png') for i in range(len(figs))]
+        pio.write_images(list(figs), caminhos, width=largura, height=altura)
+        pngs = []
+        for caminho in caminhos:
+            with open(caminho, 'rb') as f:
+                pngs.append(f.read())
+        return pngs
+
+# PNGs das figuras, na mesma ordem; só as que não estão no cache são renderizadas
+def renderizar_figuras(figs, largura=LARGURA_IMAGEM, altura=ALTURA_IMAGEM, motor=None, max_workers=None):
+    global _kaleido_indisponivel
+    motor = motor or MOTOR_IMAGENS
+    chaves = [_chave_figura(fig, largura, altura) for fig in figs]
+    pngs = [_obter_imagem(chave) for chave in chaves]
+
+    # figuras repetidas no mesmo pedido são renderizadas uma vez
+    faltando = {}
+    for fig, chave, png in zip(figs, chaves, pngs):
+        if png is None: faltando.setdefault(chave, fig)
+
+    if faltando:
+        novos = None
+        if motor == 'kaleido' or (motor == 'auto' and not _kaleido_indisponivel):
+            try:
+                novos = _rasterizar_kaleido(faltando.values(), largura, altura)
+            except (RuntimeError, OSError, ValueError, ImportError):
+                if motor == 'kaleido': raise
+                _kaleido_indisponivel = True  # sem Chrome: não tenta de novo neste processo
+        if novos is None:
+            with ThreadPoolExecutor(max_workers or min(len(faltando), os.cpu_count() or 1)) as pool:
+                novos = list(pool.map(lambda fig: rasterizar_opencv(fig, largura, altura), faltando.values()))
+        novos = dict(zip(faltando, novos))
+        for chave, png in novos.items():
+            _guardar_imagem(chave, png)
+        pngs = [png if png is not None else novos[chave] for chave, png in zip(chaves, pngs)]
+    return pngs
+
+
+# --- PDF ---
+
+#Função para gerar relatório PDF
+def gerar_pdf(nome_paciente, df, fig_ang, fig_desvio, fig_pelve, tipo_analise="Individual"):
+    imagens = renderizar_figuras([fig for fig in (fig_ang, fig_desvio, fig_pelve) if fig])
+    return _montar_pdf(nome_paciente, df, imagens, tipo_analise)
+
+# monta o PDF com os gráficos já rasterizados (PNG)
+def _montar_pdf(nome_paciente, df, imagens, tipo_analise):
+    pdf = PDFReport()
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+
+    #  dados do paciente
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0,10, f"Paciente: {nome_paciente}", 0,1)
+    pdf.cell(0,10, f"Data: {datetime.now().strftime('%d/%m/%Y')}", 0,1)
+    pdf.cell(0,10, f"Tipo de Análise: {tipo_analise}", 0,1)
+
+    # resumo dos dados
+    pdf.set_font("Arial", 'B', 14)
+    pdf.cell(0, 10, 'Resumo das Métricas Principais', 0, 1)
+    pdf.set_font("Arial", size=11)
+
+    # extrair metricas dependendo  do tipo de análise (um bloco por lado na avaliação bilateral)
+    lados = lados_resultado(df)
+    if 'Periodo' in df.columns: # Comparação
+        for sufixo in lados:
+            valgo_antes = df[df['Periodo']=='Antes'][f'Angulo Joelho{sufixo}'].min()
+            valgo_depois = df[df['Periodo']=='Depois'][f'Angulo Joelho{sufixo}'].min()
+            pdf.cell(0, 8, f"Angulo Minimo{sufixo} (Antes): {valgo_antes:.1f} graus", 0, 1)
+            pdf.cell(0, 8, f"Angulo Minimo{sufixo} (Depois): {valgo_depois:.1f} graus", 0, 1)
+            pdf.cell(0, 8, f"Evolucao{sufixo}: {valgo_depois - valgo_antes:.1f} graus", 0, 1)
+    else: # Individual
+        picos = calcular_picos(df)
+        for sufixo in lados:
+            pdf.cell(0, 8, f"Angulo Minimo de Valgo{sufixo}: {picos[f'Angulo Minimo{sufixo}']:.1f} graus", 0, 1)
+            pdf.cell(0, 8, f"Desvio Medial Maximo{sufixo}: {picos[f'Desvio Maximo{sufixo}']:.1f} px", 0, 1)
+        if 'Queda Pelvica' in picos:
+            pdf.cell(0, 8, f"Queda Pelvica Maxima: {picos['Queda Pelvica']:.1f} graus", 0, 1)
+
+        # picos de cada repetição (modo segmentado)
+        if 'Repeticao' in df.columns:
+            pdf.ln(3)
+            pdf.set_font("Arial", 'B', 11)
+            pdf.cell(0, 8, 'Picos por Repeticao', 0, 1)
+            pdf.set_font("Arial", size=10)
+            for r in resumo_repeticoes(df):
+                partes = [f"angulo min.{sufixo} {r[f'Angulo Minimo{sufixo}']:.1f} graus, "
+                          f"desvio max.{sufixo} {r[f'Desvio Maximo{sufixo}']:.1f} px" for sufixo in lados]
+                if 'Queda Pelvica' in r: partes.append(f"queda pelvica {r['Queda Pelvica']:.1f} graus")
+                pdf.multi_cell(0, 7, f"Repeticao {r['Repeticao']} (frames {r['Frame Inicial']}-{r['Frame Final']}): "
+                                     + ", ".join(partes))
+
+    pdf.ln(5)
+
+    # inserir graficos; a pasta temporária é apagada mesmo se algo falhar
+    with tempfile.TemporaryDirectory(prefix='biostep_pdf_') as pasta:
+        for i, png in enumerate(imagens):
+            caminho = os.path.join(pasta, f'grafico_{i}.png')
+            with open(caminho, 'wb') as f:
+                f.write(png)
+            pdf.image(caminho, x=10, w=190)
+            pdf.ln(5)
+        return pdf.output(dest='S').encode('latin-1')
+
+# vários relatórios de uma vez: as figuras de todos são renderizadas juntas antes
+# relatorios: lista de dicts com nome_paciente, df, figuras (lista) e, opcionalmente, tipo_analise
+# Retorna a lista de PDFs (bytes) na mesma ordem
+def gerar_pdfs_lote(relatorios):
+    figs = [[fig for fig in r['figuras'] if fig] for r in relatorios]
+    todas = renderizar_figuras([fig for lista in figs for fig in lista])
+    pdfs, inicio = [], 0
+    for r, lista in zip(relatorios, figs):
+        imagens = todas[inicio:inicio + len(lista)]
+        inicio += len(lista)
+        pdfs.append(_montar_pdf(r['nome_paciente'], r['df'], imagens, r.get('tipo_analise', "Individual")))
+    return pdfs
@@ -1,14 +1,11 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
 import tempfile
 import os
-import cv2
-import numpy as np
+import time
 from datetime import datetime
-from fpdf import FPDF
-from streamlit_image_coordinates import streamlit_image_coordinates
-from biostep_engine import AnalisadorBioStep, refinar_ponto_pela_cor
+from biostep_cache import CacheResultados, hash_bytes
+# pandas, plotly, OpenCV, fpdf e o motor são importados só nas páginas e funções que os usam:
+# as páginas informativas (Início, Como Usar, Metodologia) abrem sem carregá-los
 
 # Configuração da Página
 st.set_page_config(page_title="BioStep Analyzer", layout="wide", page_icon="🦵")
@@ -32,91 +29,351 @@ OPT_COMO_USAR = "📖 Como Usar"
 OPT_METODOLOGIA = "📐 Metodologia"
 OPT_INDIVIDUAL = "📂 Análise Individual"
 OPT_COMPARACAO = "🔄 Comparação (Antes/Depois)"
+OPT_HISTORICO = "🗂️ Histórico"
+OPT_TAREFAS = "⏳ Análises em Andamento"
 
 opcao_menu = st.sidebar.radio(
     "Escolha uma opção:",
-    [OPT_INICIO, OPT_COMO_USAR, OPT_METODOLOGIA, OPT_INDIVIDUAL, OPT_COMPARACAO]
+    [OPT_INICIO, OPT_COMO_USAR, OPT_METODOLOGIA, OPT_INDIVIDUAL, OPT_COMPARACAO, OPT_HISTORICO, OPT_TAREFAS]
 )
 
-# Função para salvar vídeo
+# profissional que está usando o painel: as análises em segundo plano são separadas (e limitadas) por usuário.
+# O nome fica na URL (?usuario=...), então continua valendo ao recarregar a página ou abrir outra aba
+usuario = st.sidebar.text_input("👤 Profissional", st.query_params.get('usuario', ''),
+                                help="Identifica as suas análises na fila. Use o mesmo nome para acompanhá-las de outra aba ou computador.")
+if usuario != st.query_params.get('usuario', ''):
+    st.query_params['usuario'] = usuario
+usuario = usuario.strip() or "anonimo"
+
+# Cache de resultados compartilhado entre reruns e sessões
+@st.cache_resource
+def obter_cache():
+    return CacheResultados()
+
+# Histórico de sessões salvas (trajetórias e métricas por paciente)
+@st.cache_resource
+def obter_armazem():
+    from biostep_armazem import ArmazemSessoes
+    return ArmazemSessoes()
+
+# Fila de análises em segundo plano (um pool de processos para todo o servidor)
+@st.cache_resource
+def obter_gerenciador():
+    from biostep_jobs import GerenciadorTarefas
+    return GerenciadorTarefas()
+
+if st.sidebar.button("🧹 Limpar cache de resultados"):
+    obter_cache().invalidar()
+    st.sidebar.success("Cache limpo.")
+
+# pontos por curva enviados ao navegador (barra lateral das páginas com gráficos);
+# os picos de cada curva são sempre mantidos
+def limite_pontos():
+    from biostep_engine import PONTOS_GRAFICO
+    return st.sidebar.number_input("Pontos por curva nos gráficos", min_value=200, max_value=50000, value=PONTOS_GRAFICO, step=100,
+                                   help="Gravações longas ou com fps alto são reduzidas a este número de pontos por curva, mantendo os mínimos e máximos. Escolha um intervalo de frames menor para ver todos os pontos.")
+
+# esquema de marcadores escolhido antes da marcação (nome em ESQUEMAS)
+def escolher_esquema(key_suffix):
+    from biostep_engine import ESQUEMAS
+    nomes = {'padrao': "Uma perna (5 pontos, perna de apoio)", 'bilateral': "Bilateral (7 pontos, as duas pernas)"}
+    return st.radio("Marcadores", list(ESQUEMAS), format_func=lambda nome: nomes.get(nome, nome), horizontal=True,
+                    key=f"esquema_{key_suffix}", help="Na avaliação bilateral, joelho e tornozelo das duas pernas são rastreados no mesmo processamento, com ângulo e desvio de cada lado.")
+
+# picos da análise em colunas de métricas (um par ângulo/desvio por lado)
+ROTULOS_PICOS = {'Angulo Minimo': ("Pico Valgo", "°"), 'Desvio Maximo': ("Desvio Máx", " px"), 'Queda Pelvica': ("Queda Pélvica", "°")}
+
+def mostrar_picos(picos):
+    for coluna, (nome, valor) in zip(st.columns(len(picos)), picos.items()):
+        base = next(b for b in ROTULOS_PICOS if nome.startswith(b))
+        rotulo, unidade = ROTULOS_PICOS[base]
+        coluna.metric(rotulo + nome[len(base):], f"{valor:.1f}{unidade}")
+
+# proporção do frame de referência, escolhida antes da marcação (os pontos são marcados nele).
+# Sem ela, todo vídeo é redimensionado para 480x850 e um vídeo paisagem fica esticado; por isso
+# vem marcada quando algum dos vídeos (caminho, hash) é paisagem
+def escolher_aspecto(key_suffix, *videos):
+    formatos = [carregar_frame_inicial(hash_video, path, True)[0].shape for path, hash_video in videos]
+    paisagem = any(largura > altura for altura, largura, _ in formatos)
+    return st.checkbox("📐 Manter a proporção do vídeo", value=paisagem, key=f"aspecto_{key_suffix}",
+                       help="O vídeo é analisado na proporção original em vez de 480x850. Recomendado para vídeos gravados na horizontal, que de outro modo ficam distorcidos.")
+
+# opções do rastreamento (repassadas ao AnalisadorBioStep)
+def opcoes_rastreamento(key_suffix, esquema='padrao', preservar_aspecto=False):
+    with st.expander("⚙️ Opções de rastreamento"):
+        reancorar = st.checkbox("🧲 Reancorar marcadores perdidos automaticamente", key=f"reancorar_{key_suffix}",
+                                help="Quando o fluxo óptico perde um ponto, ele é recolocado no centro do marcador amarelo mais próximo. Adiciona colunas de confiança por ponto aos dados.")
+        roi = st.checkbox("⚡ Rastrear só a região dos marcadores", key=f"roi_{key_suffix}",
+                          help="Recomendado para vídeos 1080p/4K: o fluxo óptico roda em um recorte ao redor dos pontos, na resolução original.")
+        segmentar = st.checkbox("🔁 Detectar repetições", key=f"segmentar_{key_suffix}",
+                                help="Processa só os trechos com movimento (ignora o tempo parado antes e depois) e mostra os picos de cada repetição.")
+        blocos = st.checkbox("🧩 Dividir vídeos longos entre os núcleos", key=f"blocos_{key_suffix}", disabled=segmentar,
+                             help="Gravações longas são divididas em trechos rastreados ao mesmo tempo, um por núcleo do servidor, e emendadas pela posição dos marcadores. Não combina com a detecção de repetições.")
+        instrumentar = st.checkbox("🩺 Coletar diagnóstico de desempenho", key=f"instrumentar_{key_suffix}",
+                                   help="Mede o tempo de cada etapa (decodificação, resize, fluxo óptico, métricas...) e conta os pontos perdidos. Não altera os resultados.")
+    return {'reancorar': reancorar, 'roi': roi, 'segmentar': segmentar, 'instrumentar': instrumentar,
+            'blocos_paralelos': (os.cpu_count() or 1) if blocos and not segmentar else 0, 'esquema': esquema,
+            'preservar_aspecto': preservar_aspecto}
+
+# o cache guarda o DataFrame e a trajetória (para salvar no histórico sem rastrear de novo)
+def obter_do_cache(cache, chave):
+    valor = cache.obter(chave)
+    if isinstance(valor, dict): return valor['df'], valor['trajetoria']
+    return None, None  # ausente, ou entrada antiga só com o DataFrame
+
+# guarda o resultado sem o diagnóstico: ele descreve a execução, não o resultado
+def guardar_no_cache(cache, chave, df, trajetoria):
+    diagnostico = df.attrs.pop('diagnostico', None)
+    cache.guardar(chave, {'df': df, 'trajetoria': trajetoria})
+    if diagnostico is not None: df.attrs['diagnostico'] = diagnostico
+
+# resultado sem nenhum frame rastreado: no modo 🔁 Detectar repetições (coluna Repeticao) o vídeo não teve
+# nenhuma repetição; fora dele, o rastreamento parou já no primeiro frame
+def avisar_resultado_vazio(df, rotulo=""):
+    if not df.empty: return
+    em = f" em {rotulo}" if rotulo else ""
+    if 'Repeticao' in df.columns:
+        st.warning(f"Nenhuma repetição detectada{em}: nenhum frame foi rastreado. "
+                   "Desmarque **🔁 Detectar repetições** para analisar o vídeo inteiro.")
+    else:
+        st.warning(f"Nenhum frame rastreado{em}: o rastreamento parou no início do vídeo. Confira os pontos marcados.")
+
+# filtra o intervalo de frames escolhido; intervalos menores cabem no limite de pontos em resolução total
+def intervalo_frames(df, key_suffix):
+    if df.empty: return df
+    inicio, fim = int(df['Frame'].min()), int(df['Frame'].max())
+    if fim <= inicio: return df
+    escolhido = st.slider("🔍 Intervalo de frames", inicio, fim, (inicio, fim), key=f"intervalo_{key_suffix}")
+    if escolhido == (inicio, fim): return df
+    return df[df['Frame'].between(*escolhido)]
+
+# painel com o tempo por etapa e os contadores do rastreamento (opção instrumentar)
+def painel_diagnostico(diagnostico, titulo="🩺 Diagnóstico de desempenho"):
+    import pandas as pd
+    with st.expander(titulo):
+        if not diagnostico:
+            st.info("Resultado reaproveitado do cache: nenhum frame foi rastreado nesta execução.")
+            return
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Frames", diagnostico['frames'])
+        c2.metric("Vazão", f"{diagnostico['fps']} fps")
+        c3.metric("Duração", f"{diagnostico['duracao_s']:.2f} s")
+        etapas = pd.DataFrame.from_dict(diagnostico['etapas'], orient='index')
+        st.dataframe(etapas.sort_values('total_ms', ascending=False))
+        st.json({'contadores': diagnostico['contadores'], 'erro_lk': diagnostico.get('erro_lk')})
+
+# processa o vídeo, reaproveitando o resultado se o mesmo vídeo já foi rastreado com os mesmos pontos
+# retorna (DataFrame, trajetória, parâmetros do rastreamento)
+def processar_com_cache(path, hash_video, pontos, titulo="Analise", ao_vivo=False, max_pontos=None, **opcoes):
+    from biostep_engine import AnalisadorBioStep
+    cache = obter_cache()
+    analise = AnalisadorBioStep(path, titulo, **opcoes)  # o vídeo só é aberto se precisar rastrear
+    parametros = analise.parametros_rastreamento()
+    chave = cache.chave(hash_video, pontos, parametros)
+    df, trajetoria = obter_do_cache(cache, chave)
+    if df is None:
+        analise.set_pontos(pontos)
+        df = processar_ao_vivo(analise, max_pontos=max_pontos) if ao_vivo else analise.processar_video()
+        trajetoria = analise.trajetoria
+        guardar_no_cache(cache, chave, df, trajetoria)
+    return df, trajetoria, parametros
+
+# envia as análises para a fila em segundo plano; as que já estão no cache ficam prontas na hora.
+# As sessões de um mesmo envio formam um grupo: ocupam uma só vaga do usuário e rodam juntas.
+# sessoes: dict rotulo -> (caminho, hash, pontos). O pedido fica em st.session_state[chave]
+# ({rotulo: id da tarefa ou (DataFrame, trajetória, parâmetros)}) e sobrevive aos reruns
+def enviar_analises(chave, sessoes, usuario, **opcoes):
+    from biostep_engine import AnalisadorBioStep
+    cache, gerenciador = obter_cache(), obter_gerenciador()
+    pedido = {}
+    grupo = f"{chave}-{time.time_ns()}"
+    for rotulo, (path, hash_video, pontos) in sessoes.items():
+        parametros = AnalisadorBioStep(path, rotulo, **opcoes).parametros_rastreamento()
+        chave_cache = cache.chave(hash_video, pontos, parametros)
+        df, trajetoria = obter_do_cache(cache, chave_cache)
+        if df is None:
+            pedido[rotulo] = gerenciador.enviar(usuario, path, pontos, rotulo, opcoes, dados={'chave_cache': chave_cache}, grupo=grupo)
+        else:
+            pedido[rotulo] = (df, trajetoria, parametros)
+    st.session_state[chave] = pedido
+
+# resultado de uma tarefa concluída como (DataFrame, trajetória, parâmetros), guardado também no cache; ou a
+# mensagem de erro. Os parâmetros vêm das opções com que a tarefa rodou
+def resultado_tarefa(estado):
+    from biostep_engine import AnalisadorBioStep
+    from biostep_jobs import EM_ANDAMENTO
+    if estado is None: return "análise não encontrada (apagada da fila)"
+    if estado['status'] in EM_ANDAMENTO: return None
+    if estado['status'] == 'cancelada': return "análise cancelada"
+    resultado = obter_gerenciador().resultado(estado['id']) if estado['status'] == 'concluida' else None
+    if resultado is None: return estado.get('erro') or "resultado não encontrado"
+    if 'chave_cache' in estado['dados']:
+        guardar_no_cache(obter_cache(), estado['dados']['chave_cache'], resultado['df'], resultado['trajetoria'])
+    parametros = AnalisadorBioStep(estado['video'], **estado['opcoes']).parametros_rastreamento()
+    return resultado['df'], resultado['trajetoria'], parametros
+
+# quando todas as análises de st.session_state[chave] terminaram, retira o pedido e devolve
+# ({rotulo: (DataFrame, trajetória, parâmetros)}, {rotulo: erro}); enquanto alguma estiver em andamento, devolve None
+def coletar_analises(chave):
+    from biostep_jobs import EM_ANDAMENTO
+    pedido = st.session_state.get(chave)
+    if not pedido: return None
+    gerenciador = obter_gerenciador()
+    estados = {rotulo: gerenciador.estado(valor) for rotulo, valor in pedido.items() if isinstance(valor, str)}
+    if any(e is not None and e['status'] in EM_ANDAMENTO for e in estados.values()): return None
+
+    del st.session_state[chave]
+    resultados, erros = {}, {}
+    for rotulo, valor in pedido.items():
+        valor = resultado_tarefa(estados[rotulo]) if rotulo in estados else valor
+        if isinstance(valor, str): erros[rotulo] = valor
+        else: resultados[rotulo] = valor
+    return resultados, erros
+
+def texto_andamento(rotulo, estado):
+    if estado['status'] == 'na_fila':
+        return f"{rotulo}: na fila ({estado['posicao_fila']}º)"
+    if estado['total']:
+        return f"{rotulo}: {estado['feitos']}/{estado['total']} frames"
+    return f"{rotulo}: iniciando..."
+
+# andamento das análises de st.session_state[chave]. O fragmento se atualiza sozinho a cada segundo,
+# sem bloquear o resto da página; quando todas terminam, recarrega a página para coletar_analises.
+# Chamar depois de coletar_analises (senão o recarregamento se repete)
+@st.fragment(run_every=1)
+def acompanhar_analises(chave):
+    from biostep_jobs import EM_ANDAMENTO
+    pedido = st.session_state.get(chave)
+    if not pedido: return
+    gerenciador = obter_gerenciador()
+    ids = {rotulo: valor for rotulo, valor in pedido.items() if isinstance(valor, str)}
+    estados = {rotulo: gerenciador.estado(id_tarefa) for rotulo, id_tarefa in ids.items()}
+    if all(e is None or e['status'] not in EM_ANDAMENTO for e in estados.values()):
+        st.rerun()
+
+    for rotulo, estado in estados.items():
+        if estado is None: continue
+        fracao = min(estado['feitos'] / estado['total'], 1.0) if estado['total'] else 0.0
+        st.progress(fracao, text=texto_andamento(rotulo, estado))
+    st.caption("A análise continua no servidor mesmo se você sair desta página; acompanhe em ⏳ Análises em Andamento.")
+    if st.button("⏹️ Cancelar", key=f"cancelar_{chave}"):
+        for id_tarefa in ids.values(): gerenciador.cancelar(id_tarefa)
+
+# processa mostrando o progresso e o gráfico do joelho sendo desenhado durante o rastreamento.
+# Clicar em qualquer botão (ex.: Cancelar) reinicia o script e interrompe o processamento.
+def processar_ao_vivo(analise, tamanho_bloco=60, intervalo_grafico=0.5, max_pontos=None):
+    import pandas as pd
+    from biostep_engine import reduzir_df, colunas_metricas, PONTOS_GRAFICO
+    max_pontos = max_pontos or PONTOS_GRAFICO
+    angulos = [c for c in colunas_metricas(analise.esquema) if c.startswith('Angulo Joelho')]
+    barra = st.progress(0.0, text="Rastreando...")
+    st.button("⏹️ Cancelar")
+    grafico = st.empty()
+    partes = []
+    ultimo_desenho = 0.0
+
+    def progresso(feitos, total):
+        if total and feitos % 15 == 0:
+            barra.progress(min(feitos / total, 1.0), text=f"Rastreando... {feitos}/{total} frames")
+
+    for bloco in analise.iterar_resultados(tamanho_bloco, progresso, guardar_trajetoria=True):
+        partes.append(pd.DataFrame(bloco))
+        # redesenha o gráfico no máximo a cada intervalo_grafico segundos
+        if time.time() - ultimo_desenho >= intervalo_grafico:
+            serie = reduzir_df(pd.concat(partes, ignore_index=True), angulos, max_pontos)
+            grafico.line_chart(serie.set_index('Frame')[angulos])
+            ultimo_desenho = time.time()
+
+    barra.empty()
+    grafico.empty()
+    with analise.instr.medir('dataframe'):
+        vazio = ['Frame'] + colunas_metricas(analise.esquema) + (['Repeticao'] if analise.janelas is not None else [])
+        df = pd.concat(partes, ignore_index=True) if partes else pd.DataFrame(columns=vazio)
+    if analise.instrumentar:
+        analise.registrar_diagnostico()
+        df.attrs['diagnostico'] = analise.diagnostico
+    return df
+
+# salva no histórico do paciente as sessões analisadas, com a data escolhida para cada uma
+# sessoes: dict titulo -> (DataFrame, trajetória, pontos iniciais, parâmetros com que a análise rodou)
+def interface_salvar_historico(nome_paciente, sessoes, key_suffix):
+    st.subheader("🗂️ Histórico do Paciente")
+    colunas = st.columns(len(sessoes))
+    datas = {titulo: col.date_input(f"Data da sessão ({titulo})", key=f"data_{key_suffix}_{titulo}", format="DD/MM/YYYY")
+             for col, titulo in zip(colunas, sessoes)}
+    if st.button("💾 Salvar no histórico", key=f"salvar_{key_suffix}"):
+        armazem = obter_armazem()
+        for titulo, (df, trajetoria, pontos, parametros) in sessoes.items():
+            data = datetime.combine(datas[titulo], datetime.now().time())
+            armazem.salvar(nome_paciente, df, trajetoria, pontos, data, titulo, parametros)
+        st.success(f"Sessão salva no histórico de {nome_paciente}.")
+
+# Uploads ficam em uma pasta própria, um arquivo por conteúdo (nome = hash)
+PASTA_UPLOADS = os.path.join(tempfile.gettempdir(), 'biostep_uploads')
+VALIDADE_UPLOAD = 6 * 3600  # segundos sem uso até o arquivo ser apagado
+
+# apaga uploads que não são usados há mais de VALIDADE_UPLOAD
+def limpar_uploads_antigos():
+    limite = time.time() - VALIDADE_UPLOAD
+    for nome in os.listdir(PASTA_UPLOADS):
+        caminho = os.path.join(PASTA_UPLOADS, nome)
+        try:
+            if os.path.getmtime(caminho) < limite: os.remove(caminho)
+        except FileNotFoundError:
+            pass
+
+# Função para salvar vídeo: grava uma única vez por conteúdo e devolve (caminho, hash)
 def salvar_temp(uploaded_file):
-    if uploaded_file is not None:
-        tfile = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4')
-        tfile.write(uploaded_file.read())
-        return tfile.name
-    return None
+    if uploaded_file is None:
+        return None, None
 
-#Função PDF
-class  PDFReport(FPDF):
-    def header(self):
-        self.set_font('Arial', 'B', 12)
-        self.cell(0, 10, 'Relatório BioStep Analyzer', 0, 1, 'C')
-
-    def footer(self):
-        self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Página {self.page_no()}', 0, 0, 'C')
-
-#Função para gerar relatório PDF
-def gerar_pdf(nome_paciente, df, fig_ang,fig_desvio, fig_pelve, tipo_analise="Individual"):
-    pdf = PDFReport()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-
-    #  dados do paciente
-    pdf.set_font("Arial", 'B', 12)
-    pdf.cell(0,10, f"Paciente: {nome_paciente}", 0,1)
-    pdf.cell(0,10, f"Data: {datetime.now().strftime('%d/%m/%Y')}", 0,1)
-    pdf.cell(0,10, f"Tipo de Análise: {tipo_analise}", 0,1)
-    
-    # resumo dos dados
-    pdf.set_font("Arial", 'B', 14)
-    pdf.cell(0, 10, 'Resumo das Métricas Principais', 0, 1)
-    pdf.set_font("Arial", size=11)
-
-    # extrair metricas dependendo  do tipo de análise
-    if 'Periodo' in df.columns: # Comparação
-        valgo_antes = df[df['Periodo']=='Antes']['Angulo Joelho'].min()
-        valgo_depois = df[df['Periodo']=='Depois']['Angulo Joelho'].min()
-        pdf.cell(0, 8, f"Angulo Minimo (Antes): {valgo_antes:.1f} graus", 0, 1)
-        pdf.cell(0, 8, f"Angulo Minimo (Depois): {valgo_depois:.1f} graus", 0, 1)
-        pdf.cell(0, 8, f"Evolucao: {valgo_depois - valgo_antes:.1f} graus", 0, 1)
-    else: # Individual
-        pdf.cell(0, 8, f"Angulo Minimo de Valgo: {df['Angulo Joelho'].min():.1f} graus", 0, 1)
-        pdf.cell(0, 8, f"Desvio Medial Maximo: {df['Desvio Valgo (px)'].max():.1f} px", 0, 1)
-        pdf.cell(0, 8, f"Queda Pelvica Maxima: {abs(df['Queda Pelvica'].max() - 180):.1f} graus", 0, 1)
-    
-    pdf.ln(5)
-    
-    # salvar e inserir graficos
-    imgs = []
-    for fig in [fig_ang, fig_desvio, fig_pelve]:
-        if fig:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-                fig.write_image(tmp.name, width=800, height=400) # Requer 'kaleido'
-                imgs.append(tmp.name)
-                pdf.image(tmp.name, x=10, w=190)
-                pdf.ln(5)
-    
-    # limpar imagens temporárias
-    for img in imgs:
-        os.remove(img)
-        
-    return pdf.output(dest='S').encode('latin-1')
+    # o hash é calculado uma vez por upload e reaproveitado nos reruns
+    chave_sessao = f'hash_upload_{uploaded_file.file_id}'
+    if chave_sessao not in st.session_state:
+        st.session_state[chave_sessao] = hash_bytes(uploaded_file.getvalue())
+    hash_video = st.session_state[chave_sessao]
+
+    extensao = os.path.splitext(uploaded_file.name)[1].lower() or '.mp4'
+    caminho = os.path.join(PASTA_UPLOADS, hash_video + extensao)
+    if os.path.exists(caminho):
+        os.utime(caminho)  # marca o uso para a limpeza
+    else:
+        os.makedirs(PASTA_UPLOADS, exist_ok=True)
+        limpar_uploads_antigos()
+        # grava em temporário e renomeia para outra sessão nunca ler um arquivo pela metade
+        with tempfile.NamedTemporaryFile(dir=PASTA_UPLOADS, suffix='.tmp', delete=False) as tfile:
+            tfile.write(uploaded_file.getvalue())
+        os.replace(tfile.name, caminho)
+    return caminho, hash_video
+
+# primeiro frame do vídeo, guardado por hash: marcar os pontos não reabre o vídeo a cada clique
+@st.cache_data(max_entries=16, show_spinner=False)
+def carregar_frame_inicial(hash_video, _video_path, preservar_aspecto=False):
+    from biostep_engine import AnalisadorBioStep
+    analise = AnalisadorBioStep(_video_path, preservar_aspecto=preservar_aspecto)
+    frame_bgr = analise.frame_inicial # Usado para o cálculo (OpenCV - BGR)
+    frame_rgb = analise.get_frame_inicial_rgb() # Usado para exibir (Streamlit - RGB)
+    analise.fechar()
+    return frame_bgr, frame_rgb
 
 # ------ Interface de Marcação de Pontos com Correção ------
-def interface_marcador_pontos(video_path, key_suffix):
+def interface_marcador_pontos(video_path, hash_video, key_suffix, esquema='padrao', preservar_aspecto=False):
+    import cv2
+    from streamlit_image_coordinates import streamlit_image_coordinates
+    from biostep_engine import obter_esquema, refinar_ponto_pela_cor
  
-    if f'pontos_{key_suffix}' not in st.session_state:
+    # trocar de esquema ou de proporção recomeça a marcação
+    marcacao = (esquema, preservar_aspecto)
+    if f'pontos_{key_suffix}' not in st.session_state or st.session_state.get(f'marcacao_{key_suffix}') != marcacao:
         st.session_state[f'pontos_{key_suffix}'] = []
+        st.session_state[f'marcacao_{key_suffix}'] = marcacao
     
     pontos = st.session_state[f'pontos_{key_suffix}']
-    nomes_pontos = ["1. Esterno", "2. Quadril Dir", "3. Quadril Esq", "4. Joelho (Apoio)", "5. Tornozelo"]
+    esquema = obter_esquema(esquema)
+    nomes_pontos = [f"{i}. {nome}" for i, nome in enumerate(esquema.get('rotulos', esquema['pontos']), 1)]
     
-    # cria analisador para pegar frames
-    analise = AnalisadorBioStep(video_path)
-    frame_bgr = analise.frame_inicial # Usado para o cálculo (OpenCV - BGR)
-    frame_rgb = analise.get_frame_inicial_rgb() # Usado para exibir (Streamlit - RGB)
+    # primeiro frame em cache (BGR para o cálculo, RGB para exibir)
+    frame_bgr, frame_rgb = carregar_frame_inicial(hash_video, video_path, preservar_aspecto)
     
     # desenha os pontos já marcados
     img_display = frame_rgb.copy()
@@ -126,8 +383,8 @@ def interface_marcador_pontos(video_path, key_suffix):
         cv2.circle(img_display, p, 10, (0, 255, 0), 1) 
         cv2.putText(img_display, str(i+1), (p[0]+10, p[1]), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
 
-    # total de pontos = 5, se não completou, pede próximo ponto
-    if len(pontos) < 5:
+    # se não completou os pontos do esquema, pede o próximo
+    if len(pontos) < len(nomes_pontos):
         st.warning(f"📍 Clique no ponto: **{nomes_pontos[len(pontos)]}** (O sistema ajustará para o centro amarelo)")
         
         # capta coordenadas do clique
@@ -185,6 +442,8 @@ elif opcao_menu == OPT_COMO_USAR:
         * 3. Quadril Esquerdo
         * 4. Joelho (Apoio)
         * 5. Tornozelo (Apoio)
+    4. **Avaliação Bilateral:** Escolha **Bilateral** em *Marcadores* para rastrear as duas pernas de uma vez.
+       A ordem passa a ser Esterno, Quadril Dir, Quadril Esq, Joelho Dir, Tornozelo Dir, Joelho Esq e Tornozelo Esq.
     """)
 
 elif opcao_menu == OPT_METODOLOGIA:
@@ -273,38 +532,59 @@ elif opcao_menu == OPT_METODOLOGIA:
         st.latex(r"\beta_{tronco} = \arctan\left(\frac{\Delta x}{\Delta y}\right)")
 
 elif opcao_menu == OPT_INDIVIDUAL:
+    import pandas as pd
+    from biostep_engine import calcular_picos, resumo_repeticoes
+    from biostep_relatorio import gerar_pdf, figuras_padrao
+    max_pontos = limite_pontos()
     st.header("📂 Análise Individual")
     nome_paciente = st.text_input("Nome do Paciente", "Paciente X")
     video_file = st.file_uploader("Carregar Vídeo", type=['mp4', 'mov'])
     
     if video_file:
-        path = salvar_temp(video_file)
-        pontos_finais = interface_marcador_pontos(path, "unico")
+        path, hash_video = salvar_temp(video_file)
+        esquema = escolher_esquema("unico")
+        preservar_aspecto = escolher_aspecto("unico", (path, hash_video))
+        pontos_finais = interface_marcador_pontos(path, hash_video, "unico", esquema, preservar_aspecto)
         
         if pontos_finais:
+            opcoes = opcoes_rastreamento("unico", esquema, preservar_aspecto)
+            ao_vivo = st.checkbox("📈 Acompanhar o gráfico durante o rastreamento", key="ao_vivo_unico",
+                                  help="Rastreia nesta página, desenhando o gráfico do joelho em tempo real; a página fica ocupada até o fim. Sem esta opção, a análise vai para a fila do servidor.")
+            if ao_vivo: opcoes['blocos_paralelos'] = 0  # o acompanhamento ao vivo rastreia em sequência
             if st.button("🚀 Processar"):
-                analise = AnalisadorBioStep(path, "Video Unico")
-                analise.set_pontos(pontos_finais)
-                with st.spinner('Processando...'):
-                    df = analise.processar_video()
-                os.remove(path)
-                st.session_state['resultado_df'] = df
+                if ao_vivo:
+                    resultado = processar_com_cache(path, hash_video, pontos_finais, "Video Unico", ao_vivo=True, max_pontos=max_pontos, **opcoes)
+                    st.session_state['resultado_df'], st.session_state['resultado_traj'], st.session_state['resultado_param'] = resultado
+                else:
+                    enviar_analises('tarefas_unico', {"Video Unico": (path, hash_video, pontos_finais)}, usuario, **opcoes)
+
+            coletado = coletar_analises('tarefas_unico')
+            if coletado:
+                resultados, erros = coletado
+                for erro in erros.values():
+                    st.error(f"Erro ao processar o vídeo: {erro}")
+                if resultados:
+                    st.session_state['resultado_df'], st.session_state['resultado_traj'], st.session_state['resultado_param'] = resultados["Video Unico"]
+            acompanhar_analises('tarefas_unico')
                 
             if 'resultado_df' in st.session_state:
                 df = st.session_state['resultado_df']
-                c1, c2, c3 = st.columns(3)
-                c1.metric("Pico Valgo", f"{df['Angulo Joelho'].min():.1f}°")
-                c2.metric("Desvio Máx", f"{df['Desvio Valgo (px)'].max():.1f} px")
-                c3.metric("Queda Pélvica", f"{abs(df['Queda Pelvica'].max() - 180):.1f}°")
-
-                fig_ang = px.line(df, x="Frame", y="Angulo Joelho", title="Ângulo Joelho")
-                fig_desvio = px.line(df, x="Frame", y="Desvio Valgo (px)", title="Desvio Linear")
-                fig_pelve = px.line(df, x="Frame", y="Queda Pelvica", title="Pelve")
+                avisar_resultado_vazio(df)
+                if not df.empty: mostrar_picos(calcular_picos(df))
+
+                if 'Repeticao' in df.columns:
+                    st.markdown("**Picos por repetição**")
+                    st.dataframe(pd.DataFrame(resumo_repeticoes(df)), hide_index=True)
+
+                if opcoes['instrumentar']:
+                    painel_diagnostico(df.attrs.get('diagnostico'))
+
+                fig_ang, fig_desvio, fig_pelve = figuras_padrao(intervalo_frames(df, "unico"), max_pontos)
                 
                 st.plotly_chart(fig_ang, use_container_width=True)
                 col_g1, col_g2 = st.columns(2)
                 col_g1.plotly_chart(fig_desvio, use_container_width=True)
-                col_g2.plotly_chart(fig_pelve, use_container_width=True)
+                if fig_pelve is not None: col_g2.plotly_chart(fig_pelve, use_container_width=True)
                 
                 st.divider()
                 st.subheader("💾 Exportar Resultados")
@@ -314,11 +594,19 @@ elif opcao_menu == OPT_INDIVIDUAL:
                 
                 if col_d2.button("📄 Gerar Relatório PDF"):
                     with st.spinner("Gerando PDF..."):
-                        pdf_bytes = gerar_pdf(nome_paciente, df, fig_ang, fig_desvio, fig_pelve)
+                        pdf_bytes = gerar_pdf(nome_paciente, df, *figuras_padrao(df))  # vídeo inteiro
                         st.download_button("📥 Clique para Baixar PDF", pdf_bytes, f"{nome_paciente}_relatorio.pdf", "application/pdf")
 
+                st.divider()
+                # os parâmetros da análise exibida, não os das opções marcadas agora
+                sessao = (df, st.session_state['resultado_traj'], pontos_finais, st.session_state['resultado_param'])
+                interface_salvar_historico(nome_paciente, {"Individual": sessao}, "unico")
+
 
 elif opcao_menu == OPT_COMPARACAO:
+    from biostep_engine import combinar_sessoes
+    from biostep_relatorio import gerar_pdf, figura_comparacao
+    max_pontos = limite_pontos()
     st.header("🔄 Comparativo")
     nome_paciente = st.text_input("Nome do Paciente", "Paciente X")
     c1, c2 = st.columns(2)
@@ -326,33 +614,46 @@ elif opcao_menu == OPT_COMPARACAO:
     v2 = c2.file_uploader("Vídeo DEPOIS", type=['mp4'])
 
     if v1 and v2:
-        path1, path2 = salvar_temp(v1), salvar_temp(v2)
+        (path1, hash1), (path2, hash2) = salvar_temp(v1), salvar_temp(v2)
         
+        esquema = escolher_esquema("comp")  # o mesmo nos dois vídeos
+        preservar_aspecto = escolher_aspecto("comp", (path1, hash1), (path2, hash2))
         col_esq, col_dir = st.columns(2) 
         
         with col_esq: 
             st.subheader("Antes")
-            pts1 = interface_marcador_pontos(path1, "v1")
+            pts1 = interface_marcador_pontos(path1, hash1, "v1", esquema, preservar_aspecto)
         with col_dir: 
             st.subheader("Depois")
-            pts2 = interface_marcador_pontos(path2, "v2")
+            pts2 = interface_marcador_pontos(path2, hash2, "v2", esquema, preservar_aspecto)
 
         if pts1 and pts2:
+            opcoes = opcoes_rastreamento("comp", esquema, preservar_aspecto)
             if st.button("🚀 Comparar"):
-                a1 = AnalisadorBioStep(path1); a1.set_pontos(pts1)
-                df1 = a1.processar_video()
-                a2 = AnalisadorBioStep(path2); a2.set_pontos(pts2)
-                df2 = a2.processar_video()
-                os.remove(path1); os.remove(path2)
-                
-                df1['Periodo'] = 'Antes'; df2['Periodo'] = 'Depois'
-                df_final = pd.concat([df1, df2])
-                st.session_state['comp_df'] = df_final
+                sessoes = {'Antes': (path1, hash1, pts1), 'Depois': (path2, hash2, pts2)}
+                enviar_analises('tarefas_comp', sessoes, usuario, **opcoes)  # os dois vídeos rodam em paralelo
+
+            coletado = coletar_analises('tarefas_comp')
+            if coletado:
+                resultados, erros = coletado
+                for rotulo, erro in erros.items():
+                    st.error(f"Erro ao processar o vídeo {rotulo}: {erro}")
+                if not erros:
+                    st.session_state['comp_resultados'] = resultados
+                    st.session_state['comp_df'] = combinar_sessoes({rotulo: df for rotulo, (df, _, _) in resultados.items()})
+                    st.session_state['comp_diag'] = {rotulo: df.attrs.get('diagnostico') for rotulo, (df, _, _) in resultados.items()}
+            acompanhar_analises('tarefas_comp')
             
             if 'comp_df' in st.session_state:
                 df_final = st.session_state['comp_df']
-                fig_comp = px.line(df_final, x="Frame", y="Angulo Joelho", color="Periodo", title="Comparativo: Ângulo Q Dinâmico", color_discrete_map={"Antes":"red", "Depois":"green"})
+                for rotulo, (df, _, _) in st.session_state['comp_resultados'].items():
+                    avisar_resultado_vazio(df, rotulo)
+                fig_comp = figura_comparacao(intervalo_frames(df_final, "comp"), max_pontos)
                 st.plotly_chart(fig_comp, use_container_width=True)
+
+                if opcoes['instrumentar']:
+                    for rotulo, diagnostico in st.session_state.get('comp_diag', {}).items():
+                        painel_diagnostico(diagnostico, f"🩺 Diagnóstico de desempenho – {rotulo}")
                 
                 st.divider()
                 st.subheader("💾 Exportar Resultados")
@@ -360,5 +661,128 @@ elif opcao_menu == OPT_COMPARACAO:
                 csv_data = df_final.to_csv(index=False).encode('utf-8')
                 cd1.download_button("📥 Baixar Dados (CSV)", csv_data, f"{nome_paciente}_comparacao.csv", "text/csv")
                 if cd2.button("📄 Relatório PDF"):
-                    pdf_bytes = gerar_pdf(nome_paciente, df_final, fig_comp, None, None, "Comparativa")
-                    st.download_button("📥 Baixar PDF", pdf_bytes, f"{nome_paciente}_relatorio_comp.pdf", "application/pdf")
\ No newline at end of file
+                    pdf_bytes = gerar_pdf(nome_paciente, df_final, figura_comparacao(df_final), None, None, "Comparativa")
+                    st.download_button("📥 Baixar PDF", pdf_bytes, f"{nome_paciente}_relatorio_comp.pdf", "application/pdf")
+
+                st.divider()
+                pontos = {'Antes': pts1, 'Depois': pts2}
+                sessoes = {rotulo: (df, trajetoria, pontos[rotulo], parametros)
+                           for rotulo, (df, trajetoria, parametros) in st.session_state['comp_resultados'].items()}
+                interface_salvar_historico(nome_paciente, sessoes, "comp")
+
+elif opcao_menu == OPT_HISTORICO:
+    import pandas as pd
+    import plotly.express as px
+    from biostep_engine import calcular_picos, combinar_sessoes, reduzir_df
+    max_pontos = limite_pontos()
+    st.header("🗂️ Histórico de Sessões")
+    armazem = obter_armazem()
+    pacientes = armazem.pacientes()
+
+    if not pacientes:
+        st.info("Nenhuma sessão salva ainda. Depois de processar um vídeo, use **💾 Salvar no histórico**.")
+    else:
+        paciente = st.selectbox("Paciente", pacientes)
+        sessoes = armazem.listar(paciente)
+        st.dataframe(pd.DataFrame([{'Data': s['data'].replace('T', ' '), 'Sessão': s['titulo'], 'Frames': s['frames'], **s['picos']}
+                                   for s in sessoes]), hide_index=True)
+
+        # rótulo legível -> id da sessão
+        rotulos = {f"{s['data'][:16].replace('T', ' ')} – {s['titulo']}": s['id'] for s in sessoes}
+        escolhidas = st.multiselect("Sessões para comparar", list(rotulos), default=list(rotulos)[-2:])
+        recalcular = st.checkbox("🔁 Recalcular métricas a partir das trajetórias salvas",
+                                 help="Aplica a versão atual das fórmulas aos pontos guardados, sem abrir os vídeos de novo.")
+
+        if escolhidas:
+            # as trajetórias e métricas são lidas dos arquivos mapeados em memória
+            dfs = {}
+            for rotulo in escolhidas:
+                sessao = armazem.carregar(rotulos[rotulo])
+                dfs[rotulo] = sessao.recalcular_metricas() if recalcular else sessao.dataframe()
+            df_hist = combinar_sessoes(dfs)
+
+            # sessões bilaterais têm uma coluna de ângulo e de desvio por lado
+            metricas = [c for c in df_hist.columns if c not in ('Frame', 'Repeticao', 'Periodo') and not c.startswith('Confianca')]
+            metrica = st.selectbox("Métrica", metricas)
+            visivel = reduzir_df(intervalo_frames(df_hist, "hist"), metrica, max_pontos, grupo="Periodo")
+            fig_hist = px.line(visivel, x="Frame", y=metrica, color="Periodo", title=f"Evolução: {metrica}")
+            st.plotly_chart(fig_hist, use_container_width=True)
+            st.dataframe(pd.DataFrame([{'Sessão': rotulo, **calcular_picos(df)} for rotulo, df in dfs.items()]), hide_index=True)
+
+            csv_hist = df_hist.to_csv(index=False).encode('utf-8')
+            st.download_button("📥 Baixar Dados (CSV)", csv_hist, f"{paciente}_historico.csv", "text/csv")
+elif opcao_menu == OPT_TAREFAS:
+    import pandas as pd
+    from biostep_engine import AnalisadorBioStep, calcular_picos
+    from biostep_jobs import EM_ANDAMENTO
+    from biostep_relatorio import figuras_padrao
+    max_pontos = limite_pontos()
+    st.header("⏳ Análises em Andamento")
+    st.markdown(f"Análises enviadas por **{usuario}**. Elas continuam rodando no servidor se você fechar a página; "
+                "volte aqui (com o mesmo nome de profissional) para ver o resultado.")
+    gerenciador = obter_gerenciador()
+    NOMES_STATUS = {'na_fila': "⏸️ Na fila", 'rodando': "▶️ Rodando", 'concluida': "✅ Concluída",
+                    'erro': "❌ Erro", 'cancelada': "⏹️ Cancelada"}
+
+    # quadro atualizado a cada 2 s; quando uma análise termina, a página é recarregada para poder abri-la
+    @st.fragment(run_every=2)
+    def quadro_tarefas():
+        tarefas = gerenciador.listar(usuario)
+        ativas = {t['id'] for t in tarefas if t['status'] in EM_ANDAMENTO}
+        if st.session_state.get('tarefas_ativas', set()) - ativas:
+            st.session_state['tarefas_ativas'] = ativas
+            st.rerun()
+        st.session_state['tarefas_ativas'] = ativas
+        if not tarefas:
+            st.info("Nenhuma análise enviada. Use **🚀 Processar** na Análise Individual ou na Comparação.")
+            return
+
+        st.dataframe(pd.DataFrame([{
+            'Enviada': datetime.fromtimestamp(t['criada']).strftime('%d/%m %H:%M'), 'Vídeo': t['titulo'],
+            'Situação': NOMES_STATUS[t['status']] + (f" ({t['posicao_fila']}º)" if t['posicao_fila'] else ""),
+            'Progresso': t['feitos'] / t['total'] if t['total'] else 0.0, 'Erro': t.get('erro', ''),
+        } for t in tarefas]), hide_index=True,
+            column_config={'Progresso': st.column_config.ProgressColumn("Progresso", min_value=0.0, max_value=1.0)})
+
+        if ativas:
+            rotulos = {f"{t['titulo']} ({t['id']})": t['id'] for t in tarefas if t['id'] in ativas}
+            c1, c2 = st.columns([3, 1])
+            escolhida = c1.selectbox("Análise em andamento", list(rotulos), key="tarefa_cancelar")
+            if c2.button("⏹️ Cancelar", key="cancelar_tarefa"):
+                gerenciador.cancelar(rotulos[escolhida])
+
+    quadro_tarefas()
+
+    concluidas = [t for t in gerenciador.listar(usuario) if t['status'] == 'concluida']
+    if concluidas:
+        st.divider()
+        st.subheader("📊 Resultados")
+        rotulos = {f"{datetime.fromtimestamp(t['criada']):%d/%m %H:%M} – {t['titulo']} ({t['id']})": t for t in concluidas}
+        estado = rotulos[st.selectbox("Análise concluída", list(rotulos))]
+        resultado = gerenciador.resultado(estado['id'])
+        if resultado is None:
+            st.error("Resultado não encontrado.")
+        else:
+            df = resultado['df']
+            avisar_resultado_vazio(df)
+            if not df.empty: mostrar_picos(calcular_picos(df))
+            if df.attrs.get('diagnostico'):
+                painel_diagnostico(df.attrs['diagnostico'])
+
+            fig_ang, fig_desvio, fig_pelve = figuras_padrao(intervalo_frames(df, "tarefa"), max_pontos)
+            st.plotly_chart(fig_ang, use_container_width=True)
+            col_g1, col_g2 = st.columns(2)
+            col_g1.plotly_chart(fig_desvio, use_container_width=True)
+            if fig_pelve is not None: col_g2.plotly_chart(fig_pelve, use_container_width=True)
+
+            cd1, cd2 = st.columns(2)
+            cd1.download_button("📥 Baixar Dados (CSV)", df.to_csv(index=False).encode('utf-8'), f"{estado['titulo']}_dados.csv", "text/csv")
+            if cd2.button("🗑️ Remover da lista"):
+                gerenciador.remover(estado['id'])
+                st.rerun()
+
+            st.divider()
+            nome_paciente = st.text_input("Nome do Paciente", "Paciente X", key="paciente_tarefa")
+            parametros = AnalisadorBioStep(estado['video'], **estado['opcoes']).parametros_rastreamento()
+            interface_salvar_historico(nome_paciente, {estado['titulo']: (df, resultado['trajetoria'], estado['pontos'], parametros)},
+                                       "tarefa")